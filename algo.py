@@ -1,20 +1,46 @@
 import cv2
+import multiprocessing
 import numpy as np
 import os
+from collections import deque
+from PIL import Image
 from tqdm import tqdm
-import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from result_cache import ResultCache, cache_key, DEFAULT_MAX_BYTES
+import encoders
+import instrument
+import roi
 
-def process_image(image_path, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar_image):
-    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+ENGINES = ('vectorized', 'loop')
+
+# Error reported for images abandoned because the batch was cancelled
+CANCELLED = "cancelled"
+
+# Set in batch worker processes by _init_worker, so the filter loops can stop part way through an image
+_worker_cancel = None
+
+
+class FilterCancelled(Exception):
+    pass
 
-    if image is None:
-        print(f"Error: Could not read image {image_path}")
-        return
 
+def _init_worker(cancel_event):
+    global _worker_cancel
+    _worker_cancel = cancel_event
+
+
+def _check_cancel():
+    if _worker_cancel is not None and _worker_cancel.is_set():
+        raise FilterCancelled()
+
+
+# Reference implementation: walks every window in pure Python
+def _filter_loop(image, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar_image=None):
     height, width = image.shape
     processed_image = image.copy()
 
     for i in range(height - kernel_size + 1):
+        _check_cancel()
         for j in range(width - kernel_size + 1):
             block = image[i:i+kernel_size, j:j+kernel_size]
             
@@ -26,40 +52,501 @@ def process_image(image_path, output_dir, kernel_size, percentage, compare_value
             if count >= (kernel_size * kernel_size * (percentage / 100)):
                 processed_image[i:i+kernel_size, j:j+kernel_size] = set_value
 
-            pbar_image.update(1)
+            if pbar_image is not None:
+                pbar_image.update(1)
+
+    return processed_image
+
+
+# Window sums come from summed-area tables, so both steps of the vectorized engine cost O(1) per
+# pixel whatever the kernel size. cv2's int32 table can't overflow while the image has fewer than
+# 2**31 pixels; past that (gigapixel scans) the table is summed modulo 2**32 in NumPy, which still
+# gives every window its exact count because no window holds 2**32 pixels.
+CV2_INTEGRAL_PIXELS = 2 ** 31
+# A kernel fits in the image, so its windows stay under 2**32 pixels unless both sides reach 2**16
+UINT64_TABLE_SIDE = 2 ** 16
+
+
+def _integral(mask):
+    # (H+1, W+1[, C]) summed-area table of a 0/1 uint8 mask, with a zero first row and column
+    height, width = mask.shape[:2]
+    shape = (height + 1, width + 1) + mask.shape[2:]
+    if height * width < CV2_INTEGRAL_PIXELS:
+        # cv2 drops a single channel
+        return cv2.integral(mask, sdepth=cv2.CV_32S).reshape(shape)
+    table = np.zeros(shape, dtype=np.uint32 if min(height, width) < UINT64_TABLE_SIDE else np.uint64)
+    np.cumsum(mask, axis=0, dtype=table.dtype, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def _window_sums(table, kernel_size):
+    # Sum of every kernel_size x kernel_size window, indexed by the window's top-left corner
+    k = kernel_size
+    if table.dtype == np.int32:
+        # cv2's arithmetic is threaded; the unsigned tables of gigapixel images wrap in NumPy instead
+        sums = cv2.subtract(table[k:, k:], table[:-k, k:])
+        cv2.subtract(sums, table[k:, :-k], dst=sums)
+        cv2.add(sums, table[:-k, :-k], dst=sums)
+        return sums.reshape(table[k:, k:].shape)
+    sums = table[k:, k:] - table[:-k, k:]
+    sums -= table[k:, :-k]
+    sums += table[:-k, :-k]
+    return sums
+
+
+def _count_threshold(kernel_size, percentage, dtype):
+    # Fewest hits for a window to qualify: counts are integers, so count >= k*k*p/100 is count >= ceil(...)
+    threshold = np.ceil(kernel_size * kernel_size * (np.asarray(percentage, dtype=np.float64) / 100))
+    return np.clip(threshold, 0, kernel_size * kernel_size + 1).astype(dtype)
+
+
+# Kernels up to this size are stamped with cv2.dilate: its cost grows with the kernel but stays
+# below the summed-area stamp until about here, so the stamp's per-pixel cost is bounded either way
+DILATE_STAMP_MAX = 128
+
+
+def _stamp_mask(qualifying, kernel_size):
+    # Pixels covered by at least one qualifying window (qualifying is indexed by top-left corner)
+    k = kernel_size
+    height, width = qualifying.shape[0] + k - 1, qualifying.shape[1] + k - 1
+    if k <= DILATE_STAMP_MAX:
+        padded = np.zeros((height, width) + qualifying.shape[2:], dtype=np.uint8)
+        padded[:qualifying.shape[0], :qualifying.shape[1]] = qualifying
+        # A pixel is stamped if any window starting up to kernel_size-1 above/left of it qualifies
+        stamped = cv2.dilate(padded, np.ones((k, k), dtype=np.uint8), anchor=(k - 1, k - 1),
+                             borderType=cv2.BORDER_CONSTANT, borderValue=0)
+        return stamped.reshape(padded.shape).view(bool)
+    # Scattering +1 and -1 at the four corners of every qualifying window into a difference array
+    # and prefix-summing it in 2-D gives each pixel's coverage; that prefix sum is the summed-area
+    # table of the window corners read kernel_size apart, so it is computed the same way as the counts.
+    corners = np.zeros((height + k - 1, width + k - 1) + qualifying.shape[2:], dtype=np.uint8)
+    corners[k - 1:height, k - 1:width] = qualifying
+    return _window_sums(_integral(corners), k) > 0
+
+
+# Whole-array engine: summed-area tables count the hits in every window and stamp set_value over
+# every pixel covered by a qualifying window, in time independent of kernel_size
+def _filter_vectorized(image, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar_image=None):
+    height, width = image.shape
+    processed_image = image.copy()
+
+    if kernel_size < 1 or kernel_size > height or kernel_size > width:
+        return processed_image
+
+    if comparison_operator == '>=':
+        hits = (image >= compare_value).astype(np.uint8)
+    else:
+        hits = (image <= compare_value).astype(np.uint8)
+
+    counts = _window_sums(_integral(hits), kernel_size)
+    del hits
+    stamped = _stamp_mask(counts >= _count_threshold(kernel_size, percentage, counts.dtype), kernel_size)
+
+    processed_image[stamped] = set_value
+
+    if pbar_image is not None:
+        pbar_image.update(counts.shape[0] * counts.shape[1])
+
+    return processed_image
+
+
+def filter_image(image, kernel_size, percentage, compare_value, set_value, comparison_operator, engine='vectorized', pbar_image=None):
+    if engine == 'loop':
+        return _filter_loop(image, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar_image)
+    if engine == 'vectorized':
+        return _filter_vectorized(image, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar_image)
+    raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+
+
+# Images per cv2 call in filter_stack: the planes of several images are packed into the channels of
+# one array (cv2 allows up to 128), which amortizes the per-call overhead over small images
+STACK_PLANES = 16
+
+
+def _per_channel(value, channels, name):
+    values = np.atleast_1d(np.asarray(value, dtype=np.float64))
+    if values.size == 1:
+        return np.repeat(values, channels)
+    if values.size != channels:
+        raise ValueError(f"{name} has {values.size} values for {channels} channels")
+    return values
+
+
+# Filters a stack of same-shaped images, (N, H, W) gray or (N, H, W, C) multi-channel, in a few
+# vectorized passes. Every image and channel is filtered on its own, exactly as filter_image would;
+# percentage, compare_value and set_value are numbers or one value per channel. Chunks of the stack
+# run on a thread pool (cv2 releases the GIL).
+def filter_stack(stack, kernel_size, percentage, compare_value, set_value, comparison_operator, workers=1, out=None):
+    stack = np.asarray(stack)
+    if stack.ndim not in (3, 4):
+        raise ValueError(f"Expected an (N, H, W) or (N, H, W, C) stack, got shape {stack.shape}")
+    if out is None:
+        out = np.empty_like(stack)
+    # Gray stacks are handled as single-channel ones
+    images_in = stack[..., None] if stack.ndim == 3 else stack
+    images_out = out[..., None] if out.ndim == 3 else out
+    count, height, width, channels = images_in.shape
+
+    percentages = _per_channel(percentage, channels, "percentage")
+    compare_values = _per_channel(compare_value, channels, "compare_value")
+    set_values = _per_channel(set_value, channels, "set_value").astype(stack.dtype)
+
+    if kernel_size < 1 or kernel_size > height or kernel_size > width:
+        images_out[...] = images_in
+        return out
+
+    per_call = max(STACK_PLANES // channels, 1)
+
+    def run_chunk(start):
+        images = images_in[start:start + per_call]
+        n = images.shape[0]
+        # (n, H, W, C) -> (H, W, n * C): every plane becomes a channel of one image
+        planes = np.ascontiguousarray(images.transpose(1, 2, 0, 3).reshape(height, width, n * channels))
+        if comparison_operator == '>=':
+            hits = (planes >= np.tile(compare_values, n)).astype(np.uint8)
+        else:
+            hits = (planes <= np.tile(compare_values, n)).astype(np.uint8)
+
+        counts = _window_sums(_integral(hits), kernel_size)
+        stamped = _stamp_mask(counts >= np.tile(_count_threshold(kernel_size, percentages, counts.dtype), n),
+                              kernel_size)
+
+        result = np.where(stamped, np.tile(set_values, n), planes)
+        images_out[start:start + n] = result.reshape(height, width, n, channels).transpose(2, 0, 1, 3)
+
+    starts = range(0, count, per_call)
+    if workers and workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(run_chunk, starts))
+    else:
+        for start in starts:
+            run_chunk(start)
+    return out
+
+
+# Filters image in horizontal strips of strip_height output rows. Each strip is read with a
+# (kernel_size - 1) halo above and below so windows crossing strip edges are counted exactly as in the
+# whole-image pass. Yields (start, stop, filtered rows) top to bottom; the cv2/numpy work releases the
+# GIL, so strips run on a thread pool, with at most workers + 1 strips in memory at a time. image only
+# needs .shape and row slicing, so it can be a _FileRows.
+def _filtered_strips(image, kernel_size, percentage, compare_value, set_value, comparison_operator, engine='vectorized', strip_height=1024, workers=1):
+    height = image.shape[0]
+    halo = max(kernel_size - 1, 0)
+    strip_height = max(int(strip_height), 1)
+
+    def run_strip(r0):
+        _check_cancel()
+        r1 = min(r0 + strip_height, height)
+        a = max(r0 - halo, 0)
+        b = min(r1 + halo, height)
+        result = filter_image(image[a:b], kernel_size, percentage, compare_value, set_value,
+                              comparison_operator, engine)
+        return r0, r1, result[r0 - a:r1 - a]
+
+    starts = range(0, height, strip_height)
+    if not workers or workers <= 1:
+        for r0 in starts:
+            yield run_strip(r0)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for r0 in starts:
+            pending.append(executor.submit(run_strip, r0))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def filter_image_tiled(image, kernel_size, percentage, compare_value, set_value, comparison_operator, engine='vectorized', strip_height=1024, workers=1, out=None):
+    if out is None:
+        out = np.empty_like(image)
+    for r0, r1, rows in _filtered_strips(image, kernel_size, percentage, compare_value, set_value,
+                                         comparison_operator, engine, strip_height, workers):
+        out[r0:r1] = rows
+    return out
+
+
+_TO_GRAY = {"bgr": cv2.COLOR_BGR2GRAY, "bgra": cv2.COLOR_BGRA2GRAY, "rgb": cv2.COLOR_RGB2GRAY,
+            "rgba": cv2.COLOR_RGBA2GRAY}
+
+
+class _FileRows:
+    # Gray rows of an image file, read on demand through a roi reader: stands in for the decoded
+    # image in strip mode (shape, and image[start:stop] for a band of rows)
+    def __init__(self, reader):
+        self.reader = reader
+        self.shape = (reader.height, reader.width)
+
+    def __getitem__(self, rows):
+        start, stop, _ = rows.indices(self.shape[0])
+        with instrument.span("decode", op="filter"):
+            pixels = self.reader.read(0, start, self.shape[1], stop - start)
+            # The rows read so far aren't needed again (but for the next strip's halo, which is re-read)
+            self.reader.release()
+            if self.reader.order == "gray":
+                return pixels[..., 0]
+            return cv2.cvtColor(pixels, _TO_GRAY[self.reader.order])
+
+
+def _read_gray(image_path, strip_height=None):
+    # The image to filter; None if it can't be read. In strip mode, tile caches, uncompressed
+    # TIFF/BMP/PGM/PPM and tiled TIFF are read a strip at a time (_FileRows), so only the strips being
+    # filtered are in memory. PNG and JPEG have no random access (PNG rows only decode in order, each
+    # through its filter), so they are decoded whole either way.
+    reader = roi.open_reader(image_path) if strip_height else None
+    if reader is not None:
+        return _FileRows(reader)
+    with instrument.span("decode", op="filter"):
+        return cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+
+
+# Filters image and encodes it to output_path with the encoder profile; with strip_height each strip is
+# written as soon as it and the ones above it are done, so the result is never whole in memory.
+# Returns (bytes written, seconds spent encoding)
+def _filter_to_file(image, output_path, kernel_size, percentage, compare_value, set_value, comparison_operator, engine, strip_height=None, strip_workers=1, pbar_image=None, encoder=encoders.DEFAULT_PROFILE):
+    # The old output may be a hard link into the result cache; replace it rather than write through it
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+
+    height, width = image.shape
+    instrument.count("pixels", height * width, op="filter")
+
+    if not strip_height:
+        with instrument.span("compute", op="filter"):
+            processed_image = filter_image(image, kernel_size, percentage, compare_value, set_value,
+                                           comparison_operator, engine, pbar_image)
+        encoded = encoders.write_image(output_path, processed_image, encoder, op="filter")
+    else:
+        writer = encoders.StripWriter(output_path, width, height, 1, encoder, op="filter")
+        try:
+            for _, _, rows in _filtered_strips(image, kernel_size, percentage, compare_value, set_value,
+                                               comparison_operator, engine, strip_height, strip_workers):
+                writer.write(rows)
+        except BaseException:
+            writer.abort()
+            raise
+        encoded = writer.close()
+
+    if pbar_image is not None and pbar_image.total:
+        pbar_image.update(pbar_image.total - pbar_image.n)
+    return encoded
+
+
+def process_image(image_path, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar_image, engine='vectorized', strip_height=None, strip_workers=1, encoder=encoders.DEFAULT_PROFILE):
+    image = _read_gray(image_path, strip_height)
+
+    if image is None:
+        print(f"Error: Could not read image {image_path}")
+        return
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     file_name = os.path.basename(image_path)
-    output_path = os.path.join(output_dir, file_name)
-    cv2.imwrite(output_path, processed_image)
-    print(f"Processed image saved to {output_path}")
+    output_path = encoders.output_path(os.path.join(output_dir, file_name), encoder)
+    nbytes, seconds = _filter_to_file(image, output_path, kernel_size, percentage, compare_value, set_value,
+                                      comparison_operator, engine, strip_height, strip_workers, pbar_image, encoder)
+    print(f"Processed image saved to {output_path} ({nbytes / 1024:.1f} KB, encoded in {seconds:.2f}s)")
+    return output_path
 
 
-def process_single_image(image_path, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar):
-    height, width = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE).shape
+def process_single_image(image_path, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar, engine='vectorized'):
+    # Only the header is read for the size; the image is decoded once, by process_image
+    with Image.open(image_path) as img:
+        width, height = img.size
     total_iterations = (height - kernel_size + 1) * (width - kernel_size + 1)
 
     with tqdm(total=total_iterations, desc=f"Processing {os.path.basename(image_path)}", position=1, leave=False) as pbar_image:
-        process_image(image_path, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar_image)
+        process_image(image_path, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar_image, engine)
 
     pbar.update(1)
 
 
-def process_images_in_directory(input_dir, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator):
-    image_files = [f for f in os.listdir(input_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp'))]
+# Runs in a worker process; errors are returned instead of raised so one bad file doesn't stop the batch
+# Returns (image_path, output_path, error, cached, bytes written, seconds spent encoding)
+def _process_file(image_path, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator, engine, strip_height=None, cache_dir=None, cache_link=True, encoder=encoders.DEFAULT_PROFILE):
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = encoders.output_path(os.path.join(output_dir, os.path.basename(image_path)), encoder)
+
+        cache = key = None
+        if cache_dir:
+            cache = ResultCache(cache_dir, link=cache_link)
+            key = cache_key(image_path, kernel_size, percentage, compare_value, set_value, comparison_operator,
+                            encoder)
+            if cache.fetch(key, output_path):
+                instrument.count("cache_hits", op="filter")
+                return image_path, output_path, None, True, os.path.getsize(output_path), 0.0
+
+        image = _read_gray(image_path, strip_height)
+        if image is None:
+            return image_path, None, f"Could not read image {image_path}", False, 0, 0.0
+
+        nbytes, seconds = _filter_to_file(image, output_path, kernel_size, percentage, compare_value, set_value,
+                                          comparison_operator, engine, strip_height, encoder=encoder)
+
+        if cache:
+            cache.store(key, output_path)
+        return image_path, output_path, None, False, nbytes, seconds
+    except FilterCancelled:
+        return image_path, None, CANCELLED, False, 0, 0.0
+    except Exception as e:
+        return image_path, None, str(e), False, 0, 0.0
+    finally:
+        # Worker processes exit without running atexit handlers
+        instrument.flush()
+
+
+# progress(count) is called as images finish. Once the optional cancel Event is set, queued images are
+# dropped and the workers stop the images they are on at their next row or strip
+def process_images_in_directory(input_dir, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator, engine='vectorized', workers=None, max_in_flight=None, strip_height=None, cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES, cache_link=True, progress=None, cancel=None, encoder=encoders.DEFAULT_PROFILE):
+    image_files = sorted(f for f in os.listdir(input_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')))
+
+    workers = workers or os.cpu_count() or 1
+    # Each queued task holds a decoded image in its worker, so cap how many are submitted at once
+    max_in_flight = max_in_flight or workers * 2
+
+    results = {}
+    failures = 0
+    hits = 0
+    encoded = encoders.EncodeStats(encoder)
+    pending = set()
+    paths = iter(os.path.join(input_dir, f) for f in image_files)
+
+    # Workers are spawned rather than forked: the GUI calls this from a Qt worker thread, and a fork of a
+    # multi-threaded process can hand the children a lock another thread was holding
+    context = multiprocessing.get_context("spawn")
+    # The caller's Event is only visible in this process; workers watch a multiprocessing copy of it
+    worker_cancel = context.Event() if cancel is not None else None
+    pool_args = {"initializer": _init_worker, "initargs": (worker_cancel,)} if cancel is not None else {}
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, **pool_args) as executor, \
+            tqdm(total=len(image_files), desc="Processing Images", unit="img") as pbar:
+        while True:
+            if cancel is not None and cancel.is_set():
+                worker_cancel.set()
+                paths = iter(())
+                for future in pending:
+                    future.cancel()
+
+            for image_path in paths:
+                pending.add(executor.submit(
+                    _process_file, image_path, output_dir, kernel_size, percentage,
+                    compare_value, set_value, comparison_operator, engine, strip_height, cache_dir, cache_link, encoder
+                ))
+                if len(pending) >= max_in_flight:
+                    break
+
+            if not pending:
+                break
+
+            # With a cancel Event, wake up regularly to look at it
+            done, pending = wait(pending, timeout=0.2 if cancel is not None else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.cancelled():
+                    continue
+                image_path, output_path, error, cached, nbytes, seconds = future.result()
+                if error == CANCELLED:
+                    continue
+                results[image_path] = {"output": output_path, "error": error, "cached": cached,
+                                       "bytes": nbytes, "encode_seconds": seconds}
+                if error:
+                    failures += 1
+                    tqdm.write(f"Error: {error}")
+                elif not cached:
+                    encoded.add(nbytes, seconds)
+                hits += cached
+                pbar.update(1)
+                pbar.set_postfix(failed=failures, cached=hits)
+                if progress:
+                    progress(1)
+
+    if cancel is not None and cancel.is_set():
+        print(f"Cancelled after {len(results)}/{len(image_files)} images")
+    print(f"Processed {len(results) - failures}/{len(results)} images into {output_dir}")
+    print(encoded.summary())
+
+    if cache_dir:
+        cache = ResultCache(cache_dir, cache_max_bytes)
+        evictions = cache.evict()
+        stats = cache.record(hits=hits, misses=len(results) - hits - failures, evictions=evictions)
+        print(f"Cache: {hits} hits, {len(results) - hits - failures} misses this run, {evictions} evicted "
+              f"({stats['hits']} hits / {stats['misses']} misses in total)")
+    return results
+
+
+# Filters many images by stacking the ones with the same shape and running filter_stack on each
+# stack: for thousands of small tiles, where per-image overhead dominates. Images are decoded and
+# encoded on a thread pool, batch_size at a time. With color, images are read as BGR and every channel
+# is filtered; per-channel percentage, compare_value and set_value are given in R, G, B order.
+# Returns results like process_images_in_directory.
+def filter_images_batched(image_paths, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator, color=False, batch_size=1024, workers=None, progress=None, cancel=None, encoder=encoders.DEFAULT_PROFILE):
+    image_paths = list(image_paths)
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    if color:
+        # OpenCV channel order
+        percentage, compare_value, set_value = (value[::-1] if isinstance(value, (list, tuple)) else value
+                                                for value in (percentage, compare_value, set_value))
+    flags = cv2.IMREAD_COLOR if color else cv2.IMREAD_GRAYSCALE
+
+    def decode(image_path):
+        with instrument.span("decode", op="filter"):
+            return cv2.imread(image_path, flags)
+
+    def encode(item):
+        image_path, image = item
+        output_path = encoders.output_path(os.path.join(output_dir, os.path.basename(image_path)), encoder)
+        try:
+            nbytes, seconds = encoders.write_image(output_path, image, encoder, op="filter")
+        except IOError as e:
+            return {"output": None, "error": str(e), "cached": False, "bytes": 0, "encode_seconds": 0.0}
+        encoded.add(nbytes, seconds)
+        return {"output": output_path, "error": None, "cached": False, "bytes": nbytes, "encode_seconds": seconds}
+
+    results = {}
+    failures = 0
+    encoded = encoders.EncodeStats(encoder)
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=len(image_paths), desc="Processing Images", unit="img") as pbar:
+        for start in range(0, len(image_paths), batch_size):
+            if cancel is not None and cancel.is_set():
+                break
+            batch = image_paths[start:start + batch_size]
+            groups = {}
+            for image_path, image in zip(batch, executor.map(decode, batch)):
+                if image is None:
+                    results[image_path] = {"output": None, "error": f"Could not read image {image_path}", "cached": False,
+                                           "bytes": 0, "encode_seconds": 0.0}
+                    continue
+                groups.setdefault(image.shape, []).append((image_path, image))
+
+            processed = []
+            for items in groups.values():
+                stack = np.stack([image for _, image in items])
+                with instrument.span("compute", op="filter"):
+                    filtered = filter_stack(stack, kernel_size, percentage, compare_value, set_value,
+                                            comparison_operator, workers)
+                instrument.count("pixels", stack.size, op="filter")
+                processed.extend((image_path, filtered[i]) for i, (image_path, _) in enumerate(items))
+
+            for (image_path, _), result in zip(processed, executor.map(encode, processed)):
+                results[image_path] = result
 
-    with tqdm(total=len(image_files), desc="Processing Images") as pbar:
-        threads = []
-        for filename in image_files:
-            image_path = os.path.join(input_dir, filename)
-            t = threading.Thread(
-                target=process_single_image,
-                args=(image_path, output_dir, kernel_size, percentage, compare_value, set_value, comparison_operator, pbar)
-            )
-            threads.append(t)
-            t.start()
+            for image_path in batch:
+                error = results[image_path]["error"]
+                if error:
+                    failures += 1
+                    tqdm.write(f"Error: {error}")
+            pbar.update(len(batch))
+            pbar.set_postfix(failed=failures)
+            if progress:
+                progress(len(batch))
 
-        for t in threads:
-            t.join()
+    if cancel is not None and cancel.is_set():
+        print(f"Cancelled after {len(results)}/{len(image_paths)} images")
+    print(f"Processed {len(results) - failures}/{len(results)} images into {output_dir}")
+    print(encoded.summary())
+    return results
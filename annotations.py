@@ -0,0 +1,156 @@
+# annotations.py
+# Box annotations for ImageViewer. Boxes are small __slots__ records held in an AnnotationStore with a
+# uniform-grid spatial index, so hit-testing and "which boxes are visible" only look at nearby cells.
+# A single AnnotationItem paints every visible box; coordinate labels are drawn only when zoomed in.
+
+from PyQt5.QtWidgets import QGraphicsItem, QStyleOptionGraphicsItem
+from PyQt5.QtGui import QPen, QFont
+from PyQt5.QtCore import Qt, QRectF, QPointF
+
+GRID_CELL = 256
+# Labels are unreadable below this zoom and would dominate paint time, so they are skipped
+LABEL_MIN_ZOOM = 0.5
+
+
+class Box:
+    __slots__ = ('id', 'x', 'y', 'width', 'height')
+
+    def __init__(self, box_id, x, y, width, height):
+        self.id = box_id
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+    def rect(self):
+        return QRectF(self.x, self.y, self.width, self.height)
+
+    def contains(self, x, y):
+        return self.x <= x <= self.x + self.width and self.y <= y <= self.y + self.height
+
+
+class AnnotationStore:
+    def __init__(self, cell=GRID_CELL):
+        self.cell = cell
+        self.boxes = {}  # insertion ordered: id -> Box
+        self.grid = {}   # (cx, cy) -> set of ids
+        self.next_id = 1
+        self.bounds = QRectF()
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __iter__(self):
+        return iter(self.boxes.values())
+
+    def _cells(self, x, y, width, height):
+        cx0, cy0 = int(x // self.cell), int(y // self.cell)
+        cx1, cy1 = int((x + width) // self.cell), int((y + height) // self.cell)
+        return [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+
+    def _index(self, box):
+        for cell in self._cells(box.x, box.y, box.width, box.height):
+            self.grid.setdefault(cell, set()).add(box.id)
+        self.bounds = self.bounds.united(box.rect()) if not self.bounds.isNull() else box.rect()
+
+    def _unindex(self, box):
+        for cell in self._cells(box.x, box.y, box.width, box.height):
+            ids = self.grid.get(cell)
+            if ids is not None:
+                ids.discard(box.id)
+                if not ids:
+                    del self.grid[cell]
+
+    def add(self, x, y, width, height):
+        box = Box(self.next_id, x, y, width, height)
+        self.next_id += 1
+        self.boxes[box.id] = box
+        self._index(box)
+        return box.id
+
+    def update(self, box_id, x, y, width, height):
+        box = self.boxes[box_id]
+        self._unindex(box)
+        box.x, box.y, box.width, box.height = x, y, width, height
+        self._index(box)
+
+    def remove(self, box_id):
+        box = self.boxes.pop(box_id)
+        self._unindex(box)
+        return box
+
+    def clear(self):
+        self.boxes.clear()
+        self.grid.clear()
+        self.bounds = QRectF()
+
+    def query(self, rect):
+        # Boxes intersecting rect, in insertion order
+        ids = set()
+        for cell in self._cells(rect.x(), rect.y(), rect.width(), rect.height()):
+            ids.update(self.grid.get(cell, ()))
+        x0, y0, x1, y1 = rect.left(), rect.top(), rect.right(), rect.bottom()
+        found = []
+        for box_id in sorted(ids):
+            box = self.boxes[box_id]
+            if box.x <= x1 and x0 <= box.x + box.width and box.y <= y1 and y0 <= box.y + box.height:
+                found.append(box)
+        return found
+
+    def hit(self, x, y):
+        # First drawn box containing the point, like the old linear scan over rect_items
+        ids = self.grid.get((int(x // self.cell), int(y // self.cell)), ())
+        for box_id in sorted(ids):
+            if self.boxes[box_id].contains(x, y):
+                return box_id
+        return None
+
+    def snapshot(self):
+        # Plain (x, y, width, height) tuples, safe to hand to another thread
+        return [(box.x, box.y, box.width, box.height) for box in self.boxes.values()]
+
+
+class AnnotationItem(QGraphicsItem):
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+        self.pen = QPen(Qt.red, 2)
+        self.font = QFont("Arial", 10)
+        self._bounds = QRectF()
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption, True)
+        self.setZValue(1)
+
+    def boundingRect(self):
+        return self._bounds
+
+    def refresh(self, rect=None):
+        # Call after changing the store; rect limits the repaint to the area that changed
+        bounds = self.store.bounds.adjusted(-60, -10, 120, 30)  # room for the pen and labels
+        if bounds != self._bounds:
+            self.prepareGeometryChange()
+            self._bounds = bounds
+        if rect is None:
+            self.update()
+        else:
+            self.update(rect.adjusted(-60, -10, 120, 30))
+
+    def paint(self, painter, option, widget=None):
+        # Widen the query so labels of boxes just outside the exposed area still get drawn
+        boxes = self.store.query(option.exposedRect.adjusted(-130, -30, 60, 10))
+        if not boxes:
+            return
+
+        painter.setPen(self.pen)
+        painter.setBrush(Qt.NoBrush)
+        painter.drawRects([box.rect() for box in boxes])
+
+        lod = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        if lod < LABEL_MIN_ZOOM:
+            return
+
+        painter.setFont(self.font)
+        baseline = painter.fontMetrics().ascent() + 4  # matches QGraphicsTextItem's document margin
+        for box in boxes:
+            right, bottom = box.x + box.width, box.y + box.height
+            painter.drawText(QPointF(box.x - 50 + 4, box.y + baseline), f"({box.x:.0f}, {box.y:.0f})")
+            painter.drawText(QPointF(right + 4, bottom + baseline), f"({right:.0f}, {bottom:.0f})")
@@ -1,15 +1,38 @@
 # app.py
+# python app.py [--startup-time]
+# With --startup-time the time until the window is on screen is printed and the app exits, which is
+# what bench.py measures. Operation modules (cv2, NumPy, PIL, ...) load in the background afterwards.
 import sys
+import time
+
+STARTED = time.perf_counter()
+
 from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import QTimer
 from mainwindow import MainWindow
+import operations
+
+
+def on_shown(measure):
+    shown = time.perf_counter() - STARTED
+    if measure:
+        print(f"startup_seconds={shown:.4f}")
+        QApplication.instance().quit()
+        return
+    operations.warm_up()
+
 
 if __name__ == '__main__':
+    measure = "--startup-time" in sys.argv
+
     # Create the application instance
     app = QApplication(sys.argv)
 
     # Create and display the main window
     window = MainWindow()
     window.show()
+    # Runs once the event loop has painted the window
+    QTimer.singleShot(0, lambda: on_shown(measure))
 
     # Start the event loop
     sys.exit(app.exec_())
@@ -0,0 +1,358 @@
+# bench.py
+# Reproducible benchmarks for the image operations. Synthetic inputs are generated from a fixed
+# seed, every case runs in a fresh process so its peak RSS can be measured, and results are
+# written as JSON so runs can be compared:
+#
+#   python bench.py --sizes 1,16 --regions 10,1000 --output results.json
+#   python bench.py --preset full --output new.json --compare results.json
+#   python bench.py --ops filter,crop --encoders default,fast,small,lossless-archival
+#
+# Every result records the bytes the operation wrote (output_bytes), so encoder profiles can be
+# compared on time and size.
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cv2
+import numpy as np
+
+import encoders
+
+PRESETS = {
+    "quick": {"sizes": [1, 4], "regions": [10, 1000], "kernel_sizes": [3]},
+    "full": {"sizes": [1, 16, 64, 200], "regions": [10, 1000, 100000], "kernel_sizes": [2, 8, 32, 128, 512]},
+}
+
+OPERATIONS = ["filter", "crop", "paste", "pdf", "viewer_crop", "startup"]
+
+
+def image_shape(megapixels):
+    # 4:3 landscape, like the scans
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = int(round(megapixels * 1e6 / width))
+    return height, width
+
+
+def make_image(path, megapixels, channels, seed):
+    if os.path.exists(path):
+        return path
+    rng = np.random.default_rng(seed)
+    height, width = image_shape(megapixels)
+    # Smooth gradient plus noise: compresses like a scan rather than pure noise
+    rows = np.linspace(0, 200, height, dtype=np.float32)[:, None]
+    cols = np.linspace(0, 55, width, dtype=np.float32)[None, :]
+    base = (rows + cols).astype(np.uint8)
+    if channels > 1:
+        base = np.repeat(base[:, :, None], channels, axis=2)
+    image = base + rng.integers(0, 16, base.shape, dtype=np.uint8)
+    cv2.imwrite(path, image)
+    return path
+
+
+def make_coordinates(path, megapixels, count, seed):
+    if os.path.exists(path):
+        return path
+    rng = np.random.default_rng(seed)
+    height, width = image_shape(megapixels)
+    sizes = rng.integers(16, 257, (count, 2))
+    sizes = np.minimum(sizes, [width, height])
+    xs = rng.integers(0, width - sizes[:, 0] + 1)
+    ys = rng.integers(0, height - sizes[:, 1] + 1)
+    coords = {
+        str(i + 1): {"x": int(x), "y": int(y), "width": int(w), "height": int(h)}
+        for i, (x, y, (w, h)) in enumerate(zip(xs, ys, sizes))
+    }
+    with open(path, "w") as f:
+        json.dump(coords, f)
+    return path
+
+
+def make_edited_crops(folder, image_path, json_path):
+    if os.path.isdir(folder):
+        return folder
+    os.makedirs(folder)
+    image = cv2.imread(image_path)
+    with open(json_path, "r") as f:
+        coords = json.load(f)
+    for key, c in coords.items():
+        crop = image[c["y"]:c["y"] + c["height"], c["x"]:c["x"] + c["width"]]
+        cv2.imwrite(os.path.join(folder, f"{key}.png"), 255 - crop)
+    return folder
+
+
+def peak_rss_mb(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+# Each timer does its imports and setup first and returns the seconds spent in the operation itself
+
+def _time_filter(case, out_dir):
+    from algo import process_image
+
+    start = time.perf_counter()
+    process_image(case["image"], out_dir, case["kernel_size"], 50, 100, 255, ">=", None, encoder=case["encoder"])
+    return time.perf_counter() - start
+
+
+def _time_crop(case, out_dir):
+    from crop import crop_images_by_json
+
+    start = time.perf_counter()
+    crop_images_by_json(case["image"], case["json"], out_dir, encoder=case["encoder"])
+    return time.perf_counter() - start
+
+
+def _time_paste(case, out_dir):
+    from PIL import Image
+    from replace import load_coordinates, paste_crops, save_result
+
+    Image.MAX_IMAGE_PIXELS = None
+    start = time.perf_counter()
+    coords = load_coordinates(case["json"])
+    original_img = Image.open(case["image"]).convert("RGBA")
+    merged = paste_crops(original_img, coords, case["edited"])
+    save_result(merged, os.path.join(out_dir, "merged.png"), case["encoder"])
+    return time.perf_counter() - start
+
+
+def _time_pdf(case, out_dir):
+    from pdf import png_to_pdf
+
+    start = time.perf_counter()
+    png_to_pdf(case["image"], os.path.join(out_dir, "out.pdf"), encoder=case["encoder"])
+    return time.perf_counter() - start
+
+
+def _time_viewer_crop(case, out_dir):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    from image_viewer import ImageViewer
+
+    app = QApplication.instance() or QApplication([])
+    viewer = ImageViewer()
+    viewer.load_image(case["image"])
+    with open(case["json"], "r") as f:
+        coords = json.load(f)
+    for c in coords.values():
+        viewer.add_box(c["x"], c["y"], c["width"], c["height"])
+
+    # _crop_and_save writes to ./crops
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        start = time.perf_counter()
+        viewer._crop_and_save()
+        return time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+
+def _time_startup(case, out_dir):
+    # Whole process, interpreter start included, until the main window is on screen
+    import subprocess
+
+    env = dict(os.environ)
+    env.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+    start = time.perf_counter()
+    subprocess.run([sys.executable, app_path, "--startup-time"], env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+TIMERS = {
+    "filter": _time_filter,
+    "crop": _time_crop,
+    "paste": _time_paste,
+    "pdf": _time_pdf,
+    "viewer_crop": _time_viewer_crop,
+    "startup": _time_startup,
+}
+
+
+def _tree_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+# Runs in a fresh process so peak RSS reflects this case only
+def run_case(case):
+    out_dir = tempfile.mkdtemp(prefix=f"bench_{case['op']}_", dir=case["workdir"])
+    try:
+        elapsed = TIMERS[case["op"]](case, out_dir)
+        output_bytes = _tree_bytes(out_dir)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    result = {
+        "name": case["name"],
+        "op": case["op"],
+        "megapixels": case["megapixels"],
+        "seconds": elapsed,
+        "mp_per_s": case["megapixels"] / elapsed if elapsed and case["megapixels"] else None,
+        "peak_rss_mb": peak_rss_mb(children=case["op"] == "startup"),
+        "output_bytes": output_bytes,
+    }
+    if case.get("encoder", "default") != "default":
+        result["encoder"] = case["encoder"]
+    if "regions" in case:
+        result["regions"] = case["regions"]
+        result["regions_per_s"] = case["regions"] / elapsed if elapsed else None
+    if "kernel_size" in case:
+        result["kernel_size"] = case["kernel_size"]
+    return result
+
+
+def build_cases(workdir, operations, sizes, regions, kernel_sizes, seed, encoders=("default",)):
+    cases = []
+    if "startup" in operations:
+        cases.append({"workdir": workdir, "megapixels": 0, "name": "startup", "op": "startup"})
+    for mp in sizes:
+        gray = make_image(os.path.join(workdir, f"gray_{mp}mp.png"), mp, 1, seed)
+        rgb = make_image(os.path.join(workdir, f"rgb_{mp}mp.png"), mp, 3, seed)
+
+        for encoder in encoders:
+            common = {"workdir": workdir, "megapixels": mp, "encoder": encoder}
+            # The default profile keeps the names older results files use
+            suffix = "" if encoder == "default" else f"/{encoder}"
+
+            if "filter" in operations:
+                for k in kernel_sizes:
+                    cases.append(dict(common, name=f"filter/{mp}mp/k{k}{suffix}", op="filter", image=gray, kernel_size=k))
+            if "pdf" in operations:
+                cases.append(dict(common, name=f"pdf/{mp}mp{suffix}", op="pdf", image=rgb))
+
+            for n in regions:
+                json_path = make_coordinates(os.path.join(workdir, f"coords_{mp}mp_{n}.json"), mp, n, seed)
+                region_case = dict(common, image=rgb, json=json_path, regions=n)
+                if "crop" in operations:
+                    cases.append(dict(region_case, name=f"crop/{mp}mp/{n}{suffix}", op="crop"))
+                if "paste" in operations:
+                    edited = make_edited_crops(os.path.join(workdir, f"edited_{mp}mp_{n}"), rgb, json_path)
+                    cases.append(dict(region_case, name=f"paste/{mp}mp/{n}{suffix}", op="paste", edited=edited))
+                if "viewer_crop" in operations and encoder == "default":
+                    cases.append(dict(region_case, name=f"viewer_crop/{mp}mp/{n}", op="viewer_crop"))
+    return cases
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path, "r") as f:
+        baseline = {r["name"]: r for r in json.load(f)["results"]}
+
+    regressions = []
+    for r in results:
+        old = baseline.get(r["name"])
+        if not old or "error" in r or "error" in old:
+            continue
+        ratio = r["seconds"] / old["seconds"] if old["seconds"] else 1.0
+        marker = "REGRESSION" if ratio > 1 + tolerance else ""
+        print(f"{r['name']:<32} {old['seconds']:>9.3f}s -> {r['seconds']:>9.3f}s  x{ratio:.2f} {marker}")
+        if marker:
+            regressions.append(r["name"])
+    return regressions
+
+
+def parse_list(value):
+    return [float(v) if "." in v else int(v) for v in value.split(",") if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the image operations")
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    parser.add_argument("--sizes", type=parse_list, help="Image sizes in megapixels, e.g. 1,16,200")
+    parser.add_argument("--regions", type=parse_list, help="Region counts, e.g. 10,1000,100000")
+    parser.add_argument("--kernel-sizes", dest="kernel_sizes", type=parse_list, help="Filter kernel sizes, e.g. 2,32,128")
+    parser.add_argument("--ops", default=",".join(OPERATIONS), help="Comma-separated subset of " + ",".join(OPERATIONS))
+    parser.add_argument("--encoders", default="default",
+                        help="Comma-separated encoder profiles to run filter, crop, paste and pdf with (see encoders.py)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="Keep the fastest of N runs per case")
+    parser.add_argument("--workdir", help="Where synthetic inputs are kept between runs (default: temp dir)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed slowdown before flagging a regression")
+    args = parser.parse_args(argv)
+
+    preset = PRESETS[args.preset]
+    sizes = args.sizes or preset["sizes"]
+    regions = args.regions or preset["regions"]
+    kernel_sizes = args.kernel_sizes or preset["kernel_sizes"]
+    operations = [op for op in args.ops.split(",") if op]
+    for op in operations:
+        if op not in OPERATIONS:
+            parser.error(f"unknown operation {op!r}")
+
+    encoder_names = [name for name in args.encoders.split(",") if name]
+    for name in encoder_names:
+        if name not in encoders.PROFILES:
+            parser.error(f"unknown encoder profile {name!r}")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_")
+    os.makedirs(workdir, exist_ok=True)
+
+    print(f"Generating inputs in {workdir}")
+    cases = build_cases(workdir, operations, sizes, regions, kernel_sizes, args.seed, encoder_names)
+
+    results = []
+    context = get_context("spawn")
+    for case in cases:
+        best = None
+        for _ in range(max(args.repeat, 1)):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                try:
+                    result = executor.submit(run_case, case).result()
+                except Exception as e:
+                    result = {"name": case["name"], "op": case["op"], "error": str(e)}
+            if best is None or "error" in best or ("error" not in result and result["seconds"] < best["seconds"]):
+                best = result
+        results.append(best)
+
+        if "error" in best:
+            print(f"{best['name']:<32} error: {best['error']}")
+        else:
+            if "regions_per_s" in best:
+                rate = f"{best['regions_per_s']:.1f} regions/s"
+            else:
+                rate = f"{best['mp_per_s']:.2f} MP/s" if best["mp_per_s"] else ""
+            print(f"{best['name']:<32} {best['seconds']:>9.3f}s  {rate:>18}  peak {best['peak_rss_mb']:.0f} MB  "
+                  f"out {best['output_bytes'] / (1024 * 1024):.1f} MB")
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "seed": args.seed, "results": results}, f, indent=4)
+    print(f"Results saved to {args.output}")
+
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,392 @@
+# cli.py
+# Headless entry point for the batch operations. Never imports PyQt5, so it runs on machines
+# without a display:
+#
+#   python cli.py filter INPUT_DIR OUTPUT_DIR --kernel-size 3 --percentage 75 --workers 8
+#   python cli.py filter TILES_DIR OUTPUT_DIR --color --compare-value 120,100,100
+#   python cli.py crop IMAGE JSON OUTPUT_DIR
+#   python cli.py crop IMAGE JSON OUTPUT_DIR --encoder fast      # see encoders.py for the profiles
+#   python cli.py paste JSON IMAGE EDITED_DIR OUTPUT
+#   python cli.py pdf PNG PDF
+#   python cli.py pdf PAGES_DIR book.pdf --mode lossless
+#   python cli.py regions crops/coordinates.regions coordinates.json
+#   python cli.py tiles scan.png      # once; later crops read only the tiles their regions touch
+#   python cli.py watch SCANS_DIR OUT_DIR --profiles profiles.json --profile default
+#   python cli.py pipeline PAGES_DIR book.pdf --kernel-size 3 --regions coords.regions --edited-dir edited
+#   python cli.py run jobs.json --parallel 4
+#   python cli.py --metrics-jsonl stages.jsonl --metrics-prom stages.prom filter IN OUT
+#
+# A job file is a list of operations (or {"jobs": [...]}) whose keys match the subcommand options:
+#
+#   [{"op": "filter", "input_dir": "scans", "output_dir": "out", "kernel_size": 3},
+#    {"op": "pdf", "png_path": "out/page1.png", "pdf_path": "page1.pdf"}]
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import instrument
+
+# Operation modules pull in cv2/PIL/reportlab, so they are imported on first use only
+
+FILTER_DEFAULTS = {
+    "kernel_size": 2,
+    "percentage": 50,
+    "compare_value": 100,
+    "set_value": 255,
+    "comparison_operator": ">=",
+    "engine": "vectorized",
+    "workers": None,
+    "strip_height": None,
+    "cache_dir": None,
+    "cache_max_mb": None,
+    "batch": False,
+    "color": False,
+    "batch_size": 1024,
+    "encoder": None,
+}
+
+ENCODER_HELP = "Output encoder profile: default, fast, small, webp or lossless-archival (see encoders.py)"
+
+
+def encoder_profile(params):
+    # The profile named by the job, checked before any work starts (ValueError if unknown)
+    import encoders
+
+    name = params.get("encoder") or encoders.DEFAULT_PROFILE
+    encoders.get_profile(name)
+    return name
+
+
+def run_filter(params):
+    from algo import filter_images_batched, process_images_in_directory
+
+    options = dict(FILTER_DEFAULTS)
+    options.update({k: v for k, v in params.items() if v is not None})
+    per_channel = any(isinstance(options[k], list) for k in ("percentage", "compare_value", "set_value"))
+    if per_channel and not options["color"]:
+        raise ValueError("per-channel values need --color")
+
+    if options["batch"] or options["color"]:
+        image_files = sorted(f for f in os.listdir(options["input_dir"])
+                             if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')))
+        results = filter_images_batched(
+            [os.path.join(options["input_dir"], f) for f in image_files],
+            options["output_dir"],
+            options["kernel_size"],
+            options["percentage"],
+            options["compare_value"],
+            options["set_value"],
+            options["comparison_operator"],
+            color=options["color"],
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+            encoder=encoder_profile(options),
+        )
+        return all(r["error"] is None for r in results.values())
+
+    results = process_images_in_directory(
+        options["input_dir"],
+        options["output_dir"],
+        options["kernel_size"],
+        options["percentage"],
+        options["compare_value"],
+        options["set_value"],
+        options["comparison_operator"],
+        engine=options["engine"],
+        workers=options["workers"],
+        strip_height=options["strip_height"],
+        cache_dir=options["cache_dir"],
+        encoder=encoder_profile(options),
+        **({"cache_max_bytes": options["cache_max_mb"] * 1024 * 1024} if options["cache_max_mb"] is not None else {}),
+    )
+    return all(r["error"] is None for r in results.values())
+
+
+def channel_values(text):
+    # "50" or, per colour channel, "50,60,70" (R, G, B)
+    values = [int(value) for value in text.split(",")]
+    return values[0] if len(values) == 1 else values
+
+
+def run_crop(params):
+    from crop import crop_images_by_json
+
+    summary = crop_images_by_json(params["image_path"], params["json_path"], params["output_dir"],
+                                  workers=params.get("workers"), png_compression=params.get("png_compression"),
+                                  encoder=encoder_profile(params))
+    return bool(summary) and summary["failed"] == 0
+
+
+def run_paste(params):
+    from replace import paste_edited_crops
+
+    summary = paste_edited_crops(params["json_path"], params["image_path"], params["edited_dir"], params["output_path"],
+                                 workers=params.get("workers"), incremental=not params.get("full"),
+                                 manifest_path=params.get("manifest_path"), encoder=encoder_profile(params))
+    return not summary["cancelled"] and summary["failed"] == 0
+
+
+def run_pdf(params):
+    from pdf import png_to_pdf, folder_to_pdf
+
+    mode = params.get("mode") or "auto"
+    quality = params.get("quality") or 95
+    encoder = encoder_profile(params)
+    # A directory becomes one multi-page PDF
+    if os.path.isdir(params["png_path"]):
+        saved = folder_to_pdf(params["png_path"], params["pdf_path"], mode, quality, params.get("workers"), encoder=encoder)
+    else:
+        saved = png_to_pdf(params["png_path"], params["pdf_path"], mode, quality, encoder)
+    return saved is not None
+
+
+def run_pipeline(params):
+    from pdf import IMAGE_EXTENSIONS
+    from pipeline import run_pipeline as pipeline, edited_from_dir
+
+    input_path = params["input_path"]
+    if os.path.isdir(input_path):
+        image_paths = [os.path.join(input_path, f) for f in sorted(os.listdir(input_path))
+                       if f.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        image_paths = [input_path]
+
+    filter_keys = ("kernel_size", "percentage", "compare_value", "set_value", "comparison_operator", "engine")
+    filter_params = {k: params[k] for k in filter_keys if params.get(k) is not None}
+    if not filter_params and not params.get("filter"):
+        filter_params = None
+
+    edit = edited_from_dir(params["edited_dir"], params.get("per_page", False)) if params.get("edited_dir") else None
+    saved = pipeline(image_paths, params["pdf_path"], filter_params, params.get("regions_path"), edit,
+                     params.get("output_dir"), params.get("mode") or "auto", params.get("quality") or 95,
+                     params.get("workers"), encoder_profile(params))
+    return saved is not None
+
+
+def run_watch(params):
+    import signal
+    import threading
+    from watch import Watcher, resolve_profile, save_profile
+
+    filter_params = resolve_profile(params.get("profiles_path"), params.get("profile"), params)
+    encoder_profile(filter_params)
+    if params.get("save_profile"):
+        if not params.get("profiles_path"):
+            raise ValueError("--save-profile needs --profiles")
+        save_profile(params["profiles_path"], params["save_profile"], filter_params)
+        print(f"Saved profile {params['save_profile']!r} to {params['profiles_path']}")
+
+    watcher = Watcher(params["input_dir"], params["output_dir"], filter_params, params.get("workers"),
+                      **{k: params[k] for k in ("poll_interval", "settle") if params.get(k) is not None})
+    stop = threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    return watcher.run(stop)
+
+
+def run_tiles(params):
+    from roi import convert_to_tiles, TILE_SIZE
+
+    tiles_path = convert_to_tiles(params["image_path"], params.get("tiles_path"), params.get("tile_size") or TILE_SIZE)
+    print(f"Wrote tile cache {tiles_path}")
+    return True
+
+
+def run_regions(params):
+    from regions import convert
+
+    convert(params["src_path"], params["dst_path"])
+    print(f"Regions written to {params['dst_path']}")
+    return True
+
+
+OPERATIONS = {
+    "filter": run_filter,
+    "crop": run_crop,
+    "paste": run_paste,
+    "pdf": run_pdf,
+    "pipeline": run_pipeline,
+    "regions": run_regions,
+    "tiles": run_tiles,
+    "watch": run_watch,
+}
+
+
+def load_jobs(job_path):
+    with open(job_path, "r") as f:
+        if job_path.lower().endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is required for YAML job files (pip install pyyaml)")
+            jobs = yaml.safe_load(f)
+        else:
+            jobs = json.load(f)
+
+    if isinstance(jobs, dict):
+        jobs = jobs.get("jobs", [])
+    for index, job in enumerate(jobs):
+        if job.get("op") not in OPERATIONS:
+            raise ValueError(f"job {index} has unknown op {job.get('op')!r}, expected one of {sorted(OPERATIONS)}")
+    return jobs
+
+
+def run_job(job):
+    params = {k: v for k, v in job.items() if k != "op"}
+    try:
+        return job["op"], OPERATIONS[job["op"]](params), None
+    except Exception as e:
+        return job["op"], False, str(e)
+
+
+def run_jobs(job_path, parallel=1):
+    jobs = load_jobs(job_path)
+
+    if parallel and parallel > 1:
+        with ProcessPoolExecutor(max_workers=parallel) as executor:
+            outcomes = list(executor.map(run_job, jobs))
+    else:
+        outcomes = [run_job(job) for job in jobs]
+
+    failures = 0
+    for index, (op, ok, error) in enumerate(outcomes):
+        if not ok:
+            failures += 1
+            print(f"Job {index} ({op}) failed" + (f": {error}" if error else ""), file=sys.stderr)
+
+    print(f"Completed {len(jobs) - failures}/{len(jobs)} jobs")
+    return failures == 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Headless image batch operations")
+    parser.add_argument("--metrics-jsonl", dest="metrics_jsonl",
+                        help="Append per-stage timings and counters to this JSON-lines file")
+    parser.add_argument("--metrics-prom", dest="metrics_prom",
+                        help="Write stage totals in Prometheus text format when done")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("filter", help="Kernel threshold filter over a directory")
+    p.add_argument("input_dir")
+    p.add_argument("output_dir")
+    p.add_argument("--kernel-size", dest="kernel_size", type=int)
+    p.add_argument("--percentage", type=channel_values, help="A number, or R,G,B values with --color")
+    p.add_argument("--compare-value", dest="compare_value", type=channel_values, help="A number, or R,G,B values with --color")
+    p.add_argument("--set-value", dest="set_value", type=channel_values, help="A number, or R,G,B values with --color")
+    p.add_argument("--operator", dest="comparison_operator", choices=[">=", "<="])
+    p.add_argument("--engine", choices=["vectorized", "loop"])
+    p.add_argument("--workers", type=int, help="Worker processes (default: CPU count)")
+    p.add_argument("--strip-height", dest="strip_height", type=int, help="Process each image in strips of this many rows")
+    p.add_argument("--cache-dir", dest="cache_dir", help="Reuse results for unchanged inputs from this directory")
+    p.add_argument("--cache-max-mb", dest="cache_max_mb", type=int, help="Evict least recently used results above this size")
+    p.add_argument("--batch", action="store_true",
+                   help="Filter same-sized images together in one process (many small images; vectorized engine, no cache)")
+    p.add_argument("--color", action="store_true", help="Filter each colour channel instead of converting to gray (implies --batch)")
+    p.add_argument("--batch-size", dest="batch_size", type=int, help="Images decoded at a time with --batch (default: 1024)")
+    p.add_argument("--encoder", help=ENCODER_HELP)
+
+    p = subparsers.add_parser("crop", help="Crop regions listed in a .regions file or coordinates JSON")
+    p.add_argument("image_path")
+    p.add_argument("json_path")
+    p.add_argument("output_dir")
+    p.add_argument("--workers", type=int, help="Encoder threads (default: CPU count)")
+    p.add_argument("--png-compression", dest="png_compression", type=int, choices=range(10), metavar="0-9")
+    p.add_argument("--encoder", help=ENCODER_HELP)
+
+    p = subparsers.add_parser("paste", help="Paste edited crops back into the master image")
+    p.add_argument("json_path")
+    p.add_argument("image_path")
+    p.add_argument("edited_dir")
+    p.add_argument("output_path")
+    p.add_argument("--workers", type=int, help="Decode threads (default: CPU count)")
+    p.add_argument("--manifest", dest="manifest_path", help="Crop manifest if not in EDITED_DIR (default: EDITED_DIR/crop_manifest.json)")
+    p.add_argument("--full", action="store_true", help="Paste every crop, even those unchanged since export")
+    p.add_argument("--encoder", help=ENCODER_HELP)
+
+    p = subparsers.add_parser("pdf", help="Convert an image, or a folder of images, to a PDF")
+    p.add_argument("png_path", help="Image file, or a directory for a multi-page PDF")
+    p.add_argument("pdf_path")
+    p.add_argument("--mode", choices=["auto", "lossless", "jpeg", "passthrough"])
+    p.add_argument("--quality", type=int, help="JPEG quality for --mode jpeg (default: 95)")
+    p.add_argument("--workers", type=int, help="Page encoder threads (default: CPU count)")
+    p.add_argument("--encoder", help="Encoder profile whose zlib level is used for lossless pages (default: level 6)")
+
+    p = subparsers.add_parser("pipeline", help="Filter, paste edited crops and build a PDF without intermediate files")
+    p.add_argument("input_path", help="Image file, or a directory of pages")
+    p.add_argument("pdf_path")
+    p.add_argument("--filter", action="store_true", help="Apply the threshold filter (implied by any filter option)")
+    p.add_argument("--kernel-size", dest="kernel_size", type=int)
+    p.add_argument("--percentage", type=int)
+    p.add_argument("--compare-value", dest="compare_value", type=int)
+    p.add_argument("--set-value", dest="set_value", type=int)
+    p.add_argument("--operator", dest="comparison_operator", choices=[">=", "<="])
+    p.add_argument("--engine", choices=["vectorized", "loop"])
+    p.add_argument("--regions", dest="regions_path", help="Regions (.regions or JSON) applied to every page")
+    p.add_argument("--edited-dir", dest="edited_dir", help="Edited crops named <key>.png (or .webp, .tif)")
+    p.add_argument("--per-page", dest="per_page", action="store_true", help="Edited crops are in EDITED_DIR/<page name>/")
+    p.add_argument("--output-dir", dest="output_dir", help="Also save the finished pages here (PNG, or the encoder's format)")
+    p.add_argument("--mode", choices=["auto", "lossless", "jpeg", "passthrough"])
+    p.add_argument("--quality", type=int, help="JPEG quality for --mode jpeg (default: 95)")
+    p.add_argument("--workers", type=int, help="Pages processed at once (default: CPU count)")
+    p.add_argument("--encoder", help=ENCODER_HELP + "; also sets the PDF's zlib level")
+
+    p = subparsers.add_parser("watch", help="Keep filtering images as they arrive in a directory")
+    p.add_argument("input_dir")
+    p.add_argument("output_dir")
+    p.add_argument("--profiles", dest="profiles_path", help="JSON/YAML file of named parameter profiles")
+    p.add_argument("--profile", help="Profile to use; options below override it")
+    p.add_argument("--save-profile", dest="save_profile", metavar="NAME", help="Save the resulting parameters under NAME")
+    p.add_argument("--kernel-size", dest="kernel_size", type=int)
+    p.add_argument("--percentage", type=int)
+    p.add_argument("--compare-value", dest="compare_value", type=int)
+    p.add_argument("--set-value", dest="set_value", type=int)
+    p.add_argument("--operator", dest="comparison_operator", choices=[">=", "<="])
+    p.add_argument("--engine", choices=["vectorized", "loop"])
+    p.add_argument("--strip-height", dest="strip_height", type=int, help="Process each image in strips of this many rows")
+    p.add_argument("--encoder", help=ENCODER_HELP)
+    p.add_argument("--workers", type=int, help="Worker processes (default: CPU count)")
+    p.add_argument("--poll-interval", dest="poll_interval", type=float, help="Seconds between directory scans (default: 0.5)")
+    p.add_argument("--settle", type=float, help="Seconds a file must stay unchanged before it is processed (default: 1)")
+
+    p = subparsers.add_parser("tiles", help="Convert an image to a tile cache for fast region reads")
+    p.add_argument("image_path")
+    p.add_argument("tiles_path", nargs="?", help="Default: IMAGE_PATH.tiles, which crop and paste pick up automatically")
+    p.add_argument("--tile-size", dest="tile_size", type=int, help="Tile edge in pixels (default: 256)")
+
+    p = subparsers.add_parser("regions", help="Convert coordinates between JSON and the .regions format")
+    p.add_argument("src_path")
+    p.add_argument("dst_path", help="Ends in .json for JSON, anything else for the .regions format")
+
+    p = subparsers.add_parser("run", help="Run a JSON/YAML job file")
+    p.add_argument("job_path")
+    p.add_argument("--parallel", type=int, default=1, help="Run up to this many jobs at once")
+
+    return parser
+
+
+def main(argv=None):
+    args = vars(build_parser().parse_args(argv))
+    command = args.pop("command")
+    metrics_jsonl = args.pop("metrics_jsonl")
+    metrics_prom = args.pop("metrics_prom")
+    if metrics_jsonl or metrics_prom:
+        instrument.enable(metrics_jsonl)
+
+    # Helpers raise ValueError for bad options, so a job file reports them per job instead of exiting
+    try:
+        if command == "run":
+            ok = run_jobs(args["job_path"], args["parallel"])
+        else:
+            ok = OPERATIONS[command](args)
+    except ValueError as e:
+        raise SystemExit(f"Error: {e}")
+
+    if metrics_prom:
+        instrument.write_prometheus(metrics_prom)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
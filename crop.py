@@ -1,59 +1,152 @@
-import cv2
-import json
+import numpy as np
 import os
-import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+import encoders
+import instrument
+import image_cache
+import roi
+from manifest import crop_entry, source_info, write_manifest
+from regions import as_region_store, load_regions
 
-def crop_images_by_json(image_path, json_path, output_dir):
-    # Load image
-    image = cv2.imread(image_path)
+# Regions handed to a worker at a time; small enough to balance load, large enough to keep scheduling cheap
+BATCH_SIZE = 64
+
+
+def crop_profile(encoder=encoders.DEFAULT_PROFILE, png_compression=None):
+    # Encoder settings for crops: PNG unless the profile picks another format; png_compression
+    # overrides the profile's zlib level
+    settings = dict(encoders.get_profile(encoder))
+    if settings["format"] == "auto":
+        settings["format"] = "png"
+    if png_compression is not None and settings["format"] == "png":
+        settings["level"] = int(png_compression)
+    return settings
+
+
+# Writes each region of image to output_dir/<key>.png (or the encoder profile's extension) on a thread
+# pool. Workers are threads, so they all slice the same array without copying; image may also be a roi
+# reader, which reads each region from the file on demand. regions is a RegionStore or a coordinates
+# dict; each worker reads only its own slice of the region columns. progress(done) is called from the
+# calling thread. cancel is an optional threading.Event; once set, the workers stop before their next
+# region. The crops written are listed in a manifest (see manifest.py) so paste can skip the ones left
+# unedited; source_path is the file image was decoded from, if any.
+def export_crops(image, regions, output_dir, workers=None, png_compression=None, batch_size=BATCH_SIZE, progress=None, cancel=None,
+                 source_path=None, encoder=encoders.DEFAULT_PROFILE):
+    os.makedirs(output_dir, exist_ok=True)
+
+    regions = as_region_store(regions)
+    settings = crop_profile(encoder, png_compression)
+    extension = encoders.EXTENSIONS[settings["format"]]
+    workers = workers or os.cpu_count() or 1
+    source = source_info(source_path) if source_path else None
+    encoded = encoders.EncodeStats(encoder)
+
+    def crop_worker(batch):
+        start, stop = batch
+        failed = []
+        entries = {}
+        for index, (x, y, w, h) in enumerate(zip(*regions.columns[:, start:stop].tolist()), start):
+            if cancel is not None and cancel.is_set():
+                break
+            key = regions.key(index)
+            try:
+                # Crop region (a view into the shared image, or read from the file)
+                cropped = image[y:y+h, x:x+w] if isinstance(image, np.ndarray) else image.read_bgr(x, y, w, h)
+                if cropped.size == 0:
+                    raise ValueError("region is empty or outside the image")
+
+                # Encode in memory (the encoders release the GIL), so the bytes can be hashed without reading them back
+                crop_path = os.path.join(output_dir, key + extension)
+                encode_start = time.perf_counter()
+                with instrument.span("encode", op="crop"):
+                    data = encoders.encode(cropped, settings, extension)
+                encoded.add(len(data), time.perf_counter() - encode_start)
+                encoders.write_file(crop_path, data)
+                entries[key] = crop_entry(crop_path, (x, y, w, h), data)
+                instrument.count("regions", op="crop")
+                instrument.count("pixels", cropped.size, op="crop")
+                instrument.count("bytes", len(data), op="crop")
+            except Exception as e:
+                failed.append((key, str(e)))
+        return len(entries) + len(failed), entries, failed
+
+    batches = regions.batches(batch_size)
+    failures = []
+    crops = {}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(crop_worker, batch) for batch in batches]
+        for future in as_completed(futures):
+            done, entries, failed = future.result()
+            crops.update(entries)
+            failures.extend(failed)
+            if progress:
+                progress(done)
+    elapsed = time.perf_counter() - start
+
+    # Keep region order, so the manifest reads like the region file
+    write_manifest(output_dir, {key: crops[key] for key in regions.keys() if key in crops}, source)
+
+    return {
+        "regions": len(regions),
+        "written": len(crops),
+        "failed": len(failures),
+        "failures": failures,
+        "cancelled": cancel is not None and cancel.is_set(),
+        "seconds": elapsed,
+        "regions_per_s": len(regions) / elapsed if elapsed else 0.0,
+        "encoding": encoded.as_dict(),
+    }
+
+
+def load_crop_source(image_path, regions):
+    # What export_crops reads the regions from, cheapest first: a reader for a tile cache or an
+    # uncompressed image (only the regions are read), an earlier decode, or a decode of the rows the
+    # regions reach (PNG) or of the whole image; None if it can't be read
+    reader = roi.open_reader(image_path)
+    if reader is not None:
+        return reader
+    image = image_cache.shared.peek(image_path, "bgr")
+    if image is not None:
+        return image
+    if len(regions):
+        bottom = int((regions.columns[1].astype(np.int64) + regions.columns[3]).max())
+        image = roi.decode_rows(image_path, max(bottom, 0))
+        if image is not None:
+            return image
+    return image_cache.load(image_path, "bgr")
+
+
+def crop_images_by_json(image_path, json_path, output_dir, workers=None, png_compression=None, batch_size=BATCH_SIZE, progress=None, cancel=None,
+                        encoder=encoders.DEFAULT_PROFILE):
+    # Region file (memory-mapped) or coordinates JSON, unless already loaded
+    regions = load_regions(json_path) if isinstance(json_path, str) else as_region_store(json_path)
+
+    # Load image once (or reuse an earlier decode, or map the file) and share it between the workers
+    with instrument.span("decode", op="crop"):
+        image = load_crop_source(image_path, regions)
     if image is None:
         print(f"Error: Could not read image {image_path}")
         return
 
-    # Load JSON
-    with open(json_path, 'r') as f:
-        crop_data = json.load(f)
+    def on_progress(done):
+        pbar.update(done)
+        if progress:
+            progress(done)
 
-    # Create output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
+    with tqdm(total=len(regions), desc="Cropping", unit="region") as pbar:
+        summary = export_crops(image, regions, output_dir, workers, png_compression, batch_size, on_progress, cancel,
+                               source_path=image_path, encoder=encoder)
 
-    # Convert keys to list and divide into chunks
-    keys = list(crop_data.keys())
-    num_threads = 2
-    chunk_size = len(keys) // num_threads
-    chunks = [keys[i*chunk_size:(i+1)*chunk_size] for i in range(num_threads)]
-
-    # Add leftover keys to the last thread if any
-    if len(keys) % num_threads != 0:
-        chunks[-1].extend(keys[num_threads * chunk_size:])
-
-    def crop_worker(thread_keys, thread_id):
-        for key in tqdm(thread_keys, desc=f"Thread {thread_id}", position=thread_id):
-            coords = crop_data[key]
-            x = coords['x']
-            y = coords['y']
-            w = coords['width']
-            h = coords['height']
-
-            # Crop region
-            cropped = image[y:y+h, x:x+w]
-
-            # Save cropped image
-            crop_filename = f"{key}.png"
-            crop_path = os.path.join(output_dir, crop_filename)
-            cv2.imwrite(crop_path, cropped)
-
-    # Start threads
-    threads = []
-    for i in range(num_threads):
-        t = threading.Thread(target=crop_worker, args=(chunks[i], i))
-        threads.append(t)
-        t.start()
-
-    # Wait for threads to finish
-    for t in threads:
-        t.join()
-
-    print("Cropping completed.")
+    for key, error in summary["failures"]:
+        print(f"Error on region {key}: {error}")
 
+    if summary["cancelled"]:
+        print("Cropping cancelled")
+    print(f"Cropping completed: {summary['written']}/{summary['regions']} regions "
+          f"in {summary['seconds']:.2f}s ({summary['regions_per_s']:.1f} regions/s), {summary['failed']} failed.")
+    print(encoders.describe(summary["encoding"]))
+    return summary
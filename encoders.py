@@ -0,0 +1,664 @@
+# encoders.py
+# Output encoding shared by every writer (filter, crop, paste, pipeline, watch, PDF). A profile picks
+# the format and how hard to compress, trading CPU time for disk space:
+#
+#   default            format from the file extension with the encoder's defaults (the behaviour before profiles)
+#   fast               PNG, zlib level 1 with the RLE strategy: quickest lossless PNG, good on thresholded scans
+#   small              PNG, zlib level 9, trying several strategies and keeping the smallest file (RLE
+#                      wins on flat scans, the default strategy on photographic content); several times slower
+#   webp               lossless WebP. WebP has no gray format: gray images are stored as RGB, so they read
+#                      back with three equal channels unless read as gray (cv2.IMREAD_GRAYSCALE, convert("L"))
+#   lossless-archival  tiled TIFF (256x256 tiles, Deflate level 9 with horizontal prediction); the tiles
+#                      can be read one at a time (roi.open_reader), so big masters stay cheap to crop.
+#                      Alpha is not stored (lossless only while it is opaque): cv2 premultiplies unassociated
+#                      alpha when reading 8-bit TIFF and PIL un-premultiplies associated alpha, so no TIFF
+#                      alpha reads back the same colours in both. Use png or webp to keep transparency.
+#
+#   nbytes, seconds = write_image(path, pixels, "fast", op="crop")
+#
+# StripWriter writes an image a band of rows at a time for the striped filter, so the whole result never
+# has to be in memory: PNG, TIFF (tiled Deflate, also for "default" .tif outputs) and BMP are written as
+# the rows arrive. WebP, JPEG and the other formats cv2 writes can only be encoded whole; their rows are
+# collected in a temporary file first.
+#
+# Profiles with a fixed format change the file extension (encoders.output_path). The Deflate level of
+# a profile also applies to the Flate streams of PDF pages. Every encode is timed and counted with
+# instrument, and EncodeStats sums time and bytes for a job's report.
+
+import io
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import instrument
+
+DEFAULT_PROFILE = "default"
+# zlib level for PDF Flate streams when the profile doesn't set one
+DEFAULT_DEFLATE_LEVEL = 6
+TIFF_TILE = 256
+
+PROFILES = {
+    "default": {"format": "auto"},
+    "fast": {"format": "png", "level": 1, "strategy": "rle"},
+    "small": {"format": "png", "level": 9, "strategy": ("default", "filtered", "rle")},
+    "webp": {"format": "webp"},
+    "lossless-archival": {"format": "tiff", "level": 9, "tile": TIFF_TILE},
+}
+
+EXTENSIONS = {"png": ".png", "webp": ".webp", "tiff": ".tif"}
+# Extensions an edited crop may have, in the order paste looks for them
+CROP_EXTENSIONS = (".png", ".webp", ".tif", ".tiff")
+
+PNG_STRATEGIES = {
+    "default": cv2.IMWRITE_PNG_STRATEGY_DEFAULT,
+    "filtered": cv2.IMWRITE_PNG_STRATEGY_FILTERED,
+    "huffman": cv2.IMWRITE_PNG_STRATEGY_HUFFMAN_ONLY,
+    "rle": cv2.IMWRITE_PNG_STRATEGY_RLE,
+    "fixed": cv2.IMWRITE_PNG_STRATEGY_FIXED,
+}
+# The same strategies for the PNGs StripWriter compresses itself
+ZLIB_STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}  # gray, gray + alpha, RGB, RGBA
+PNG_CHUNK_SIZE = 256 * 1024
+
+
+def register_profile(name, **settings):
+    # e.g. register_profile("png6", format="png", level=6)
+    if settings.get("format") not in ("auto",) + tuple(EXTENSIONS):
+        raise ValueError(f"Unknown format {settings.get('format')!r}")
+    PROFILES[name] = settings
+
+
+def get_profile(profile):
+    # A profile name, or a settings dict used as is
+    if isinstance(profile, dict):
+        return profile
+    try:
+        return PROFILES[profile or DEFAULT_PROFILE]
+    except KeyError:
+        raise ValueError(f"Unknown encoder profile {profile!r}, expected one of {sorted(PROFILES)}")
+
+
+def output_path(path, profile=DEFAULT_PROFILE):
+    # path with the extension the profile writes
+    fmt = get_profile(profile)["format"]
+    if fmt == "auto":
+        return path
+    return os.path.splitext(path)[0] + EXTENSIONS[fmt]
+
+
+def find_crop(folder, key):
+    # Path of the crop for key in folder, whichever profile wrote it; None if there is none
+    stem = os.path.join(folder, key)
+    for extension in CROP_EXTENSIONS:
+        if os.path.exists(stem + extension):
+            return stem + extension
+    return None
+
+
+def deflate_level(profile=DEFAULT_PROFILE):
+    return get_profile(profile).get("level", DEFAULT_DEFLATE_LEVEL)
+
+
+def _to_bgr_order(pixels):
+    # PIL channel order (L, RGB, RGBA) to OpenCV's
+    if pixels.ndim == 3 and pixels.shape[2] == 3:
+        return cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR)
+    if pixels.ndim == 3 and pixels.shape[2] == 4:
+        return cv2.cvtColor(pixels, cv2.COLOR_RGBA2BGRA)
+    return pixels
+
+
+def _to_rgb_order(pixels):
+    if pixels.ndim == 3 and pixels.shape[2] == 3:
+        return cv2.cvtColor(pixels, cv2.COLOR_BGR2RGB)
+    if pixels.ndim == 3 and pixels.shape[2] == 4:
+        return cv2.cvtColor(pixels, cv2.COLOR_BGRA2RGBA)
+    return pixels
+
+
+def _tiff_tile(tile, level, predict):
+    if predict:
+        # Horizontal differencing per row and channel, restarting at each tile's left edge
+        tile = tile.copy()
+        tile[:, 1:] -= tile[:, :-1].copy()
+    return zlib.compress(tile.tobytes(), level)
+
+
+def _without_alpha(pixels):
+    # What the TIFF profile stores (see PROFILES)
+    return pixels[..., :3] if pixels.ndim == 3 and pixels.shape[2] == 4 else pixels
+
+
+class _TiffStream:
+    # Tiled, Deflate-compressed baseline TIFF written to the file object f as bands of rows arrive
+    # (8-bit gray or RGB). The tiles of each band are compressed on a thread pool; zlib releases the GIL.
+    def __init__(self, f, width, height, channels, level=9, tile_size=TIFF_TILE, predict=True, workers=None):
+        if channels not in (1, 3):
+            raise ValueError(f"Cannot write {channels}-channel images as TIFF")
+        self.f = f
+        self.width, self.height, self.channels = width, height, channels
+        self.level, self.predict, self.workers = level, predict, workers
+        # Images smaller than a tile (most crops) get a smaller one; tile edges must be multiples of 16
+        self.tile_size = min(tile_size, max(16, -(-max(height, width) // 16) * 16))
+        self.cols = -(-width // self.tile_size)
+        self.partial = np.zeros((self.tile_size, width, channels), dtype=np.uint8)  # rows of an unfinished band
+        self.filled = 0
+        self.rows = 0
+        self.offsets = []
+        self.counts = []
+        # The IFD goes last; finish() fills in its offset
+        f.write(struct.pack("<2sHI", b"II", 42, 0))
+        self.position = 8
+
+    def write(self, rows):
+        if rows.dtype != np.uint8:
+            raise ValueError("Only 8-bit images can be written as TIFF")
+        if rows.ndim == 2:
+            rows = rows[..., None]
+        size = self.tile_size
+        self.rows += rows.shape[0]
+        bands = []
+        if self.filled:
+            take = min(size - self.filled, rows.shape[0])
+            self.partial[self.filled:self.filled + take] = rows[:take]
+            self.filled += take
+            rows = rows[take:]
+            if self.filled == size:
+                bands.append(self.partial)
+                self.filled = 0
+        while rows.shape[0] >= size:
+            bands.append(rows[:size])
+            rows = rows[size:]
+        if self.rows == self.height and rows.shape[0]:
+            bands.append(rows)  # the bottom band; _compress() pads it
+            rows = rows[:0]
+        self._compress(bands)
+        if rows.shape[0]:
+            self.partial[:rows.shape[0]] = rows
+            self.filled = rows.shape[0]
+        elif self.rows == self.height and self.filled:
+            self._compress([self.partial[:self.filled]])
+            self.filled = 0
+
+    def _compress(self, bands):
+        size = self.tile_size
+
+        def compress(index):
+            band, col = bands[index // self.cols], index % self.cols
+            block = band[:, col * size:(col + 1) * size]
+            tile = np.zeros((size, size, self.channels), dtype=np.uint8)  # edge tiles are padded
+            tile[:block.shape[0], :block.shape[1]] = block
+            return _tiff_tile(tile, self.level, self.predict)
+
+        count = len(bands) * self.cols
+        if count <= 1:
+            tiles = [compress(0)] if count else []  # a crop; the callers already run crops in parallel
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers or os.cpu_count() or 1) as executor:
+                tiles = list(executor.map(compress, range(count)))
+        for data in tiles:
+            self.offsets.append(self.position)
+            self.counts.append(len(data))
+            self.f.write(data)
+            self.position += len(data)
+            if len(data) & 1:
+                self.f.write(b"\0")  # keep word alignment
+                self.position += 1
+
+    def finish(self):
+        if self.rows != self.height:
+            raise ValueError(f"Got {self.rows} rows for a {self.height}-row TIFF")
+        # After the tile data: the values too big for an IFD entry, then the IFD
+        extra = bytearray()
+        extra_at = self.position
+
+        def external(fmt, values):
+            nonlocal extra
+            at = extra_at + len(extra)
+            extra += struct.pack(f"<{len(values)}{fmt}", *values)
+            if len(extra) & 1:
+                extra += b"\0"
+            return at
+
+        channels = self.channels
+        SHORT, LONG = 3, 4
+        entries = [
+            (256, LONG, 1, self.width),
+            (257, LONG, 1, self.height),
+            (258, SHORT, channels, [8] * channels),
+            (259, SHORT, 1, 8),                           # Deflate
+            (262, SHORT, 1, 1 if channels == 1 else 2),   # BlackIsZero or RGB
+            (277, SHORT, 1, channels),
+            (284, SHORT, 1, 1),                           # chunky
+            (317, SHORT, 1, 2 if self.predict else 1),
+            (322, LONG, 1, self.tile_size),
+            (323, LONG, 1, self.tile_size),
+            (324, LONG, len(self.offsets), self.offsets),
+            (325, LONG, len(self.counts), self.counts),
+        ]
+
+        packed_entries = []
+        for tag, kind, count, value in entries:
+            fmt = "H" if kind == SHORT else "I"
+            values = value if isinstance(value, list) else [value]
+            if count * (2 if kind == SHORT else 4) <= 4:
+                field = struct.pack(f"<{count}{fmt}", *values).ljust(4, b"\0")
+            else:
+                field = struct.pack("<I", external(fmt, values))
+            packed_entries.append(struct.pack("<HHI", tag, kind, count) + field)
+
+        ifd_at = extra_at + len(extra)
+        if ifd_at + 6 + 12 * len(packed_entries) > 0xFFFFFFFF:
+            raise ValueError("Image too large for a classic TIFF file")
+        self.f.write(bytes(extra))
+        self.f.write(struct.pack("<H", len(packed_entries)) + b"".join(packed_entries) + struct.pack("<I", 0))
+        self.f.seek(4)
+        self.f.write(struct.pack("<I", ifd_at))
+        self.f.seek(0, os.SEEK_END)
+
+
+def encode_tiff(pixels, level=9, tile_size=TIFF_TILE, predict=True, workers=None):
+    # Tiled, Deflate-compressed baseline TIFF from an 8-bit gray or RGB array
+    if pixels.dtype != np.uint8:
+        raise ValueError("Only 8-bit images can be written as TIFF")
+    height, width = pixels.shape[:2]
+    out = io.BytesIO()
+    stream = _TiffStream(out, width, height, pixels.shape[2] if pixels.ndim == 3 else 1, level, tile_size,
+                         predict, workers)
+    stream.write(pixels)
+    stream.finish()
+    return out.getvalue()
+
+
+def encode(pixels, profile=DEFAULT_PROFILE, extension=".png", order="bgr"):
+    # Encoded file bytes. pixels are in OpenCV channel order (order="bgr": gray, BGR, BGRA) or PIL's
+    # (order="rgb": L, RGB, RGBA); extension picks the format for the "auto" profiles.
+    settings = get_profile(profile)
+    fmt = settings["format"]
+    if fmt == "tiff":
+        rgb = _without_alpha(_to_rgb_order(pixels) if order == "bgr" else pixels)
+        return encode_tiff(np.ascontiguousarray(rgb), settings.get("level", 9), settings.get("tile", TIFF_TILE),
+                           settings.get("predict", True))
+
+    bgr = _to_bgr_order(pixels) if order == "rgb" else pixels
+    params = []
+    if fmt == "png":
+        extension = ".png"
+        if "level" in settings:
+            params += [cv2.IMWRITE_PNG_COMPRESSION, settings["level"]]
+        strategy = settings.get("strategy")
+        if isinstance(strategy, (list, tuple)):
+            # Several strategies: keep the smallest result
+            return min((_imencode(".png", bgr, params + [cv2.IMWRITE_PNG_STRATEGY, PNG_STRATEGIES[name]])
+                        for name in strategy), key=len)
+        if strategy:
+            params += [cv2.IMWRITE_PNG_STRATEGY, PNG_STRATEGIES[strategy]]
+    elif fmt == "webp":
+        extension = ".webp"
+        params += [cv2.IMWRITE_WEBP_QUALITY, 101]  # above 100 means lossless
+        if hasattr(cv2, "IMWRITE_WEBP_LOSSLESS_PRESERVE_COLOR"):
+            # Keep the colour of fully transparent pixels too (OpenCV 5); older versions may zero it
+            params += [cv2.IMWRITE_WEBP_LOSSLESS_MODE, cv2.IMWRITE_WEBP_LOSSLESS_PRESERVE_COLOR]
+    return _imencode(extension, bgr, params)
+
+
+def _imencode(extension, pixels, params):
+    ok, buffer = cv2.imencode(extension, pixels, params)
+    if not ok:
+        raise IOError(f"Could not encode image as {extension}")
+    return buffer.tobytes()
+
+
+def write_image(path, pixels, profile=DEFAULT_PROFILE, order="bgr", op=None):
+    # Encodes pixels to path (which should already carry output_path's extension) and returns
+    # (bytes written, seconds spent encoding)
+    start = time.perf_counter()
+    with instrument.span("encode", op=op):
+        data = encode(pixels, profile, os.path.splitext(path)[1] or ".png", order)
+    seconds = time.perf_counter() - start
+    write_file(path, data)
+    instrument.count("bytes", len(data), op=op)
+    return len(data), seconds
+
+
+def write_file(path, data):
+    # Written next to path and renamed into place, so an interrupted write never leaves a truncated
+    # file that the result cache, crop manifest or watch journal could take for a finished one
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+# Cost of a filtered byte in libpng's heuristic: its absolute value as a signed byte
+_PNG_FILTER_COST = np.minimum(np.arange(256), 256 - np.arange(256)).astype(np.uint8)
+
+
+def _png_filter(rows, previous, channels, adaptive):
+    # PNG scanlines for rows ((n, width * channels), PIL channel order): every row prefixed with its
+    # filter type. previous is the row above the first one (zeros at the top of the image). Without
+    # adaptive every row uses Sub, as cv2 does by default; with it each row gets the filter whose output
+    # has the smallest sum of absolute values, the heuristic libpng uses when a compression level is set.
+    # uint8 arithmetic wraps modulo 256, as the filters are defined.
+    out = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    left = np.zeros_like(rows)
+    left[:, channels:] = rows[:, :-channels]
+    if not adaptive:
+        out[:, 0] = 1
+        np.subtract(rows, left, out=out[:, 1:])
+        return out
+
+    up = np.concatenate([previous[None], rows[:-1]])
+    up_left = np.zeros_like(up)
+    up_left[:, channels:] = up[:, :-channels]
+    # Paeth predicts with whichever neighbour is closest to left + up - up_left
+    pa, pb = cv2.absdiff(up, up_left), cv2.absdiff(left, up_left)
+    pc = np.abs(left.astype(np.int16) + up - 2 * up_left.astype(np.int16))
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+    del pa, pb, pc
+    average = ((left.astype(np.uint16) + up) >> 1).astype(np.uint8)
+    # Filter types 0-4: None, Sub, Up, Average, Paeth
+    candidates = (rows, rows - left, rows - up, rows - average, rows - paeth)
+    costs = np.stack([cv2.reduce(cv2.LUT(candidate, _PNG_FILTER_COST), 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S)
+                      .reshape(-1) for candidate in candidates])
+    best = costs.argmin(axis=0)  # ties go to the lower type, like libpng
+    out[:, 0] = best
+    for kind, candidate in enumerate(candidates):
+        chosen = best == kind
+        out[chosen, 1:] = candidate[chosen]
+    return out
+
+
+class _PngStream:
+    # PNG compressed with zlib as the rows arrive. Several strategies (the "small" profile) each
+    # compress into their own temporary file and the smallest is kept.
+    order = "rgb"
+
+    def __init__(self, path, width, height, channels, level=None, strategy=None):
+        if channels not in PNG_COLOR_TYPES:
+            raise ValueError(f"Cannot write {channels}-channel images as PNG")
+        self.channels = channels
+        self.height = height
+        self.rows = 0
+        # Without a level, cv2's defaults: Sub filter, level 1, RLE
+        self.adaptive = level is not None
+        strategies = strategy if isinstance(strategy, (list, tuple)) else \
+            [strategy or ("default" if self.adaptive else "rle")]
+        level = 1 if level is None else level
+        self.previous = np.zeros(width * channels, dtype=np.uint8)
+        header = PNG_SIGNATURE + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8,
+                                                                  PNG_COLOR_TYPES[channels], 0, 0, 0))
+        self.outputs = []
+        # zlib releases the GIL, so the strategies compress side by side
+        self.executor = ThreadPoolExecutor(max_workers=len(strategies)) if len(strategies) > 1 else None
+        for name in strategies:
+            tmp_path = f"{path}.{name}.tmp" if len(strategies) > 1 else path + ".tmp"
+            f = open(tmp_path, "wb")
+            self.outputs.append([tmp_path, f, zlib.compressobj(level, zlib.DEFLATED, 15, 9, ZLIB_STRATEGIES[name]),
+                                 bytearray()])
+            f.write(header)
+
+    def _emit(self, output, data, final=False):
+        tmp_path, f, compressor, pending = output
+        pending += data
+        while len(pending) >= PNG_CHUNK_SIZE or (final and pending):
+            f.write(_png_chunk(b"IDAT", bytes(pending[:PNG_CHUNK_SIZE])))
+            del pending[:PNG_CHUNK_SIZE]
+
+    def write(self, rows):
+        if rows.dtype != np.uint8:
+            raise ValueError("Only 8-bit images can be written as PNG")
+        rows = rows.reshape(rows.shape[0], -1)
+        self.rows += rows.shape[0]
+        if not rows.shape[0]:
+            return
+        data = _png_filter(rows, self.previous, self.channels, self.adaptive).tobytes()
+        self.previous = rows[-1].copy()
+        if self.executor is None:
+            self._emit(self.outputs[0], self.outputs[0][2].compress(data))
+            return
+        compressed = list(self.executor.map(lambda output: output[2].compress(data), self.outputs))
+        for output, chunk in zip(self.outputs, compressed):
+            self._emit(output, chunk)
+
+    def finish(self):
+        if self.rows != self.height:
+            raise ValueError(f"Got {self.rows} rows for a {self.height}-row PNG")
+        if self.executor is not None:
+            self.executor.shutdown()
+        for output in self.outputs:
+            self._emit(output, output[2].flush(), final=True)
+            output[1].write(_png_chunk(b"IEND", b""))
+            output[1].close()
+        best = min((output[0] for output in self.outputs), key=os.path.getsize)
+        for output in self.outputs:
+            if output[0] != best:
+                os.remove(output[0])
+        return best
+
+    def abort(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        for output in self.outputs:
+            output[1].close()
+            if os.path.exists(output[0]):
+                os.remove(output[0])
+
+
+class _TiffFileStream:
+    order = "rgb"
+
+    def __init__(self, path, width, height, channels, settings, level=9):
+        self.tmp_path = path + ".tmp"
+        self.f = open(self.tmp_path, "wb")
+        self.stream = _TiffStream(self.f, width, height, channels, settings.get("level", level),
+                                  settings.get("tile", TIFF_TILE), settings.get("predict", True))
+
+    def write(self, rows):
+        self.stream.write(rows)
+
+    def finish(self):
+        self.stream.finish()
+        self.f.close()
+        return self.tmp_path
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class _BmpStream:
+    # Uncompressed BMP laid out like cv2 writes it: 8-bit with a gray palette, or 24-bit BGR. Rows are
+    # stored bottom-up, so each band is written at its place in a file of the final size.
+    order = "bgr"
+
+    def __init__(self, path, width, height, channels):
+        if channels not in (1, 3):
+            raise ValueError(f"Cannot write {channels}-channel images as BMP")
+        self.width, self.height, self.channels = width, height, channels
+        self.stride = (width * channels + 3) & ~3  # rows are padded to 4 bytes
+        palette = b""
+        if channels == 1:
+            palette = np.repeat(np.arange(256, dtype=np.uint8), 4).reshape(256, 4)
+            palette[:, 3] = 0
+            palette = palette.tobytes()
+        self.offset = 14 + 40 + len(palette)
+        size = self.offset + self.stride * height
+        if size > 0xFFFFFFFF:
+            raise ValueError("Image too large for a BMP file")
+        self.rows = 0
+        self.tmp_path = path + ".tmp"
+        self.f = open(self.tmp_path, "wb")
+        self.f.write(struct.pack("<2sIHHI", b"BM", size, 0, 0, self.offset))
+        self.f.write(struct.pack("<IiiHHIIiiII", 40, width, height, 1, 8 * channels, 0, 0, 0, 0, 0, 0))
+        self.f.write(palette)
+        self.f.truncate(size)
+
+    def write(self, rows):
+        count = rows.shape[0]
+        band = np.zeros((count, self.stride), dtype=np.uint8)
+        band[:, :self.width * self.channels] = rows.reshape(count, -1)
+        # The band's bottom row comes first in the file
+        self.f.seek(self.offset + (self.height - self.rows - count) * self.stride)
+        self.f.write(band[::-1].tobytes())
+        self.rows += count
+
+    def finish(self):
+        if self.rows != self.height:
+            raise ValueError(f"Got {self.rows} rows for a {self.height}-row BMP")
+        self.f.close()
+        return self.tmp_path
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class _Spool:
+    # Formats cv2 only encodes whole: the rows go to a memory-mapped temporary file next to the output
+    # and are encoded from there once the last one has arrived
+    def __init__(self, path, width, height, channels, profile, order):
+        self.path, self.profile, self.order = path, profile, order
+        fd, self.spool_path = tempfile.mkstemp(suffix=".raw", dir=os.path.dirname(path) or ".")
+        os.close(fd)
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        self.buffer = np.memmap(self.spool_path, dtype=np.uint8, mode="w+", shape=shape)
+        self.rows = 0
+
+    def write(self, rows):
+        self.buffer[self.rows:self.rows + rows.shape[0]] = rows.reshape((rows.shape[0],) + self.buffer.shape[1:])
+        self.rows += rows.shape[0]
+
+    def finish(self):
+        if self.rows != self.buffer.shape[0]:
+            raise ValueError(f"Got {self.rows} rows for a {self.buffer.shape[0]}-row image")
+        data = encode(self.buffer, self.profile, os.path.splitext(self.path)[1] or ".png", self.order)
+        self.abort()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        return tmp_path
+
+    def abort(self):
+        if self.buffer is not None:
+            self.buffer = None
+            os.remove(self.spool_path)
+
+
+class StripWriter:
+    # Writes an image to path from bands of rows given top to bottom (OpenCV channel order, or PIL's
+    # with order="rgb"); the file appears at path only once close() has succeeded
+    #
+    #   writer = StripWriter(path, width, height, 1, "fast", op="filter")
+    #   for rows in strips:
+    #       writer.write(rows)
+    #   nbytes, seconds = writer.close()
+    def __init__(self, path, width, height, channels=1, profile=DEFAULT_PROFILE, order="bgr", op=None):
+        settings = get_profile(profile)
+        fmt = settings["format"]
+        extension = os.path.splitext(path)[1].lower()
+        self.path, self.order, self.op = path, order, op
+        self.seconds = 0.0
+        self.drop_alpha = False
+        if fmt == "png" or (fmt == "auto" and extension == ".png"):
+            self._sink = _PngStream(path, width, height, channels, settings.get("level"), settings.get("strategy"))
+        elif fmt == "tiff":
+            self.drop_alpha = channels == 4
+            self._sink = _TiffFileStream(path, width, height, 3 if self.drop_alpha else channels, settings)
+        elif fmt == "auto" and extension in (".tif", ".tiff") and channels in (1, 3):
+            # cv2 would write LZW strips; this is the archival layout at the PDF streams' Deflate level
+            self._sink = _TiffFileStream(path, width, height, channels, settings, DEFAULT_DEFLATE_LEVEL)
+        elif fmt == "auto" and extension == ".bmp" and channels in (1, 3):
+            self._sink = _BmpStream(path, width, height, channels)
+        else:
+            self._sink = _Spool(path, width, height, channels, profile, order)
+
+    def write(self, rows):
+        start = time.perf_counter()
+        with instrument.span("encode", op=self.op):
+            if self._sink.order != self.order:
+                rows = _to_rgb_order(rows) if self.order == "bgr" else _to_bgr_order(rows)
+            if self.drop_alpha:
+                rows = _without_alpha(rows)
+            self._sink.write(rows)
+        self.seconds += time.perf_counter() - start
+
+    def close(self):
+        # Returns (bytes written, seconds spent encoding)
+        start = time.perf_counter()
+        try:
+            with instrument.span("encode", op=self.op):
+                tmp_path = self._sink.finish()
+        except BaseException:
+            self.abort()
+            raise
+        self.seconds += time.perf_counter() - start
+        os.replace(tmp_path, self.path)
+        nbytes = os.path.getsize(self.path)
+        instrument.count("bytes", nbytes, op=self.op)
+        return nbytes, self.seconds
+
+    def abort(self):
+        # Drops everything written so far
+        self._sink.abort()
+
+
+class EncodeStats:
+    # Thread-safe totals for a job's report
+    def __init__(self, profile=DEFAULT_PROFILE):
+        self.profile = profile if isinstance(profile, str) else "custom"
+        self.images = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes, seconds):
+        with self._lock:
+            self.images += 1
+            self.bytes += nbytes
+            self.seconds += seconds
+
+    def as_dict(self):
+        return {"profile": self.profile, "images": self.images, "bytes": self.bytes, "encode_seconds": self.seconds}
+
+    def summary(self):
+        return describe(self.as_dict())
+
+
+def _size(nbytes):
+    return f"{nbytes / 1024:.1f} KB" if nbytes < 1024 * 1024 else f"{nbytes / (1024 * 1024):.1f} MB"
+
+
+def describe(totals):
+    # One line for an EncodeStats.as_dict(), as printed at the end of a job
+    images, nbytes, seconds = totals["images"], totals["bytes"], totals["encode_seconds"]
+    if not images:
+        return f"Encoder {totals['profile']}: nothing encoded"
+    return (f"Encoder {totals['profile']}: {images} images, {_size(nbytes)} ({_size(nbytes / images)} each), "
+            f"{seconds:.2f}s encoding ({seconds / images * 1000:.1f} ms each)")
@@ -0,0 +1,195 @@
+# image_cache.py
+# Process-wide cache of decoded images, shared by the viewer, crop, paste and PDF code so moving
+# between operations on the same scan doesn't decode it again:
+#
+#   image = image_cache.load(path, "bgr")      # NumPy array, read-only
+#   pil_image = image_cache.as_pil(image)       # shares the array's pixels where PIL allows it
+#
+# Entries are keyed by absolute path, modification time, file size and pixel format, so an edited
+# file is decoded again. Arrays are marked read-only because every caller gets the same buffer;
+# take a copy before modifying one. Least recently used entries are dropped once the cache passes
+# its memory budget (IMAGE_CACHE_MB, default 1024); an image bigger than the budget is not cached.
+
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import instrument
+
+ENV_VAR = "IMAGE_CACHE_MB"
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# "unchanged", "gray" and "bgr" decode with OpenCV (BGR channel order, None when unreadable),
+# "L", "RGB" and "RGBA" with PIL (RGB order, raises when unreadable)
+CV2_FORMATS = {
+    "unchanged": cv2.IMREAD_UNCHANGED,
+    "gray": cv2.IMREAD_GRAYSCALE,
+    "bgr": cv2.IMREAD_COLOR,
+}
+PIL_FORMATS = ("L", "RGB", "RGBA")
+
+# Disable pixel limit to support large images
+Image.MAX_IMAGE_PIXELS = None
+
+
+def _decode(path, fmt):
+    if fmt in CV2_FORMATS:
+        return cv2.imread(path, CV2_FORMATS[fmt])
+    with Image.open(path) as img:
+        return np.asarray(img.convert(fmt))
+
+
+class DecodedImageCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  # key -> array
+        self._loading = {}           # key -> Event, so concurrent requests for one image decode it once
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path, fmt):
+        path = os.path.abspath(path)
+        info = os.stat(path)
+        return (path, info.st_mtime_ns, info.st_size, fmt)
+
+    def get(self, path, fmt="unchanged"):
+        if fmt not in CV2_FORMATS and fmt not in PIL_FORMATS:
+            raise ValueError(f"Unknown pixel format {fmt!r}")
+        try:
+            key = self._key(path, fmt)
+        except OSError:
+            return _decode(path, fmt)  # let the decoder report the missing file the usual way
+
+        while True:
+            with self._lock:
+                array = self._items.get(key)
+                if array is not None:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    instrument.count("image_cache_hits")
+                    return array
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            loading.wait()
+            with self._lock:
+                if key not in self._items:
+                    # The other decode failed or was too big to keep; decode here instead
+                    break
+
+        try:
+            array = _decode(path, fmt)
+            if array is not None:
+                array.setflags(write=False)
+                self._put(key, array)
+            return array
+        finally:
+            with self._lock:
+                event = self._loading.pop(key, None)
+            if event is not None:
+                event.set()
+
+    def peek(self, path, fmt="unchanged"):
+        # The cached decode, or None without decoding
+        try:
+            key = self._key(path, fmt)
+        except OSError:
+            return None
+        with self._lock:
+            array = self._items.get(key)
+            if array is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+            return array
+
+    def _put(self, key, array):
+        with self._lock:
+            self.misses += 1
+            if array.nbytes > self.max_bytes:
+                return
+            # Older versions of the same file can't be requested any more
+            for stale in [k for k in self._items if k[0] == key[0] and k[1:3] != key[1:3]]:
+                self.bytes -= self._items.pop(stale).nbytes
+            self._items[key] = array
+            self.bytes += array.nbytes
+            self._evict()
+
+    def _evict(self):
+        # Caller holds _lock. Evicted arrays stay valid for whoever still holds them.
+        while self.bytes > self.max_bytes and self._items:
+            _, evicted = self._items.popitem(last=False)
+            self.bytes -= evicted.nbytes
+
+    def set_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def discard(self, path):
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [k for k in self._items if k[0] == path]:
+                self.bytes -= self._items.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._items), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+def _budget_from_env():
+    value = os.environ.get(ENV_VAR)
+    if not value:
+        return DEFAULT_MAX_BYTES
+    try:
+        return int(float(value) * 1024 * 1024)
+    except ValueError:
+        print(f"Warning: ignoring invalid {ENV_VAR}={value!r}")
+        return DEFAULT_MAX_BYTES
+
+
+shared = DecodedImageCache(_budget_from_env())
+
+
+def load(path, fmt="unchanged"):
+    return shared.get(path, fmt)
+
+
+def as_pil(array):
+    # Expects PIL channel order ("L", "RGB", "RGBA" formats). Zero-copy for gray and 4-channel
+    # images; PIL has no 3-byte in-memory layout, so RGB is copied
+    height, width = array.shape[:2]
+    if array.ndim == 2 and array.dtype == np.uint8 and array.flags.c_contiguous:
+        return Image.frombuffer("L", (width, height), array, "raw", "L", 0, 1)
+    if array.ndim == 3 and array.shape[2] == 4 and array.dtype == np.uint8 and array.flags.c_contiguous:
+        return Image.frombuffer("RGBA", (width, height), array, "raw", "RGBA", 0, 1)
+    return Image.fromarray(array)
+
+
+def as_qimage(array, bgr=True):
+    # A QImage over the array's pixels (OpenCV channel order unless bgr=False). The QImage does not
+    # keep the array alive, so hold on to the array for as long as the QImage is used.
+    from PyQt5.QtGui import QImage
+
+    array = np.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    if array.ndim == 2:
+        fmt = QImage.Format_Grayscale8
+    elif array.shape[2] == 4:
+        fmt = QImage.Format_ARGB32 if bgr else QImage.Format_RGBA8888  # ARGB32 is BGRA in memory on little-endian
+    else:
+        fmt = QImage.Format_BGR888 if bgr else QImage.Format_RGB888
+    return QImage(array.data, width, height, array.strides[0], fmt)
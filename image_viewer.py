@@ -1,14 +1,19 @@
 # image_viewer.py
 
-from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsRectItem, QGraphicsTextItem
-from PyQt5.QtGui import QPixmap, QPen, QFont,QImage
-from PyQt5.QtCore import Qt, QRectF
-import os,json
+from PyQt5.QtWidgets import QGraphicsView, QGraphicsScene
+from PyQt5.QtCore import Qt, QRectF, QObject, pyqtSignal
+import os
 import threading
-from tqdm import tqdm
+from annotations import AnnotationStore, AnnotationItem
+# The image and crop modules pull in cv2 and NumPy; they are imported when first used so the window opens sooner
 
 
 class ImageViewer(QGraphicsView):
+    # Forwarded from every crop export started by crop_boxes
+    export_progress = pyqtSignal(int, int)
+    export_finished = pyqtSignal(dict)
+    export_failed = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
 
@@ -17,8 +22,12 @@ class ImageViewer(QGraphicsView):
         
         # Initialize variables
         self.image_item = None
-        self.rect_items = []
-        self.coord_labels_map = {}  # Map rect -> coord labels
+        self.annotations = AnnotationStore()
+        # One item paints every box, so thousands of boxes don't mean thousands of scene items
+        self.annotation_item = AnnotationItem(self.annotations)
+        self.scene.addItem(self.annotation_item)
+        self.drawing_box = None  # id of the box being dragged out
+        self.export_jobs = []  # crop exports still running, kept alive until they finish
         self.start_pos = None
         self.drawing_enabled = False
         self.erase_enabled = False
@@ -35,12 +44,18 @@ class ImageViewer(QGraphicsView):
 
     #Load and display an image
     def load_image(self, file_path):
-        pixmap = QPixmap(file_path)
+        # Tiles are decoded in the background at the resolution needed for the current zoom
+        from tiled_image import TiledImageItem
+
+        if self.image_item:
+            self.image_item.close()
+        self.scene.removeItem(self.annotation_item)
         self.scene.clear()
-        self.image_item = QGraphicsPixmapItem(pixmap)
+        self.image_item = TiledImageItem(file_path)
         self.scene.addItem(self.image_item)
-        self.rect_items.clear()
-        self.coord_labels_map.clear()
+        self.annotations.clear()
+        self.scene.addItem(self.annotation_item)
+        self.annotation_item.refresh()
         self.fitInView(self.image_item, Qt.KeepAspectRatio)
     #Enable or disable drawing mode
     def enable_drawing(self, enabled):
@@ -70,94 +85,132 @@ class ImageViewer(QGraphicsView):
 
        # If in erase mode and left mouse is clicked
        if self.erase_enabled and event.button() == Qt.LeftButton:
-        for rect in self.rect_items:
-            if rect.rect().contains(pos):
-                self.erase_box(rect)
-                self.toggle_erase_mode(False)  # ⬅️ Turn it off right after one erase
-                return
+        box_id = self.annotations.hit(pos.x(), pos.y())
+        if box_id is not None:
+            self.erase_box(box_id)
+            self.toggle_erase_mode(False)  # ⬅️ Turn it off right after one erase
+            return
 
        elif self.drawing_enabled and event.button() == Qt.LeftButton:
              self.start_pos = pos
-             rect_item = QGraphicsRectItem(QRectF(self.start_pos, self.start_pos))
-             rect_item.setPen(QPen(Qt.red, 2))
-             self.scene.addItem(rect_item)
-             self.rect_items.append(rect_item)
+             self.drawing_box = self.annotations.add(pos.x(), pos.y(), 0, 0)
+             self.annotation_item.refresh(QRectF(pos, pos))
 
        super().mousePressEvent(event)
 
 
     def mouseMoveEvent(self, event):
-        if self.drawing_enabled and self.start_pos:
+        if self.drawing_enabled and self.drawing_box is not None:
             current_pos = self.mapToScene(event.pos())
+            old_rect = self.annotations.boxes[self.drawing_box].rect()
             rect = QRectF(self.start_pos, current_pos).normalized()
-            self.rect_items[-1].setRect(rect)
+            self.annotations.update(self.drawing_box, rect.x(), rect.y(), rect.width(), rect.height())
+            self.annotation_item.refresh(old_rect.united(rect))
         super().mouseMoveEvent(event)
-    #Finish drawing and add coordinate labels
+    #Finish drawing; the coordinate labels are painted by the annotation item
     def mouseReleaseEvent(self, event):
-        if self.drawing_enabled and self.rect_items:
-            rect = self.rect_items[-1].rect()
-            font = QFont("Arial", 10)
-
-            top_left_label = QGraphicsTextItem(f"({rect.left():.0f}, {rect.top():.0f})")
-            top_left_label.setFont(font)
-            top_left_label.setDefaultTextColor(Qt.red)
-            top_left_label.setPos(rect.left() - 50, rect.top())
-
-            bottom_right_label = QGraphicsTextItem(f"({rect.right():.0f}, {rect.bottom():.0f})")
-            bottom_right_label.setFont(font)
-            bottom_right_label.setDefaultTextColor(Qt.red)
-            bottom_right_label.setPos(rect.right(), rect.bottom())
-            # Add labels to scene and map
-            self.scene.addItem(top_left_label)
-            self.scene.addItem(bottom_right_label)
-            self.coord_labels_map[self.rect_items[-1]] = [top_left_label, bottom_right_label]
-
         self.start_pos = None
+        self.drawing_box = None
         super().mouseReleaseEvent(event)
 
-    def erase_box(self, rect):
-        self.scene.removeItem(rect)
-        self.rect_items.remove(rect)
-        if rect in self.coord_labels_map:
-            for label in self.coord_labels_map[rect]:
-                self.scene.removeItem(label)
-            del self.coord_labels_map[rect]
+    def add_box(self, x, y, width, height):
+        box_id = self.annotations.add(x, y, width, height)
+        self.annotation_item.refresh(QRectF(x, y, width, height))
+        return box_id
+
+    def erase_box(self, box_id):
+        box = self.annotations.remove(box_id)
+        self.annotation_item.refresh(box.rect())
 
     #Crop all rectangles and save them as images with metadata
-    def crop_boxes(self):
+    def crop_boxes(self, output_dir=None, encoder="default"):
         if not self.image_item:
-            return
-    # Run cropping in a separate thread to prevent GUI freezing
-        thread = threading.Thread(target=self._crop_and_save)
-        thread.start()
-
-
-    def _crop_and_save(self):
-        original_pixmap = self.image_item.pixmap()
-        base_path = os.path.join(os.getcwd(), "crops")
-        os.makedirs(base_path, exist_ok=True)
-
-        metadata = {}
-
-        total = len(self.rect_items)
-
-        for idx, rect_item in enumerate(tqdm(self.rect_items, desc="Cropping", unit="crop", ncols=70), 1):
-            rect = rect_item.rect().toRect()
-            cropped = original_pixmap.copy(rect)
-
-            save_path = os.path.join(base_path, f"{idx}.png")
-            cropped.save(save_path)
-
-            metadata[str(idx)] = {
-                "x": rect.x(),
-                "y": rect.y(),
-                "width": rect.width(),
-                "height": rect.height()
-            }
-
-        metadata_path = os.path.join(base_path, "coordinates.json")
-        with open(metadata_path, "w") as f:
-            json.dump(metadata, f, indent=4)
-
-        print("\n Cropping complete. Saved to:", base_path)
-    
\ No newline at end of file
+            return None
+        # Runs in the background; several exports can be in flight at once
+        job = self.export_job(output_dir, encoder=encoder)
+        job.progress.connect(self.export_progress)
+        job.finished.connect(self.export_finished)
+        job.failed.connect(self.export_failed)
+        job.finished.connect(lambda summary, job=job: self.export_jobs.remove(job))
+        job.failed.connect(lambda message, job=job: self.export_jobs.remove(job))
+        self.export_jobs.append(job)
+        job.start()
+        return job
+
+    def export_job(self, output_dir=None, workers=None, png_compression=None, encoder="default"):
+        # Geometry is snapshotted here on the GUI thread, so later edits to the boxes don't affect the job;
+        # the worker thread only sees these tuples, rounded to whole pixels like QRectF.toRect
+        boxes = [QRectF(*box).toRect().getRect() for box in self.annotations.snapshot()]
+        output_dir = output_dir or os.path.join(os.getcwd(), "crops")
+        return CropExportJob(self.image_item.pyramid, boxes, output_dir, workers, png_compression, encoder)
+
+    def _crop_and_save(self, output_dir=None):
+        # Synchronous export, same output as crop_boxes
+        return self.export_job(output_dir).run()
+
+
+class CropExportJob(QObject):
+    progress = pyqtSignal(int, int)  # done, total
+    finished = pyqtSignal(dict)      # summary from crop.export_crops plus output_dir
+    failed = pyqtSignal(str)
+
+    def __init__(self, pyramid, boxes, output_dir, workers=None, png_compression=None, encoder="default"):
+        super().__init__()
+        self.pyramid = pyramid
+        self.boxes = boxes
+        self.output_dir = output_dir
+        self.workers = workers
+        self.png_compression = png_compression
+        self.encoder = encoder
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        import numpy as np
+        from crop import export_crops
+        from regions import RegionStore, write_regions
+
+        try:
+            # Full-resolution pixels: a NumPy array the crop workers share read-only, or level 0 read
+            # through a roi reader, which reads each region from the file
+            self.pyramid.wait()
+            if self.pyramid.error:
+                raise IOError(self.pyramid.error)
+            image = self.pyramid.levels[0]
+            height, width = image.shape[:2]
+
+            # Boxes are clipped to the image so the metadata matches the saved crops; regions are keyed "1".."n"
+            boxes = np.array(self.boxes, dtype=np.int64).reshape(-1, 4)
+            x0 = np.clip(boxes[:, 0], 0, None)
+            y0 = np.clip(boxes[:, 1], 0, None)
+            x1 = np.minimum(boxes[:, 0] + boxes[:, 2], width)
+            y1 = np.minimum(boxes[:, 1] + boxes[:, 3], height)
+            metadata = RegionStore.from_boxes(np.stack([x0, y0, np.maximum(x1 - x0, 0), np.maximum(y1 - y0, 0)], axis=1))
+
+            total = len(metadata)
+            done = [0]
+
+            def on_progress(count):
+                done[0] += count
+                self.progress.emit(done[0], total)
+
+            summary = export_crops(image, metadata, self.output_dir, self.workers, self.png_compression,
+                                   progress=on_progress, source_path=self.pyramid.file_path, encoder=self.encoder)
+
+            # Compact region file; `cli.py regions` converts it to the old coordinates JSON
+            write_regions(os.path.join(self.output_dir, "coordinates.regions"), metadata)
+        except Exception as e:
+            print(f"Error: crop export failed: {e}")
+            self.failed.emit(str(e))
+            return None
+
+        for key, error in summary["failures"]:
+            print(f"Error on region {key}: {error}")
+        print(f"Cropping complete: {summary['written']}/{summary['regions']} regions saved to {self.output_dir}")
+
+        summary["output_dir"] = self.output_dir
+        self.finished.emit(summary)
+        return summary
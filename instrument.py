@@ -0,0 +1,237 @@
+# instrument.py
+# Lightweight stage timing for the pipelines. Code wraps its stages in named spans
+# (decode, compute, composite, encode, write) and bumps counters (pixels, regions, bytes):
+#
+#   with instrument.span("decode", op="crop"):
+#       image = cv2.imread(path)
+#   instrument.count("pixels", image.size, op="crop")
+#
+# When disabled (the default) span() returns a shared no-op object and count() returns immediately.
+# When enabled, every span is appended to a JSON-lines file together with the process's peak RSS,
+# and totals can be written as a Prometheus text file. Setting IMAGE_METRICS_JSONL (which enable()
+# does) turns it on in worker processes too; they append to the same file.
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+ENV_VAR = "IMAGE_METRICS_JSONL"
+
+_enabled = False
+_lock = threading.Lock()
+_sink = None
+_buffer = []
+_spans = {}     # (name, op) -> [calls, seconds]
+_counters = {}  # (name, op) -> value
+_pending_counts = {}
+_peak_rss = 0
+
+
+def _rss_peak_bytes():
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'op', 'start')
+
+    def __init__(self, name, op):
+        self.name = name
+        self.op = op
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _record_span(self.name, self.op, time.perf_counter() - self.start)
+        return False
+
+
+def enabled():
+    return _enabled
+
+
+def enable(jsonl_path=None):
+    global _enabled, _sink
+    with _lock:
+        if jsonl_path:
+            os.environ[ENV_VAR] = os.path.abspath(jsonl_path)
+            if _sink is None or _sink.name != os.path.abspath(jsonl_path):
+                # Unbuffered append: each flush is a single write(), so lines from processes don't interleave
+                _sink = open(os.path.abspath(jsonl_path), "ab", buffering=0)
+        _enabled = True
+
+
+def disable():
+    global _enabled, _sink
+    flush()
+    with _lock:
+        _enabled = False
+        os.environ.pop(ENV_VAR, None)
+        if _sink is not None:
+            _sink.close()
+            _sink = None
+
+
+def span(name, op=None):
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, op)
+
+
+def count(name, value=1, op=None):
+    if not _enabled:
+        return
+    key = (name, op)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        _pending_counts[key] = _pending_counts.get(key, 0) + value
+
+
+def _record_span(name, op, seconds):
+    global _peak_rss
+    rss = _rss_peak_bytes()
+    with _lock:
+        stats = _spans.setdefault((name, op), [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        _peak_rss = max(_peak_rss, rss)
+        if _sink is not None:
+            _buffer.append({"ts": time.time(), "pid": os.getpid(), "type": "span", "name": name, "op": op,
+                            "seconds": seconds, "peak_rss_bytes": rss})
+            if len(_buffer) >= 256:
+                _write_buffer()
+
+
+def _write_buffer():
+    # Caller holds _lock
+    if _sink is None or not _buffer:
+        return
+    _sink.write("".join(json.dumps(event) + "\n" for event in _buffer).encode("utf-8"))
+    _buffer.clear()
+
+
+def flush():
+    # Writes buffered spans and counter deltas; call at the end of work in worker processes,
+    # which exit without running atexit handlers
+    with _lock:
+        if _sink is not None:
+            for (name, op), value in _pending_counts.items():
+                _buffer.append({"ts": time.time(), "pid": os.getpid(), "type": "counter", "name": name,
+                                "op": op, "value": value})
+        _pending_counts.clear()
+        _write_buffer()
+
+
+def snapshot():
+    # Totals recorded in this process
+    with _lock:
+        return {
+            "spans": {_label(k): {"calls": v[0], "seconds": v[1]} for k, v in _spans.items()},
+            "counters": {_label(k): v for k, v in _counters.items()},
+            "peak_rss_bytes": _peak_rss,
+        }
+
+
+def _label(key):
+    name, op = key
+    return f"{op}.{name}" if op else name
+
+
+def _aggregate_jsonl(path):
+    spans, counters, peak = {}, {}, {}
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            key = (event["name"], event.get("op"))
+            if event["type"] == "span":
+                stats = spans.setdefault(key, [0, 0.0])
+                stats[0] += 1
+                stats[1] += event["seconds"]
+                peak[event["pid"]] = max(peak.get(event["pid"], 0), event.get("peak_rss_bytes", 0))
+            elif event["type"] == "counter":
+                counters[key] = counters.get(key, 0) + event["value"]
+    return spans, counters, max(peak.values(), default=0)
+
+
+def write_prometheus(prom_path, jsonl_path=None):
+    # With a JSON-lines file the totals cover every process that appended to it, otherwise just this one
+    flush()
+    jsonl_path = jsonl_path or os.environ.get(ENV_VAR)
+    if jsonl_path and os.path.exists(jsonl_path):
+        spans, counters, peak = _aggregate_jsonl(jsonl_path)
+    else:
+        with _lock:
+            spans, counters, peak = dict(_spans), dict(_counters), _peak_rss
+
+    def labels(name_key, name, op):
+        return f'{{{name_key}="{name}",op="{op or ""}"}}'
+
+    lines = [
+        "# HELP image_stage_seconds_total Time spent in each pipeline stage.",
+        "# TYPE image_stage_seconds_total counter",
+    ]
+    lines += [f"image_stage_seconds_total{labels('stage', n, op)} {v[1]:.6f}" for (n, op), v in sorted(spans.items(), key=str)]
+    lines += [
+        "# HELP image_stage_calls_total Number of times each pipeline stage ran.",
+        "# TYPE image_stage_calls_total counter",
+    ]
+    lines += [f"image_stage_calls_total{labels('stage', n, op)} {v[0]}" for (n, op), v in sorted(spans.items(), key=str)]
+    lines += [
+        "# HELP image_processed_total Pixels, regions and bytes processed.",
+        "# TYPE image_processed_total counter",
+    ]
+    lines += [f"image_processed_total{labels('unit', n, op)} {v}" for (n, op), v in sorted(counters.items(), key=str)]
+    lines += [
+        "# HELP image_peak_rss_bytes Highest peak resident set size seen in any process.",
+        "# TYPE image_peak_rss_bytes gauge",
+        f"image_peak_rss_bytes {peak}",
+    ]
+
+    tmp_path = prom_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, prom_path)
+
+
+def _after_fork():
+    # A forked worker starts with its own empty totals; the parent's buffered events stay with the parent
+    global _lock
+    _lock = threading.Lock()
+    _buffer.clear()
+    _pending_counts.clear()
+    _spans.clear()
+    _counters.clear()
+
+
+atexit.register(flush)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR])
@@ -0,0 +1,252 @@
+# jobs.py
+# Background jobs for MainWindow. A job is a function fn(job) run on a QThreadPool thread. It reports
+# with job.progress(count) and job.set_total(total), and passes job.cancel_event (a threading.Event)
+# to the long loops in algo/crop/replace/pdf, which check it between items. JobManager
+# queues jobs and starts at most max_heavy heavy jobs at once (each heavy job already uses every
+# core); light jobs start straight away. JobPanel lists the jobs with progress, ETA and a cancel button.
+
+import threading
+import time
+
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QProgressBar, QPushButton, QScrollArea
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+MAX_HEAVY_JOBS = 1
+# Progress from the worker thread is batched so per-item callbacks don't flood the event loop
+PROGRESS_INTERVAL = 0.1
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+
+class Job(QObject):
+    changed = pyqtSignal()          # state, progress or total changed
+    finished = pyqtSignal(object)   # fn's return value
+    failed = pyqtSignal(str)
+    ended = pyqtSignal(object)      # the job, once it is done, failed or cancelled
+    _progress = pyqtSignal(int)     # from the worker thread
+    _ended = pyqtSignal(str, object)
+
+    def __init__(self, name, fn, total=0, heavy=True):
+        super().__init__()
+        self.name = name
+        self.fn = fn
+        self.total = total
+        self.heavy = heavy
+        self.done = 0
+        self.state = QUEUED
+        self.error = None
+        self.started_at = None
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_emit = 0.0
+        self._progress.connect(self._on_progress)
+        self._ended.connect(self._on_ended)
+
+    def progress(self, count=1):
+        # Thread-safe; called by fn from the worker thread
+        with self._lock:
+            self._pending += count
+            now = time.monotonic()
+            if now - self._last_emit < PROGRESS_INTERVAL:
+                return
+            self._last_emit = now
+            count, self._pending = self._pending, 0
+        self._progress.emit(count)
+
+    def _flush_progress(self):
+        with self._lock:
+            count, self._pending = self._pending, 0
+        if count:
+            self._progress.emit(count)
+
+    def set_total(self, total):
+        # Thread-safe like progress()
+        self.total = total
+        self.changed.emit()
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.changed.emit()
+
+    def eta(self):
+        # Seconds left, from the average rate so far; None until there is something to go on
+        if self.state != RUNNING or not self.done or not self.total:
+            return None
+        elapsed = time.monotonic() - self.started_at
+        return elapsed * (self.total - self.done) / self.done
+
+    def _on_progress(self, count):
+        self.done += count
+        self.changed.emit()
+
+    def _set_state(self, state):
+        self.state = state
+        self.changed.emit()
+
+    def _on_ended(self, state, value):
+        if state == FAILED:
+            self.error = value
+        self._set_state(state)
+        if state == FAILED:
+            self.failed.emit(value)
+        elif state == DONE:
+            self.finished.emit(value)
+        self.ended.emit(self)
+
+
+class _JobRunnable(QRunnable):
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+
+    def run(self):
+        job = self.job
+        try:
+            result = job.fn(job)
+        except Exception as e:
+            job._flush_progress()
+            job._ended.emit(FAILED, str(e))
+            return
+        job._flush_progress()
+        job._ended.emit(CANCELLED if job.cancel_event.is_set() else DONE, result)
+
+
+class JobManager(QObject):
+    job_added = pyqtSignal(object)
+
+    def __init__(self, max_heavy=MAX_HEAVY_JOBS, parent=None):
+        super().__init__(parent)
+        self.max_heavy = max_heavy
+        self.jobs = []
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max(QThreadPool.globalInstance().maxThreadCount(), max_heavy + 4))
+
+    def submit(self, name, fn, total=0, heavy=True):
+        job = Job(name, fn, total, heavy)
+        job.ended.connect(self._schedule)
+        self.jobs.append(job)
+        self.job_added.emit(job)
+        self._schedule()
+        return job
+
+    def cancel(self, job):
+        job.cancel()
+        if job.state == QUEUED:
+            job._set_state(CANCELLED)
+
+    def cancel_all(self):
+        for job in list(self.jobs):
+            if job.state in (QUEUED, RUNNING):
+                self.cancel(job)
+
+    def running(self):
+        return [job for job in self.jobs if job.state == RUNNING]
+
+    def clear_finished(self):
+        self.jobs = [job for job in self.jobs if job.state in (QUEUED, RUNNING)]
+
+    def _schedule(self, *args):
+        heavy_running = sum(1 for job in self.running() if job.heavy)
+        for job in self.jobs:
+            if job.state != QUEUED:
+                continue
+            if job.heavy:
+                if heavy_running >= self.max_heavy:
+                    continue
+                heavy_running += 1
+            job.started_at = time.monotonic()
+            job._set_state(RUNNING)
+            self.pool.start(_JobRunnable(job))
+
+
+def _format_eta(seconds):
+    if seconds is None:
+        return ""
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    return f"{minutes}m {seconds:02d}s left" if minutes else f"{seconds}s left"
+
+
+class _JobRow(QWidget):
+    def __init__(self, job, manager, parent=None):
+        super().__init__(parent)
+        self.job = job
+        layout = QHBoxLayout()
+        layout.setContentsMargins(2, 2, 2, 2)
+        self.name_label = QLabel(job.name, self)
+        self.name_label.setFixedWidth(160)
+        self.name_label.setToolTip(job.name)
+        self.bar = QProgressBar(self)
+        self.status_label = QLabel(self)
+        self.status_label.setMinimumWidth(110)
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.clicked.connect(lambda: manager.cancel(job))
+        for widget in [self.name_label, self.bar, self.status_label, self.cancel_button]:
+            layout.addWidget(widget)
+        self.setLayout(layout)
+        job.changed.connect(self.refresh)
+        self.refresh()
+
+    def refresh(self):
+        job = self.job
+        if job.total:
+            self.bar.setRange(0, job.total)
+            self.bar.setValue(min(job.done, job.total))
+        else:
+            # Unknown amount of work: busy indicator while running
+            self.bar.setRange(0, 0 if job.state == RUNNING else 1)
+            self.bar.setValue(1 if job.state == DONE else 0)
+        if job.state == RUNNING:
+            text = "cancelling" if job.cancel_event.is_set() else _format_eta(job.eta()) or RUNNING
+        elif job.state == FAILED:
+            text = f"failed: {job.error}"
+        elif job.state == CANCELLED and job.total and job.started_at is not None:
+            text = f"cancelled at {job.done}/{job.total}"
+        else:
+            text = job.state
+        self.status_label.setText(text)
+        self.status_label.setToolTip(text)
+        self.cancel_button.setEnabled(job.state in (QUEUED, RUNNING))
+
+
+class JobPanel(QWidget):
+    def __init__(self, manager, parent=None):
+        super().__init__(parent)
+        self.manager = manager
+        self.rows = []
+
+        self.rows_widget = QWidget(self)
+        self.rows_layout = QVBoxLayout()
+        self.rows_layout.addStretch(1)
+        self.rows_widget.setLayout(self.rows_layout)
+        scroll = QScrollArea(self)
+        scroll.setWidgetResizable(True)
+        scroll.setWidget(self.rows_widget)
+
+        buttons = QHBoxLayout()
+        self.clear_button = QPushButton("Clear finished", self)
+        self.clear_button.clicked.connect(self.clear_finished)
+        self.cancel_all_button = QPushButton("Cancel all", self)
+        self.cancel_all_button.clicked.connect(manager.cancel_all)
+        buttons.addWidget(self.clear_button)
+        buttons.addWidget(self.cancel_all_button)
+
+        layout = QVBoxLayout()
+        layout.addWidget(scroll)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+
+        manager.job_added.connect(self.add_row)
+
+    def add_row(self, job):
+        row = _JobRow(job, self.manager, self.rows_widget)
+        self.rows.append(row)
+        self.rows_layout.insertWidget(self.rows_layout.count() - 1, row)
+
+    def clear_finished(self):
+        self.manager.clear_finished()
+        for row in list(self.rows):
+            if row.job not in self.manager.jobs:
+                self.rows.remove(row)
+                row.setParent(None)
+                row.deleteLater()
@@ -1,13 +1,12 @@
-from PyQt5.QtWidgets import QMainWindow, QToolBar, QAction, QPushButton, QVBoxLayout,QHBoxLayout, QWidget, QFileDialog, QLineEdit, QLabel, QFormLayout, QDialog, QDialogButtonBox,QInputDialog,QComboBox  
+from PyQt5.QtWidgets import QMainWindow, QToolBar, QAction, QPushButton, QVBoxLayout,QHBoxLayout, QWidget, QFileDialog, QLineEdit, QLabel, QFormLayout, QDialog, QDialogButtonBox,QInputDialog,QComboBox,QCheckBox,QDockWidget
 from image_viewer import ImageViewer
 from PyQt5.QtCore import Qt
-from reportlab.pdfgen import canvas
 import os
-from PIL import Image  # Add this import at the top of your file
-from algo import process_images_in_directory
-from replace import paste_edited_crops_dialog
-from crop import crop_images_by_json
-from pdf import png_to_pdf
+import operations
+from jobs import JobManager, JobPanel
+
+# Names of encoders.PROFILES; listed here so opening the window doesn't import cv2
+ENCODER_PROFILES = ("default", "fast", "small", "webp", "lossless-archival")
 
 
 class MainWindow(QMainWindow):
@@ -33,7 +32,7 @@ class MainWindow(QMainWindow):
         
         # Connect buttons
         self.open_button.clicked.connect(self.open_image)
-        self.crop_button.clicked.connect(self.viewer.crop_boxes)
+        self.crop_button.clicked.connect(self.crop_boxes_dialog)
         self.processing_settings_button.clicked.connect(self.open_processing_dialog)
         
         # Second horizontal button row
@@ -46,7 +45,7 @@ class MainWindow(QMainWindow):
             bottom_button_layout.addWidget(btn)
         
         # Connect buttons
-        self.paste_button.clicked.connect(lambda: paste_edited_crops_dialog(self))
+        self.paste_button.clicked.connect(self.paste_dialog)
         self.cp_button.clicked.connect(self.crop_by_json_dialog)
         self.pdf_button.clicked.connect(self.open_pdf_dialog)
         
@@ -58,7 +57,23 @@ class MainWindow(QMainWindow):
 
         self.create_toolbar()
 
+        # Batch operations run as background jobs, listed in a dock with progress and cancel buttons
+        self.jobs = JobManager(parent=self)
+        self.jobs_dock = QDockWidget("Jobs", self)
+        self.jobs_dock.setWidget(JobPanel(self.jobs, self.jobs_dock))
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.jobs_dock)
+
+        # Crop exports run in the background and report here
+        self.viewer.export_progress.connect(
+            lambda done, total: self.statusBar().showMessage(f"Cropping {done}/{total}"))
+        self.viewer.export_finished.connect(
+            lambda summary: self.statusBar().showMessage(
+                f"Saved {summary['written']}/{summary['regions']} crops to {summary['output_dir']}", 5000))
+        self.viewer.export_failed.connect(
+            lambda message: self.statusBar().showMessage(f"Crop export failed: {message}", 5000))
+
         # Default values for processing parameters
+        self.encoder = "default"
         self.kernel_size = 2
         self.percentage = 50
         self.compare_value = 100
@@ -80,6 +95,14 @@ class MainWindow(QMainWindow):
         self.erase_action.triggered.connect(lambda: self.viewer.toggle_erase_mode(True))
         toolbar.addAction(self.erase_action)
 
+        # Encoder profile for everything the batch operations write
+        toolbar.addSeparator()
+        toolbar.addWidget(QLabel("Output encoding: ", self))
+        self.encoder_input = QComboBox(self)
+        self.encoder_input.addItems(ENCODER_PROFILES)
+        self.encoder_input.currentTextChanged.connect(lambda name: setattr(self, "encoder", name))
+        toolbar.addWidget(self.encoder_input)
+
     def toggle_draw_mode(self, checked):
         if checked:
             self.draw_action.setText("Pan")
@@ -125,32 +148,30 @@ class MainWindow(QMainWindow):
            self.png_to_pdf(png_path, pdf_path)
    
     def png_to_pdf(self, png_path, pdf_path):
-        if not os.path.exists(png_path):
-            print(f"Error: The file at {png_path} does not exist.")
-            return
-
-        img = Image.open(png_path)
-        img = img.convert("RGB")
-        width, height = img.size
-
-        # Save image temporarily as JPEG
-        temp_img_path = "temp_image.jpg"
-        img.save(temp_img_path, "JPEG", quality=100)
-
-        # Set the canvas size to match the image size
-        c = canvas.Canvas(pdf_path, pagesize=(width, height))
-
-        # Draw the image so it fills the page
-        c.drawImage(temp_img_path, 0, 0, width, height)
-
-        # Save and clean up
-        c.save()
-        os.remove(temp_img_path)
-
-        print(f"PDF saved as {pdf_path}")
+        encoder = self.encoder
+
+        def run(job):
+            operations.get("pdf")(png_path, pdf_path, encoder=encoder)
+            job.progress(1)
+        # A single page is one thread's work, so it doesn't wait behind the heavy jobs
+        self.start_job(f"PDF {os.path.basename(pdf_path)}", run, total=1, heavy=False,
+                       done_message=f"PDF saved as {pdf_path}")
+
+    def start_job(self, name, fn, total=0, heavy=True, done_message=None):
+        job = self.jobs.submit(name, fn, total, heavy)
+        job.failed.connect(lambda message: self.statusBar().showMessage(f"{name} failed: {message}", 5000))
+        if done_message:
+            job.finished.connect(lambda result: self.statusBar().showMessage(done_message, 5000))
+        return job
+
+    def closeEvent(self, event):
+        # Stop the loops at their next check and let the workers wind down before exiting
+        self.jobs.cancel_all()
+        self.jobs.pool.waitForDone()
+        super().closeEvent(event)
    
     def open_processing_dialog(self):
-        dialog = ProcessingDialog(self)
+        dialog = ProcessingDialog(self, self.viewer)
         if dialog.exec_() == QDialog.Accepted:
             self.kernel_size = dialog.kernel_size
             self.percentage = dialog.percentage
@@ -162,35 +183,81 @@ class MainWindow(QMainWindow):
             output_directory = QFileDialog.getExistingDirectory(self, "Select Output Directory")
 
             if input_directory and output_directory:
-                process_images_in_directory(
-                    input_directory,
-                    output_directory,
-                    self.kernel_size,
-                    self.percentage,
-                    self.compare_value,
-                    self.set_value,
-                    self.comparison_operator
+                params = (self.kernel_size, self.percentage, self.compare_value, self.set_value, self.comparison_operator)
+                encoder = self.encoder
+                total = sum(1 for f in os.listdir(input_directory) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')))
+                self.start_job(
+                    f"Filter {os.path.basename(input_directory)}",
+                    lambda job: operations.get("filter")(input_directory, output_directory, *params,
+                                                         progress=job.progress, cancel=job.cancel_event,
+                                                         encoder=encoder),
+                    total=total,
+                    done_message=f"Processed images saved to {output_directory}",
                 )
 
+    def crop_boxes_dialog(self):
+        if not self.viewer.image_item:
+            return
+        output_dir = QFileDialog.getExistingDirectory(self, "Select Output Directory for Crops")
+        if output_dir:
+            self.viewer.crop_boxes(output_dir, self.encoder)
+
     def crop_by_json_dialog(self):
         image_path, _ = QFileDialog.getOpenFileName(self, "Select Image", "", "Images (*.png *.jpg *.jpeg *.bmp)")
         if not image_path:
             return
     
-        json_path, _ = QFileDialog.getOpenFileName(self, "Select JSON File", "", "JSON Files (*.json)")
+        json_path, _ = QFileDialog.getOpenFileName(self, "Select Coordinates File", "", "Coordinates (*.regions *.json)")
         if not json_path:
             return
     
         output_dir = QFileDialog.getExistingDirectory(self, "Select Output Directory")
         if not output_dir:
             return
-    
-        crop_images_by_json(image_path, json_path, output_dir)
+
+        encoder = self.encoder
+
+        def run(job):
+            regions = operations.get("load_regions")(json_path)
+            job.set_total(len(regions))
+            summary = operations.get("crop")(image_path, regions, output_dir, progress=job.progress, cancel=job.cancel_event,
+                                             encoder=encoder)
+            if summary is None:
+                raise IOError(f"Could not read image {image_path}")
+            return summary
+
+        self.start_job(f"Crop {os.path.basename(image_path)}", run, done_message=f"Crops saved to {output_dir}")
+
+    def paste_dialog(self):
+        # Everything is asked up front so the paste itself can run in the background
+        json_path, _ = QFileDialog.getOpenFileName(self, "Select Coordinates File", "", "Coordinates (*.regions *.json)")
+        if not json_path:
+            return
+        main_image_path, _ = QFileDialog.getOpenFileName(self, "Select Main Image", "", "Image Files (*.png *.jpg *.jpeg *.bmp *.tif *.tiff *.webp)")
+        if not main_image_path:
+            return
+        edited_folder = QFileDialog.getExistingDirectory(self, "Select Folder Containing Edited Crops")
+        if not edited_folder:
+            return
+        output_path, _ = QFileDialog.getSaveFileName(self, "Save Final Image", "", "Images (*.png *.webp *.tif)")
+        if not output_path:
+            return
+        encoder = self.encoder
+
+        def run(job):
+            regions = operations.get("load_regions")(json_path)
+            job.set_total(len(regions))
+            return operations.get("paste")(regions, main_image_path, edited_folder, output_path,
+                                           progress=job.progress, cancel=job.cancel_event, encoder=encoder)
+
+        self.start_job(f"Paste {os.path.basename(output_path)}", run, done_message=f"Saved image to: {output_path}")
 
 
 class ProcessingDialog(QDialog):
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, viewer=None):
         super().__init__(parent)
+        self.viewer = viewer
+        self.preview = None
         self.setWindowTitle("Set Processing Parameters")
         self.setModal(True)
 
@@ -222,6 +289,15 @@ class ProcessingDialog(QDialog):
         self.set_value_input.setText(str(self.set_value))
         layout.addRow("Set Value (e.g., 255):", self.set_value_input)
 
+        # Live preview of the current parameters on the visible part of the image
+        self.preview_checkbox = QCheckBox("Live preview", self)
+        self.preview_checkbox.setEnabled(viewer is not None)
+        self.preview_checkbox.toggled.connect(self.toggle_preview)
+        layout.addRow(self.preview_checkbox)
+        for line_edit in [self.kernel_size_input, self.percentage_input, self.compare_value_input, self.set_value_input]:
+            line_edit.textChanged.connect(self.update_preview)
+        self.operator_input.currentIndexChanged.connect(self.update_preview)
+
         button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
         button_box.accepted.connect(self.accept)
         button_box.rejected.connect(self.reject)
@@ -229,6 +305,32 @@ class ProcessingDialog(QDialog):
 
         self.setLayout(layout)
 
+    def toggle_preview(self, enabled):
+        if enabled and self.preview is None:
+            self.preview = operations.get("filter_preview")(self.viewer, self)
+            self.update_preview()
+        elif not enabled and self.preview is not None:
+            self.preview.stop()
+            self.preview = None
+
+    def update_preview(self, *args):
+        if self.preview is None:
+            return
+        try:
+            self.preview.set_params(
+                int(self.kernel_size_input.text()),
+                int(self.percentage_input.text()),
+                int(self.compare_value_input.text()),
+                int(self.set_value_input.text()),
+                self.operator_input.currentText(),
+            )
+        except ValueError:
+            return  # half-typed value; wait for the next edit
+
+    def done(self, result):
+        self.toggle_preview(False)
+        super().done(result)
+
     def accept(self):
         try:
             self.kernel_size = int(self.kernel_size_input.text())
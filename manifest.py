@@ -0,0 +1,97 @@
+# manifest.py
+# Record of the crops written by a crop export, so a later paste can tell which edited crops actually
+# changed. The manifest (crop_manifest.json next to the crops) holds, per region key, the box and the
+# size, modification time and content hash of the file that was written, plus the size and mtime of
+# the image the crops came from:
+#
+#   {"version": 1, "source": {"path", "size", "mtime_ns"},
+#    "crops": {"key": {"box": [x, y, w, h], "size", "mtime_ns", "hash"}, ...}}
+#
+# A crop counts as unchanged when its file still has the recorded size and mtime, or, if only the
+# mtime differs (the folder was copied, or the file re-saved as is), the same content hash.
+
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = "crop_manifest.json"
+VERSION = 1
+_CHUNK = 1024 * 1024
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_info(image_path):
+    info = os.stat(image_path)
+    return {"path": os.path.abspath(image_path), "size": info.st_size, "mtime_ns": info.st_mtime_ns}
+
+
+def crop_entry(crop_path, box, data):
+    # data is the encoded file content, already in memory after writing it
+    info = os.stat(crop_path)
+    return {"box": [int(v) for v in box], "size": info.st_size, "mtime_ns": info.st_mtime_ns,
+            "hash": content_hash(data)}
+
+
+def write_manifest(output_dir, crops, source=None):
+    # Written to a temporary file and renamed into place, like the region files
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": VERSION, "source": source, "crops": crops}, f)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_manifest(path):
+    # path is the manifest or the folder holding it; None when there is no usable manifest
+    if os.path.isdir(path):
+        path = os.path.join(path, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except ValueError:
+        print(f"Warning: ignoring unreadable crop manifest {path}")
+        return None
+    if manifest.get("version") != VERSION:
+        return None
+    return manifest
+
+
+def same_source(manifest, image_path):
+    # True if image_path still looks like the image the crops were exported from (same size and
+    # mtime, so also a copy that kept its mtime); unknown sources never match
+    source = manifest.get("source")
+    if not source:
+        return False
+    try:
+        current = source_info(image_path)
+    except OSError:
+        return False
+    return current["size"] == source["size"] and current["mtime_ns"] == source["mtime_ns"]
+
+
+def is_unchanged(entry, crop_path, box):
+    if entry is None or list(box) != entry["box"]:
+        return False
+    try:
+        info = os.stat(crop_path)
+    except OSError:
+        return False
+    if info.st_size != entry["size"]:
+        return False
+    if info.st_mtime_ns == entry["mtime_ns"]:
+        return True
+    return file_hash(crop_path) == entry["hash"]
@@ -0,0 +1,65 @@
+# operations.py
+# Registry of the operations behind MainWindow's buttons. Each entry names a "module:attribute" that is
+# imported on first use, so the window appears before cv2, NumPy, PIL and tqdm are loaded:
+#
+#   paste_edited_crops = operations.get("paste")
+#
+# warm_up() imports every registered module on a background thread once the window is up, so the
+# first click usually finds them loaded already. register() adds or replaces an entry (a
+# "module:attribute" string or the object itself).
+
+import importlib
+import threading
+import time
+
+OPERATIONS = {
+    "filter": "algo:process_images_in_directory",
+    "filter_preview": "preview:FilterPreview",
+    "crop": "crop:crop_images_by_json",
+    "paste": "replace:paste_edited_crops",
+    "pdf": "pdf:png_to_pdf",
+    "load_regions": "regions:load_regions",
+}
+
+_loaded = {}
+_warm_thread = None
+
+
+def register(name, target):
+    OPERATIONS[name] = target
+    _loaded.pop(name, None)
+
+
+def get(name):
+    target = _loaded.get(name)
+    if target is None:
+        spec = OPERATIONS[name]
+        if isinstance(spec, str):
+            module_name, attribute = spec.split(":")
+            target = getattr(importlib.import_module(module_name), attribute)
+        else:
+            target = spec
+        _loaded[name] = target
+    return target
+
+
+def _warm(names, done):
+    start = time.perf_counter()
+    for name in names:
+        try:
+            get(name)
+        except Exception as e:
+            # The error comes back when the operation is used; warming is best effort
+            print(f"Warning: could not preload {name}: {e}")
+    if done:
+        done(time.perf_counter() - start)
+
+
+def warm_up(names=None, done=None):
+    # Imports the operations on a daemon thread; done(seconds) is called from that thread when finished
+    global _warm_thread
+    if _warm_thread is not None:
+        return _warm_thread
+    _warm_thread = threading.Thread(target=_warm, args=(list(names or OPERATIONS), done), daemon=True)
+    _warm_thread.start()
+    return _warm_thread
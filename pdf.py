@@ -1,47 +1,217 @@
-from PyQt5.QtWidgets import QInputDialog
+import io
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import portrait
+import encoders
+import instrument
+import image_cache
 
 # Disable pixel limit to support large images
 Image.MAX_IMAGE_PIXELS = None
 
-def png_to_pdf(png_path, pdf_path):
-    if not os.path.exists(png_path):
-        print(f"Error: The file at {png_path} does not exist.")
-        return
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+# "auto" embeds JPEG files as-is and everything else losslessly
+PDF_MODES = ('auto', 'lossless', 'jpeg', 'passthrough')
+
+
+class PdfPage:
+    # Encoded image data ready to be embedded: filter is /DCTDecode (JPEG bytes) or /FlateDecode (zlib pixels)
+    def __init__(self, width, height, color_space, pdf_filter, data, encode_seconds=0.0):
+        self.width = width
+        self.height = height
+        self.color_space = color_space
+        self.pdf_filter = pdf_filter
+        self.data = data
+        self.encode_seconds = encode_seconds
+
+
+def encode_page(image_path, mode='auto', quality=95, encoder=encoders.DEFAULT_PROFILE):
+    if mode not in PDF_MODES:
+        raise ValueError(f"Unknown PDF mode {mode!r}, expected one of {PDF_MODES}")
+
+    with Image.open(image_path) as img:
+        color_space = '/DeviceGray' if img.mode in ('L', '1') else '/DeviceRGB'
+        width, height = img.size
+        instrument.count("pixels", width * height, op="pdf")
+
+        # Passthrough: the JPEG file already is a valid /DCTDecode stream, no decode or re-encode needed
+        if mode in ('auto', 'passthrough') and img.format == 'JPEG' and img.mode in ('L', 'RGB'):
+            with instrument.span("decode", op="pdf"), open(image_path, 'rb') as f:
+                return PdfPage(width, height, color_space, '/DCTDecode', f.read())
+
+    with instrument.span("decode", op="pdf"):
+        pixels = image_cache.load(image_path, 'L' if color_space == '/DeviceGray' else 'RGB')
+    return encode_pixels(pixels, mode, quality, encoder)
+
+
+def encode_pixels(pixels, mode='auto', quality=95, encoder=encoders.DEFAULT_PROFILE):
+    # A page from decoded pixels: HxW gray or HxWx3 RGB uint8. There is no file to pass through,
+    # so every mode except "jpeg" embeds the pixels losslessly, with the encoder profile's zlib level.
+    if mode not in PDF_MODES:
+        raise ValueError(f"Unknown PDF mode {mode!r}, expected one of {PDF_MODES}")
+    pixels = np.ascontiguousarray(pixels)
+    height, width = pixels.shape[:2]
+    color_space = '/DeviceGray' if pixels.ndim == 2 else '/DeviceRGB'
+
+    start = time.perf_counter()
+    with instrument.span("encode", op="pdf"):
+        if mode == 'jpeg':
+            buffer = io.BytesIO()
+            image_cache.as_pil(pixels).save(buffer, 'JPEG', quality=quality)
+            pdf_filter, data = '/DCTDecode', buffer.getvalue()
+        else:
+            pdf_filter, data = '/FlateDecode', zlib.compress(pixels, encoders.deflate_level(encoder))
+    return PdfPage(width, height, color_space, pdf_filter, data, time.perf_counter() - start)
+
+
+class PdfStreamWriter:
+    # Minimal PDF writer: each page (image XObject, content stream, page object) is written to disk
+    # as soon as it is added, so memory stays bounded by one page no matter how many pages there are.
+    # encoded totals the pages' image bytes and encode time. Pages go to pdf_path + ".tmp", which
+    # close() moves into place; abort() (or an exception inside a with block) deletes it, so a failed
+    # or cancelled run never leaves a truncated PDF at pdf_path.
+    def __init__(self, pdf_path, encoder=encoders.DEFAULT_PROFILE):
+        self.pdf_path = pdf_path
+        self.tmp_path = pdf_path + ".tmp"
+        self.file = open(self.tmp_path, 'wb')
+        self.encoded = encoders.EncodeStats(encoder)
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3  # 1 is the catalog, 2 the page tree (written last)
+        self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
 
-    img = Image.open(png_path)
-    img = img.convert("RGB")
-    width, height = img.size
+    def _new_id(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
 
-    # Save image temporarily as JPEG
-    temp_img_path = "temp_image.jpg"
-    img.save(temp_img_path, "JPEG", quality=100)
+    def _write_object(self, obj_id, body, stream=None):
+        self.offsets[obj_id] = self.file.tell()
+        self.file.write(f'{obj_id} 0 obj\n'.encode('ascii'))
+        self.file.write(body.encode('ascii'))
+        if stream is not None:
+            self.file.write(b'\nstream\n')
+            self.file.write(stream)
+            self.file.write(b'\nendstream')
+        self.file.write(b'\nendobj\n')
 
-    # Set the canvas size to match the image size
-    c = canvas.Canvas(pdf_path, pagesize=(width, height))
+    def add_page(self, page):
+        with instrument.span("write", op="pdf"):
+            self._add_page(page)
+        instrument.count("pages", op="pdf")
+        instrument.count("bytes", len(page.data), op="pdf")
+        self.encoded.add(len(page.data), page.encode_seconds)
 
-    # Draw the image so it fills the page
-    c.drawImage(temp_img_path, 0, 0, width, height)
+    def _add_page(self, page):
+        image_id, content_id, page_id = self._new_id(), self._new_id(), self._new_id()
 
-    # Save and clean up
-    c.save()
-    os.remove(temp_img_path)
+        self._write_object(image_id, (
+            f'<< /Type /XObject /Subtype /Image /Width {page.width} /Height {page.height} '
+            f'/ColorSpace {page.color_space} /BitsPerComponent 8 /Filter {page.pdf_filter} '
+            f'/Length {len(page.data)} >>'
+        ), page.data)
+
+        # Page size matches the image size, and the image fills the page
+        content = f'q {page.width} 0 0 {page.height} 0 0 cm /Im0 Do Q'.encode('ascii')
+        self._write_object(content_id, f'<< /Length {len(content)} >>', content)
+
+        self._write_object(page_id, (
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page.width} {page.height}] '
+            f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>'
+        ))
+        self.page_ids.append(page_id)
+
+    def close(self):
+        kids = ' '.join(f'{page_id} 0 R' for page_id in self.page_ids)
+        self._write_object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+        self._write_object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>')
+
+        xref_offset = self.file.tell()
+        self.file.write(f'xref\n0 {self.next_id}\n0000000000 65535 f \n'.encode('ascii'))
+        for obj_id in range(1, self.next_id):
+            self.file.write(f'{self.offsets[obj_id]:010d} 00000 n \n'.encode('ascii'))
+        self.file.write(f'trailer\n<< /Size {self.next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode('ascii'))
+        self.file.close()
+        self.file = None
+        os.replace(self.tmp_path, self.pdf_path)
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        elif self.file is not None:
+            try:
+                self.close()
+            except BaseException:
+                self.abort()
+                raise
+
+
+# png_to_pdf, images_to_pdf and folder_to_pdf return pdf_path once the PDF is saved, None if nothing was
+def png_to_pdf(png_path, pdf_path, mode='auto', quality=95, encoder=encoders.DEFAULT_PROFILE):
+    if not os.path.exists(png_path):
+        print(f"Error: The file at {png_path} does not exist.")
+        return None
+
+    page = encode_page(png_path, mode, quality, encoder)
+    with PdfStreamWriter(pdf_path, encoder) as writer:
+        writer.add_page(page)
 
     print(f"PDF saved as {pdf_path}")
-def open_pdf_dialog(self):
-    # Step 1: Ask the user to select a PNG file
-    png_path, _ = QFileDialog.getOpenFileName(self, "Open PNG File", "", "PNG Files (*.png)")
-    if not png_path:
-        return
+    print(writer.encoded.summary())
+    return pdf_path
+
+
+def images_to_pdf(image_paths, pdf_path, mode='auto', quality=95, workers=None, progress=None, cancel=None,
+                  encoder=encoders.DEFAULT_PROFILE):
+    # Pages are encoded on a thread pool (PIL and zlib release the GIL) and written in order as they
+    # finish; at most 2 * workers encoded pages are held in memory at once. Once the optional cancel
+    # Event is set no more pages are started and nothing is saved.
+    workers = workers or os.cpu_count() or 1
+    window = workers * 2
+    image_paths = list(image_paths)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, PdfStreamWriter(pdf_path, encoder) as writer:
+        pending = [executor.submit(encode_page, p, mode, quality, encoder) for p in image_paths[:window]]
+        for index in range(len(image_paths)):
+            if cancel is not None and cancel.is_set():
+                for future in pending[index:]:
+                    future.cancel()
+                writer.abort()
+                break
+            page = pending[index].result()
+            pending[index] = None
+            if index + window < len(image_paths):
+                pending.append(executor.submit(encode_page, image_paths[index + window], mode, quality, encoder))
+            writer.add_page(page)
+            if progress:
+                progress(1)
 
-    # Step 2: Ask the user to input a name for the PDF file
-    pdf_name, ok = QInputDialog.getText(self, "Enter PDF Name", "Enter the name of the PDF (without extension):")
-    if not ok or not pdf_name:
-        return
+    if cancel is not None and cancel.is_set():
+        print("PDF cancelled")
+        return None
+    print(f"PDF with {len(image_paths)} pages saved as {pdf_path}")
+    print(writer.encoded.summary())
+    return pdf_path
 
-    pdf_path = pdf_name + ".pdf"
 
-    # Step 3: Call the function to convert the PNG to PDF
-    self.png_to_pdf(png_path, pdf_path)
\ No newline at end of file
+def folder_to_pdf(folder, pdf_path, mode='auto', quality=95, workers=None, progress=None, cancel=None,
+                  encoder=encoders.DEFAULT_PROFILE):
+    image_paths = [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.lower().endswith(IMAGE_EXTENSIONS)]
+    if not image_paths:
+        print(f"Error: No images found in {folder}")
+        return None
+    return images_to_pdf(image_paths, pdf_path, mode, quality, workers, progress, cancel, encoder)
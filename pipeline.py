@@ -0,0 +1,166 @@
+# pipeline.py
+# Filter -> crop -> edit -> paste -> PDF for many pages without intermediate files. Each page is
+# decoded once, filtered, its regions are cropped as array views and handed to an edit function,
+# the results are composited back in memory, and only the finished pages (the PDF, plus images if
+# output_dir is given, in the encoder profile's format) are encoded:
+#
+#   run_pipeline(pages, "book.pdf", filter_params={"kernel_size": 3, "percentage": 75},
+#                regions="coordinates.regions", edit=edited_from_dir("edited"))
+#
+# edit(image_path, key, crop) gets a copy of the region's pixels (gray HxW or RGB HxWx3) and returns
+# the edited pixels (gray, RGB or RGBA; resized to the region if needed), or None to leave the region
+# as it is. Pages run on a thread pool (OpenCV, PIL and zlib release the GIL) and are written to the
+# PDF in order; at most 2 * workers finished pages are held in memory at once.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import encoders
+import instrument
+from algo import filter_image
+from pdf import PdfStreamWriter, encode_pixels
+from regions import as_region_store, load_regions
+from replace import composite_pixels, edited_pixels, plan_layers
+
+# Disable pixel limit to support large images
+Image.MAX_IMAGE_PIXELS = None
+
+FILTER_DEFAULTS = {
+    "kernel_size": 2,
+    "percentage": 50,
+    "compare_value": 100,
+    "set_value": 255,
+    "comparison_operator": ">=",
+    "engine": "vectorized",
+}
+
+
+def edited_from_dir(edited_dir, per_page=False):
+    # An edit function that takes edited crops from edited_dir/<key>.png (or .webp, .tif), or with
+    # per_page from edited_dir/<page name>/<key>.png; regions without a file are left unchanged
+    def edit(image_path, key, crop):
+        folder = edited_dir
+        if per_page:
+            folder = os.path.join(edited_dir, os.path.splitext(os.path.basename(image_path))[0])
+        edited_path = encoders.find_crop(folder, key)
+        if edited_path is None:
+            return None
+        with Image.open(edited_path) as img:
+            img.load()
+            return img
+    return edit
+
+
+def _load_page(image_path, filter_params):
+    # Filtered pages are grayscale like process_image's output; unfiltered pages keep their colour
+    with instrument.span("decode", op="pipeline"):
+        if filter_params is not None:
+            page = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+            if page is None:
+                raise IOError(f"Could not read image {image_path}")
+        else:
+            with Image.open(image_path) as img:
+                page = np.asarray(img.convert("L" if img.mode in ("L", "1") else "RGB"))
+
+    if filter_params is not None:
+        options = dict(FILTER_DEFAULTS)
+        options.update(filter_params)
+        with instrument.span("compute", op="pipeline"):
+            page = filter_image(page, options["kernel_size"], options["percentage"], options["compare_value"],
+                                options["set_value"], options["comparison_operator"], options["engine"])
+    return page
+
+
+def _paste_edits(image_path, page, regions, edit):
+    # Every crop is taken from the page as it was before pasting, like cropping to files first;
+    # overlapping regions are applied in region order
+    master = None
+    for layer in plan_layers(regions):
+        for index in layer:
+            key, box = regions.key(index), regions.box(index)
+            x, y, width, height = box
+            crop = page[max(y, 0):max(y + height, 0), max(x, 0):max(x + width, 0)]
+            if crop.size == 0:
+                continue
+            edited = edit(image_path, key, crop.copy())
+            if edited is None:
+                continue
+            if not isinstance(edited, Image.Image):
+                edited = Image.fromarray(np.asarray(edited, dtype=np.uint8))
+            if master is None:
+                code = cv2.COLOR_GRAY2RGBA if page.ndim == 2 else cv2.COLOR_RGB2RGBA
+                master = cv2.cvtColor(page, code)
+            composite_pixels(master, box, edited_pixels(edited, box))
+
+    if master is None:
+        return page
+    rgb = master[..., :3]
+    # Keep gray pages gray when the edits were gray too
+    if page.ndim == 2 and (rgb[..., 0] == rgb[..., 1]).all() and (rgb[..., 1] == rgb[..., 2]).all():
+        return np.ascontiguousarray(rgb[..., 0])
+    return np.ascontiguousarray(rgb)
+
+
+def process_page(image_path, filter_params=None, regions=None, edit=None, output_dir=None, mode='auto', quality=95,
+                 encoder=encoders.DEFAULT_PROFILE, encoded=None):
+    # Runs one page through the pipeline and returns its encoded PDF page; the time and bytes of the
+    # page written to output_dir go to the optional EncodeStats encoded
+    page = _load_page(image_path, filter_params)
+
+    page_regions = regions(image_path) if callable(regions) else regions
+    if page_regions is not None and edit is not None:
+        page = _paste_edits(image_path, page, as_region_store(page_regions), edit)
+
+    if output_dir:
+        output_path = encoders.output_path(
+            os.path.join(output_dir, os.path.splitext(os.path.basename(image_path))[0] + ".png"), encoder)
+        nbytes, seconds = encoders.write_image(output_path, page, encoder, order="rgb", op="pipeline")
+        if encoded is not None:
+            encoded.add(nbytes, seconds)
+
+    instrument.count("pages", op="pipeline")
+    instrument.count("pixels", page.shape[0] * page.shape[1], op="pipeline")
+    return encode_pixels(page, mode, quality, encoder)
+
+
+def run_pipeline(image_paths, pdf_path, filter_params=None, regions=None, edit=None, output_dir=None,
+                 mode='auto', quality=95, workers=None, encoder=encoders.DEFAULT_PROFILE):
+    # filter_params: None to skip the filter, otherwise overrides for FILTER_DEFAULTS.
+    # regions: one region set (RegionStore, coordinates dict or file path) for every page, or a
+    # function image_path -> region set or None.
+    # Returns pdf_path once the PDF is saved, None if there were no pages; a page that fails raises.
+    image_paths = list(image_paths)
+    if not image_paths:
+        print("Error: No pages to write")
+        return None
+    if isinstance(regions, str):
+        regions = load_regions(regions)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    workers = workers or os.cpu_count() or 1
+    window = workers * 2
+    encoded = encoders.EncodeStats(encoder)
+
+    def submit(executor, image_path):
+        return executor.submit(process_page, image_path, filter_params, regions, edit, output_dir, mode, quality,
+                               encoder, encoded)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, PdfStreamWriter(pdf_path, encoder) as writer:
+        pending = [submit(executor, p) for p in image_paths[:window]]
+        for index in range(len(image_paths)):
+            page = pending[index].result()
+            pending[index] = None
+            if index + window < len(image_paths):
+                pending.append(submit(executor, image_paths[index + window]))
+            writer.add_page(page)
+
+    print(f"Pipeline wrote {len(image_paths)} pages to {pdf_path}")
+    print(f"PDF pages: {writer.encoded.summary()}")
+    if output_dir:
+        print(f"Page images: {encoded.summary()}")
+    return pdf_path
@@ -0,0 +1,139 @@
+# preview.py
+# Live preview of the threshold filter over the part of the image visible in ImageViewer. The
+# visible region is taken from the viewer's pyramid at roughly screen resolution (a downsampled
+# proxy), filtered on a background thread and shown as an overlay. Parameter changes are debounced,
+# the proxy is reused until the view moves, and results from stale requests are dropped.
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PyQt5.QtWidgets import QGraphicsPixmapItem
+from PyQt5.QtGui import QImage, QPixmap, QTransform
+from PyQt5.QtCore import QObject, QRectF, QTimer, pyqtSignal
+
+from algo import filter_image
+
+DEBOUNCE_MS = 200
+
+
+class FilterPreview(QObject):
+    # generation, (proxy, filtered proxy pixels); emitted from the worker thread
+    _result = pyqtSignal(int, object)
+
+    def __init__(self, viewer, parent=None):
+        super().__init__(parent)
+        self.viewer = viewer
+        self.params = None
+        self.generation = 0
+        self.proxy = None  # (key, scene rect, scale_x, scale_y, gray array) for the current view
+        self.overlay = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(DEBOUNCE_MS)
+        self.timer.timeout.connect(self._start)
+        self._result.connect(self._show)
+
+        # Panning or zooming changes the scrollbars, so the preview follows the view
+        for bar in (viewer.horizontalScrollBar(), viewer.verticalScrollBar()):
+            bar.valueChanged.connect(self.schedule)
+            bar.rangeChanged.connect(self.schedule)
+
+    def set_params(self, kernel_size, percentage, compare_value, set_value, comparison_operator):
+        self.params = (kernel_size, percentage, compare_value, set_value, comparison_operator)
+        self.schedule()
+
+    def schedule(self, *args):
+        if self.params is not None:
+            self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.params = None
+        self.generation += 1
+        for bar in (self.viewer.horizontalScrollBar(), self.viewer.verticalScrollBar()):
+            bar.valueChanged.disconnect(self.schedule)
+            bar.rangeChanged.disconnect(self.schedule)
+        self._remove_overlay()
+        self.executor.shutdown(wait=False)
+
+    def _remove_overlay(self):
+        if self.overlay is not None:
+            try:
+                if self.overlay.scene() is not None:
+                    self.overlay.scene().removeItem(self.overlay)
+            except RuntimeError:
+                pass  # already deleted by scene.clear() when a new image was loaded
+        self.overlay = None
+
+    def _view_key(self):
+        item = self.viewer.image_item
+        if item is None or not item.pyramid.ready or item.pyramid.error or not item.pyramid.levels:
+            return None
+        visible = self.viewer.mapToScene(self.viewer.viewport().rect()).boundingRect()
+        visible = visible.intersected(item.boundingRect())
+        if visible.isEmpty():
+            return None
+        level = item.level_for(self.viewer.transform().m11())
+        return (level, int(visible.x()), int(visible.y()), int(math.ceil(visible.width())), int(math.ceil(visible.height())))
+
+    def _start(self):
+        key = self._view_key()
+        if key is None or self.params is None:
+            return
+        self.generation += 1
+        generation = self.generation
+        pyramid = self.viewer.image_item.pyramid
+        scene_size = (self.viewer.image_item.width, self.viewer.image_item.height)
+        # Reuse the proxy when only the parameters changed
+        proxy = self.proxy if self.proxy is not None and self.proxy[0] == key else None
+        self.executor.submit(self._compute, generation, key, proxy, pyramid, scene_size, self.params)
+
+    def _compute(self, generation, key, proxy, pyramid, scene_size, params):
+        try:
+            if proxy is None:
+                level, x, y, width, height = key
+                array = pyramid.levels[level]
+                scale_x = scene_size[0] / array.shape[1]
+                scale_y = scene_size[1] / array.shape[0]
+                x0, y0 = int(x / scale_x), int(y / scale_y)
+                x1 = min(int(math.ceil((x + width) / scale_x)), array.shape[1])
+                y1 = min(int(math.ceil((y + height) / scale_y)), array.shape[0])
+                region = np.ascontiguousarray(array[y0:y1, x0:x1])
+                if region.ndim == 3:
+                    code = cv2.COLOR_BGRA2GRAY if region.shape[2] == 4 else cv2.COLOR_BGR2GRAY
+                    region = cv2.cvtColor(region, code)
+                rect = QRectF(x0 * scale_x, y0 * scale_y, (x1 - x0) * scale_x, (y1 - y0) * scale_y)
+                proxy = (key, rect, scale_x, scale_y, region)
+
+            # A newer request has been made since this one was queued
+            if generation != self.generation:
+                return
+
+            key, rect, scale_x, scale_y, region = proxy
+            kernel_size, percentage, compare_value, set_value, comparison_operator = params
+            # Shrink the kernel with the proxy so it covers about the same scene area
+            proxy_kernel = max(int(round(kernel_size / scale_x)), 1)
+            filtered = filter_image(region, proxy_kernel, percentage, compare_value, set_value, comparison_operator)
+            self._result.emit(generation, (proxy, filtered))
+        except Exception as e:
+            print(f"Error: preview failed: {e}")
+
+    def _show(self, generation, payload):
+        if generation != self.generation or self.params is None:
+            return
+        proxy, filtered = payload
+        self.proxy = proxy
+        _, rect, scale_x, scale_y, _ = proxy
+
+        height, width = filtered.shape
+        image = QImage(filtered.data, width, height, filtered.strides[0], QImage.Format_Grayscale8).copy()
+        self._remove_overlay()
+        self.overlay = QGraphicsPixmapItem(QPixmap.fromImage(image))
+        self.overlay.setTransform(QTransform.fromScale(scale_x, scale_y))
+        self.overlay.setPos(rect.topLeft())
+        self.overlay.setZValue(0.5)  # above the image, below the boxes
+        self.viewer.scene.addItem(self.overlay)
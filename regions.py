@@ -0,0 +1,158 @@
+# regions.py
+# Compact storage for crop regions. A .regions file holds the boxes as four int32 columns
+# (x, y, width, height) plus an index of region keys, and is opened with a memory map, so a
+# file with hundreds of thousands of regions costs almost nothing to open and is read in slices:
+#
+#   store = load_regions("crops/coordinates.regions")   # or a coordinates JSON
+#   for start, stop in store.batches(4096):
+#       xs, ys, widths, heights = store.columns[:, start:stop]
+#
+# Layout (little-endian): 32-byte header (magic, version, flags, count, key blob size), the columns,
+# then, unless the keys are simply "1".."n", count + 1 uint64 offsets into a UTF-8 key blob.
+# The coordinates JSON ({"key": {"x", "y", "width", "height"}, ...}) can be converted both ways.
+
+import json
+import os
+import struct
+
+import numpy as np
+
+MAGIC = b"IMGREGNS"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQ")  # magic, version, flags, count, key blob bytes
+FLAG_SEQUENTIAL_KEYS = 1
+REGION_EXTENSION = ".regions"
+
+_INT32_MIN, _INT32_MAX = np.iinfo(np.int32).min, np.iinfo(np.int32).max
+
+
+class RegionStore:
+    # Read-only view over region boxes; columns is a (4, count) int32 array (memory-mapped when
+    # opened from a file) with rows x, y, width, height. Region i is named key(i).
+    def __init__(self, columns, keys=None, key_offsets=None, key_blob=None):
+        self.columns = columns
+        self._keys = keys  # list of str, or None for "1".."n" / a key blob
+        self._key_offsets = key_offsets
+        self._key_blob = key_blob
+
+    def __len__(self):
+        return self.columns.shape[1]
+
+    def key(self, index):
+        if self._keys is not None:
+            return self._keys[index]
+        if self._key_offsets is None:
+            return str(index + 1)
+        start, stop = int(self._key_offsets[index]), int(self._key_offsets[index + 1])
+        return bytes(self._key_blob[start:stop]).decode("utf-8")
+
+    def keys(self):
+        return (self.key(i) for i in range(len(self)))
+
+    def box(self, index):
+        x, y, width, height = self.columns[:, index].tolist()
+        return x, y, width, height
+
+    def batches(self, batch_size):
+        # (start, stop) row ranges covering the store
+        return [(start, min(start + batch_size, len(self))) for start in range(0, len(self), batch_size)]
+
+    def to_dict(self):
+        xs, ys, widths, heights = (column.tolist() for column in self.columns)
+        return {self.key(i): {"x": xs[i], "y": ys[i], "width": widths[i], "height": heights[i]}
+                for i in range(len(self))}
+
+    @classmethod
+    def from_dict(cls, coords_data):
+        boxes = [(c["x"], c["y"], c["width"], c["height"]) for c in coords_data.values()]
+        return cls.from_boxes(boxes, list(coords_data))
+
+    @classmethod
+    def from_boxes(cls, boxes, keys=None):
+        columns = np.ascontiguousarray(np.asarray(boxes, dtype=np.int64).reshape(-1, 4).T)
+        if columns.size and (columns.min() < _INT32_MIN or columns.max() > _INT32_MAX):
+            raise ValueError("Region coordinates do not fit in 32 bits")
+        keys = None if keys is None else [str(key) for key in keys]
+        return cls(columns.astype(np.int32), None if keys is None or _sequential(keys) else keys)
+
+
+def _sequential(keys):
+    return all(key == str(i) for i, key in enumerate(keys, 1))
+
+
+def as_region_store(regions):
+    # Accepts a RegionStore or a coordinates dict as loaded from JSON
+    if isinstance(regions, RegionStore):
+        return regions
+    return RegionStore.from_dict(regions)
+
+
+def open_regions(path):
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError(f"{path} is not a region file")
+    magic, version, flags, count, blob_bytes = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a region file")
+    if version != VERSION:
+        raise ValueError(f"{path} has unsupported region format version {version}")
+    if count == 0:
+        return RegionStore(np.empty((4, 0), dtype=np.int32))
+
+    columns = np.memmap(path, dtype="<i4", mode="r", offset=HEADER.size, shape=(4, count))
+    if flags & FLAG_SEQUENTIAL_KEYS:
+        return RegionStore(columns)
+    offsets_at = HEADER.size + 4 * 4 * count
+    offsets = np.memmap(path, dtype="<u8", mode="r", offset=offsets_at, shape=(count + 1,))
+    blob = np.memmap(path, dtype=np.uint8, mode="r", offset=offsets_at + 8 * (count + 1), shape=(blob_bytes,)) \
+        if blob_bytes else b""
+    return RegionStore(columns, key_offsets=offsets, key_blob=blob)
+
+
+def write_regions(path, regions):
+    # Written to a temporary file and renamed into place, so readers never see a partial file
+    store = as_region_store(regions)
+    count = len(store)
+    sequential = store._keys is None and store._key_offsets is None
+    if not sequential:
+        encoded = [store.key(i).encode("utf-8") for i in range(count)]
+        offsets = np.zeros(count + 1, dtype="<u8")
+        np.cumsum([len(key) for key in encoded], out=offsets[1:])
+        blob = b"".join(encoded)
+    else:
+        blob = b""
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, FLAG_SEQUENTIAL_KEYS if sequential else 0, count, len(blob)))
+        f.write(np.ascontiguousarray(store.columns, dtype="<i4").tobytes())
+        if not sequential:
+            f.write(offsets.tobytes())
+            f.write(blob)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_regions(path):
+    # A .regions file is memory-mapped; anything else is read as coordinates JSON
+    if not path.lower().endswith(".json"):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) == MAGIC:
+                return open_regions(path)
+    with open(path, "r") as f:
+        return RegionStore.from_dict(json.load(f))
+
+
+def export_json(regions, json_path, indent=4):
+    with open(json_path, "w") as f:
+        json.dump(as_region_store(regions).to_dict(), f, indent=indent)
+    return json_path
+
+
+def convert(src_path, dst_path):
+    # JSON <-> .regions, picked by the destination's extension
+    store = load_regions(src_path)
+    if dst_path.lower().endswith(".json"):
+        return export_json(store, dst_path)
+    return write_regions(dst_path, store)
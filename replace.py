@@ -1,18 +1,319 @@
 import os
-import json
+import numpy as np
 from PIL import Image
-from PyQt5.QtWidgets import QFileDialog, QMessageBox
 from tqdm import tqdm
-import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import encoders
+import instrument
+import image_cache
+import roi
+from manifest import is_unchanged, load_manifest, same_source
+from regions import as_region_store, load_regions
 
-def paste_edited_crops_dialog(parent=None):
-    # Select JSON file
-    json_path, _ = QFileDialog.getOpenFileName(parent, "Select JSON File", "", "JSON Files (*.json)")
+# PyQt5 is imported inside the dialog helpers only, so the paste logic can run headless
+
+
+def load_coordinates(path):
+    # Region file (memory-mapped) or coordinates JSON, as a RegionStore
+    return load_regions(path)
+
+
+# Grid cell size used to find overlapping regions without comparing every pair
+OVERLAP_CELL = 256
+# Regions whose boxes are read from the store at a time when planning
+PLAN_CHUNK = 65536
+
+
+def _clip_region(box, image_width, image_height):
+    # Returns (dst_y0, dst_y1, dst_x0, dst_x1, src_y0, src_x0) clipped like Image.paste, or None if outside
+    x, y, w, h = box
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, image_width), min(y + h, image_height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return y0, y1, x0, x1, y0 - y, x0 - x
+
+
+def _cells(x0, y0, x1, y1):
+    return [(cx, cy)
+            for cx in range(x0 // OVERLAP_CELL, (x1 - 1) // OVERLAP_CELL + 1)
+            for cy in range(y0 // OVERLAP_CELL, (y1 - 1) // OVERLAP_CELL + 1)]
+
+
+def _chunks(regions, indices=None):
+    # (indices, xs, ys, rights, bottoms) as lists, PLAN_CHUNK regions at a time (all of them, or the
+    # ascending indices), so only one chunk of the memory-mapped columns is turned into Python ints
+    order = None if indices is None else np.asarray(indices, dtype=np.int64)
+    count = len(regions) if order is None else len(order)
+    for start in range(0, count, PLAN_CHUNK):
+        stop = min(start + PLAN_CHUNK, count)
+        chunk = np.arange(start, stop) if order is None else order[start:stop]
+        xs, ys, widths, heights = regions.columns[:, start:stop] if order is None else regions.columns[:, chunk]
+        xs, ys = xs.astype(np.int64), ys.astype(np.int64)
+        yield chunk.tolist(), xs.tolist(), ys.tolist(), (xs + widths).tolist(), (ys + heights).tolist()
+
+
+def _column_views(regions):
+    # The store's columns as memoryviews: indexing one gives a Python int without a NumPy scalar
+    return [memoryview(np.ascontiguousarray(column)) for column in regions.columns]
+
+
+def _overlaps(columns, other, x0, y0, x1, y1):
+    # Whether region other (looked up in _column_views) overlaps the box x0, y0 to x1, y1
+    xs, ys, widths, heights = columns
+    ox, oy = xs[other], ys[other]
+    return x0 < ox + widths[other] and ox < x1 and y0 < oy + heights[other] and oy < y1
+
+
+def plan_layers(regions, indices=None):
+    # Greedy layering in region order: a region goes one layer above the highest earlier region it overlaps.
+    # Regions within a layer never overlap, so a layer can be written in parallel without a lock, and
+    # applying layers in order gives the same result as pasting the regions one after another.
+    # Layers are ascending arrays of region indices; indices (ascending) limits the plan to those regions.
+    columns = _column_views(regions)
+    grid = {}  # cell -> planned regions so far
+    layer_of = np.full(len(regions), -1, dtype=np.int32)
+    layers = memoryview(layer_of)
+
+    for chunk, xs, ys, rights, bottoms in _chunks(regions, indices):
+        for index, x0, y0, x1, y1 in zip(chunk, xs, ys, rights, bottoms):
+            cells = _cells(x0, y0, x1, y1)
+            layer = 0
+            for cell in cells:
+                for other in grid.get(cell, ()):
+                    if layers[other] >= layer and _overlaps(columns, other, x0, y0, x1, y1):
+                        layer = layers[other] + 1
+            layers[index] = layer
+            for cell in cells:
+                grid.setdefault(cell, []).append(index)
+
+    planned = np.flatnonzero(layer_of >= 0)
+    if not len(planned):
+        return []
+    by_layer = planned[np.argsort(layer_of[planned], kind="stable")]
+    return np.split(by_layer, np.cumsum(np.bincount(layer_of[planned]))[:-1])
+
+
+def find_unchanged(regions, edited_folder, manifest, workers=None):
+    # Boolean array: True where the edited crop is still the file crop export wrote (see manifest.py).
+    # Mostly stat calls; files whose mtime changed are hashed, on a thread pool.
+    crops = manifest["crops"]
+    workers = workers or os.cpu_count() or 1
+
+    def check(batch):
+        start, stop = batch
+        flags = []
+        for index in range(start, stop):
+            crop_path = encoders.find_crop(edited_folder, regions.key(index))
+            flags.append(crop_path is not None
+                         and is_unchanged(crops.get(regions.key(index)), crop_path, regions.box(index)))
+        return flags
+
+    unchanged = np.zeros(len(regions), dtype=bool)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (start, stop), flags in zip(regions.batches(1024), executor.map(check, regions.batches(1024))):
+            unchanged[start:stop] = flags
+    return unchanged
+
+
+def regions_to_paste(regions, unchanged):
+    # Indices (an ascending array) of the changed regions, plus unchanged ones that overlap an earlier
+    # changed region (a full paste would put the original pixels back over that edit). Any other unchanged
+    # region would only paste back the pixels it was cropped from, so skipping it leaves the same result;
+    # the exception is a master with transparency, where a full paste also made those regions opaque.
+    columns = _column_views(regions)
+    paste = ~unchanged
+    grid = {}  # cell -> changed regions so far
+
+    for chunk, xs, ys, rights, bottoms in _chunks(regions):
+        changed = paste[chunk[0]:chunk[-1] + 1].tolist()
+        for index, x0, y0, x1, y1, is_changed in zip(chunk, xs, ys, rights, bottoms, changed):
+            cells = _cells(x0, y0, x1, y1)
+            if is_changed:
+                for cell in cells:
+                    grid.setdefault(cell, []).append(index)
+            elif any(_overlaps(columns, other, x0, y0, x1, y1) for cell in cells for other in grid.get(cell, ())):
+                paste[index] = True
+
+    return np.flatnonzero(paste)
+
+
+def incremental_plan(regions, main_image_path, edited_folder, manifest_path=None, workers=None):
+    # Region indices worth pasting, or None to paste them all: used when the crops were exported with
+    # a manifest (crop_manifest.json in edited_folder, or manifest_path) from this version of the image
+    manifest = load_manifest(manifest_path or edited_folder)
+    if manifest is None:
+        return None
+    if not same_source(manifest, main_image_path):
+        print("Crops were exported from a different version of the main image; pasting every region")
+        return None
+
+    unchanged = find_unchanged(regions, edited_folder, manifest, workers)
+    indices = regions_to_paste(regions, unchanged)
+    print(f"{len(regions) - int(unchanged.sum())} of {len(regions)} crops changed; pasting {len(indices)} regions")
+    return indices
+
+
+def _blend(dst, src, alpha):
+    # Same integer rounding as PIL's paste-with-mask, so results match Image.paste byte for byte
+    a = alpha[..., None].astype(np.uint16)
+    blended = dst.astype(np.uint16) * (255 - a) + src.astype(np.uint16) * a + 128
+    dst[...] = ((blended >> 8) + blended) >> 8
+
+
+def edited_pixels(edited_img, box):
+    # An edited crop (PIL image) as an RGB or RGBA array the size of its region
+    if edited_img.mode not in ("RGB", "RGBA"):
+        edited_img = edited_img.convert("RGBA")
+    expected_size = (box[2], box[3])
+    if edited_img.size != expected_size:
+        edited_img = edited_img.resize(expected_size)
+    return np.asarray(edited_img)
+
+
+def composite_pixels(master, box, pixels):
+    # Pastes RGB/RGBA pixels over box in master (HxWx4, modified in place) like Image.paste with a mask
+    clipped = _clip_region(box, master.shape[1], master.shape[0])
+    if clipped is None:
+        return
+    y0, y1, x0, x1, sy, sx = clipped
+    src = pixels[sy:sy + (y1 - y0), sx:sx + (x1 - x0)]
+    dst = master[y0:y1, x0:x1]
+    instrument.count("regions", op="paste")
+    instrument.count("pixels", dst.shape[0] * dst.shape[1], op="paste")
+
+    with instrument.span("composite", op="paste"):
+        if src.shape[2] == 3:
+            # No alpha channel: fully opaque, straight copy
+            dst[..., :3] = src
+            dst[..., 3] = 255
+            return
+
+        alpha = src[..., 3]
+        if alpha.min() == 255:
+            dst[...] = src
+        elif alpha.max() > 0:
+            _blend(dst, src, alpha)
+
+
+def _composite_region(master, key, box, edited_folder, cancel=None):
+    # None once pasted (or skipped after cancel), otherwise why the region could not be pasted
+    if cancel is not None and cancel.is_set():
+        return None
+    edited_path = encoders.find_crop(edited_folder, key)
+    if edited_path is None:
+        return "missing edited image"
+
+    try:
+        with instrument.span("decode", op="paste"), Image.open(edited_path) as edited_img:
+            pixels = edited_pixels(edited_img, box)
+        composite_pixels(master, box, pixels)
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def composite_crops(master, regions, edited_folder, workers=None, progress=None, cancel=None, indices=None):
+    # master is an HxWx4 uint8 array modified in place. Crops are decoded and written by a thread pool
+    # straight into master; overlapping regions are applied layer by layer in region order.
+    # regions is a RegionStore or a coordinates dict. progress(count) is called as regions finish;
+    # once the optional cancel Event is set, regions not yet started are skipped.
+    # indices (ascending, e.g. from incremental_plan) limits the paste to those regions.
+    # Returns the regions that could not be pasted, as (key, error) pairs.
+    regions = as_region_store(regions)
+    workers = workers or os.cpu_count() or 1
+    layers = plan_layers(regions, indices)
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=len(regions), desc="Pasting", unit="crop") as pbar:
+        skipped = 0 if indices is None else len(regions) - len(indices)
+        if skipped:
+            pbar.update(skipped)
+            if progress:
+                progress(skipped)
+        for layer in layers:
+            if cancel is not None and cancel.is_set():
+                break
+            futures = {executor.submit(_composite_region, master, regions.key(index), regions.box(index),
+                                       edited_folder, cancel): regions.key(index)
+                       for index in layer}
+            for future in as_completed(futures):
+                error = future.result()
+                if error:
+                    tqdm.write(f"Error on region {futures[future]}: {error}")
+                    failures.append((futures[future], error))
+                pbar.update(1)
+                if progress:
+                    progress(1)
+
+    return failures
+
+
+def paste_crops(original_img, coords_data, edited_folder, workers=None):
+    master = np.array(original_img.convert("RGBA"))
+    composite_crops(master, coords_data, edited_folder, workers)
+    return Image.fromarray(master, "RGBA")
+
+
+def load_master(main_image_path):
+    # A writable copy of the shared decode, since crops are composited into it in place; read straight
+    # from a tile cache or an uncompressed file when there is one
+    with instrument.span("decode", op="paste"):
+        reader = roi.open_reader(main_image_path)
+        if reader is not None:
+            return reader.read_rgba(0, 0, reader.width, reader.height)
+        return np.array(image_cache.load(main_image_path, "RGBA"))
+
+
+def save_result(image, output_path, encoder=encoders.DEFAULT_PROFILE):
+    # image is a PIL image or an RGBA array; returns the path written, with the profile's extension
+    output_path = encoders.output_path(output_path, encoder)
+    encoded = encoders.EncodeStats(encoder)
+    encoded.add(*encoders.write_image(output_path, np.asarray(image), encoder, order="rgb", op="paste"))
+    print(encoded.summary())
+    return output_path
+
+
+def paste_edited_crops(json_path, main_image_path, edited_folder, output_path=None, workers=None, progress=None, cancel=None,
+                       incremental=True, manifest_path=None, encoder=encoders.DEFAULT_PROFILE):
+    # json_path may also be an already loaded RegionStore. With incremental, crops left as crop export
+    # wrote them are skipped (see incremental_plan). Returns a summary like crop_images_by_json; the
+    # result is saved even if some regions failed, with the original pixels left in those regions.
+    coords_data = load_coordinates(json_path) if isinstance(json_path, str) else as_region_store(json_path)
+    indices = incremental_plan(coords_data, main_image_path, edited_folder, manifest_path, workers) if incremental else None
+    master = load_master(main_image_path)
+    failures = composite_crops(master, coords_data, edited_folder, workers, progress, cancel, indices)
+    attempted = len(coords_data) if indices is None else len(indices)
+    summary = {
+        "regions": len(coords_data),
+        "pasted": attempted - len(failures),
+        "skipped": len(coords_data) - attempted,
+        "failed": len(failures),
+        "failures": failures,
+        "cancelled": cancel is not None and cancel.is_set(),
+        "output_path": None,
+    }
+    if summary["cancelled"]:
+        print("Paste cancelled; nothing saved")
+        return summary
+    if output_path:
+        summary["output_path"] = save_result(master, output_path, encoder)
+        print(f"Saved image to: {summary['output_path']}")
+    print(f"Pasting completed: {summary['pasted']}/{attempted} regions, {summary['failed']} failed.")
+    return summary
+
+
+def paste_edited_crops_dialog(parent=None, encoder=encoders.DEFAULT_PROFILE):
+    from PyQt5.QtWidgets import QFileDialog
+
+    # Select coordinates file
+    json_path, _ = QFileDialog.getOpenFileName(parent, "Select Coordinates File", "", "Coordinates (*.regions *.json)")
     if not json_path:
         return
 
     # Select main image
-    main_image_path, _ = QFileDialog.getOpenFileName(parent, "Select Main Image", "", "Image Files (*.png *.jpg *.jpeg *.bmp)")
+    main_image_path, _ = QFileDialog.getOpenFileName(parent, "Select Main Image", "", "Image Files (*.png *.jpg *.jpeg *.bmp *.tif *.tiff *.webp)")
     if not main_image_path:
         return
 
@@ -21,70 +322,36 @@ def paste_edited_crops_dialog(parent=None):
     if not edited_folder:
         return
 
-    # Load JSON
+    # Load coordinates
     try:
-        with open(json_path, "r") as f:
-            coords_data = json.load(f)
+        coords_data = load_coordinates(json_path)
     except Exception as e:
-        show_message("Error", f"Failed to load JSON: {e}", parent)
+        show_message("Error", f"Failed to load coordinates: {e}", parent)
         return
 
     # Load main image
     try:
-        original_img = Image.open(main_image_path).convert("RGBA")
+        master = load_master(main_image_path)
     except Exception as e:
         show_message("Error", f"Failed to load main image: {e}", parent)
         return
 
-    # Shared lock for thread-safe image pasting
-    paste_lock = threading.Lock()
-
-    # Split the work into two chunks
-    keys = list(coords_data.keys())
-    midpoint = len(keys) // 2
-    chunks = [keys[:midpoint], keys[midpoint:]]
-
-    def paste_worker(thread_keys, thread_id):
-        for key in tqdm(thread_keys, desc=f"Thread {thread_id}", position=thread_id):
-            coords = coords_data[key]
-            edited_path = os.path.join(edited_folder, f"{key}.png")
-            if not os.path.exists(edited_path):
-                tqdm.write(f"[Thread {thread_id}] Warning: Missing edited image: {key}")
-                continue
-            try:
-                edited_img = Image.open(edited_path).convert("RGBA")
-                expected_size = (coords['width'], coords['height'])
-                if edited_img.size != expected_size:
-                    edited_img = edited_img.resize(expected_size)
-
-                # Thread-safe paste
-                with paste_lock:
-                    original_img.paste(edited_img, (coords['x'], coords['y']), edited_img)
-
-            except Exception as e:
-                print(f"[Thread {thread_id}] Error on region {key}: {e}")
-
-    # Start both threads
-    threads = []
-    for i in range(2):
-        t = threading.Thread(target=paste_worker, args=(chunks[i], i))
-        threads.append(t)
-        t.start()
-
-    # Wait for both threads to complete
-    for t in threads:
-        t.join()
-
-    # Save the final image
-    output_path, _ = QFileDialog.getSaveFileName(parent, "Save Final Image", "", "PNG Files (*.png)")
+    failures = composite_crops(master, coords_data, edited_folder,
+                               indices=incremental_plan(coords_data, main_image_path, edited_folder))
+
+    # Save the final image (the encoder profile may change the extension)
+    output_path, _ = QFileDialog.getSaveFileName(parent, "Save Final Image", "", "Images (*.png *.webp *.tif)")
     if output_path:
         try:
-            original_img.save(output_path)
-            show_message("Success", f"Saved image to: {output_path}", parent)
+            output_path = save_result(master, output_path, encoder)
+            failed = f" ({len(failures)} regions could not be pasted)" if failures else ""
+            show_message("Success", f"Saved image to: {output_path}{failed}", parent)
         except Exception as e:
             show_message("Error", f"Could not save: {e}", parent)
 
 def show_message(title, message, parent=None):
+    from PyQt5.QtWidgets import QMessageBox
+
     msg = QMessageBox(parent)
     msg.setWindowTitle(title)
     msg.setText(message)
@@ -0,0 +1,140 @@
+# result_cache.py
+# On-disk cache of filter outputs, keyed by a hash of the input file's bytes plus the filter
+# parameters. Entries are written atomically, served by hard link (or copy), and evicted
+# least-recently-used first once the cache grows past max_bytes. Several processes can read and
+# fill the cache at once; eviction and the stats file are only touched by the batch's parent.
+
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+import encoders
+
+# Bump when the filter's output for the same inputs changes, so stale entries stop matching
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+HASH_CHUNK = 1024 * 1024
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(image_path, kernel_size, percentage, compare_value, set_value, comparison_operator, encoder=encoders.DEFAULT_PROFILE):
+    # The engine and strip height don't change the output, so they are not part of the key
+    params = [CACHE_VERSION, kernel_size, percentage, compare_value, set_value, comparison_operator]
+    if encoder != encoders.DEFAULT_PROFILE:
+        # Left out for the default profile so results cached before encoder profiles still match
+        params.append(encoder)
+    digest = hashlib.sha256()
+    digest.update(file_digest(image_path).encode('ascii'))
+    digest.update(json.dumps(params).encode('utf-8'))
+    # The format follows the output's extension, so it is part of the result too
+    extension = os.path.splitext(encoders.output_path(image_path, encoder))[1].lower()
+    return digest.hexdigest() + extension
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, link=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.link = link
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, dest_path):
+        # Puts the cached result at dest_path; returns False on a miss
+        path = self._path(key)
+        if not os.path.exists(path):
+            return False
+        # Never write through an existing file: it may be a hard link into the cache
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        try:
+            try:
+                if not self.link:
+                    raise OSError("linking disabled")
+                os.link(path, dest_path)
+            except FileNotFoundError:
+                raise
+            except OSError:
+                shutil.copyfile(path, dest_path)
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            # Evicted by another process since the check above; the caller computes the result instead
+            return os.path.exists(dest_path)
+        return True
+
+    def store(self, key, src_path):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(src_path, tmp_path)
+            # Read-only, so an in-place edit of a hard-linked output can't corrupt the entry
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.tmp') or name == 'stats.json':
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    info = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, info.st_size, info.st_mtime
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        # Removes least recently used entries until the cache fits in max_bytes
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        return evicted
+
+    def stats(self):
+        path = os.path.join(self.cache_dir, 'stats.json')
+        if not os.path.exists(path):
+            return {"hits": 0, "misses": 0, "evictions": 0}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def record(self, hits=0, misses=0, evictions=0):
+        stats = self.stats()
+        stats["hits"] += hits
+        stats["misses"] += misses
+        stats["evictions"] += evictions
+        path = os.path.join(self.cache_dir, 'stats.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(stats, f, indent=4)
+        os.replace(tmp_path, path)
+        return stats
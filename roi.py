@@ -0,0 +1,373 @@
+# roi.py
+# Region-of-interest reads from large images, so cropping touches only the parts of a scan the
+# regions cover instead of decoding all of it:
+#
+#   reader = open_reader("scan.tif")        # None if the file has to be decoded as a whole
+#   pixels = reader.read_bgr(x, y, width, height)
+#
+# Readers are available for
+#   - tile caches (TILE_EXTENSION files made by convert_to_tiles): the image cut into square tiles and
+#     stored uncompressed behind a small header, memory-mapped; a region reads only the tiles it overlaps.
+#     A cache next to the image (scan.png -> scan.png.tiles) is picked up automatically while it
+#     matches the image's size and mtime, so converting a master once pays off on every later crop;
+#   - uncompressed TIFF, BMP and PPM/PGM files, whose strips are memory-mapped where they are;
+#   - tiled Deflate TIFF (encoders' "lossless-archival" profile), decompressed one tile at a time.
+# PNG has no random access; decode_rows decodes a PNG only down to the last row needed.
+
+import bisect
+import io
+import math
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PIL import Image
+
+MAGIC = b"IMGTILES"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIIQQ")  # magic, version, width, height, channels, tile size, source size, source mtime_ns
+DATA_OFFSET = 4096                    # tiles start page-aligned
+TILE_SIZE = 256
+TILE_EXTENSION = ".tiles"
+
+# Disable pixel limit to support large images
+Image.MAX_IMAGE_PIXELS = None
+
+# PIL raw modes that map straight onto a NumPy array: channel order and channel count
+RAW_MODES = {"L": ("gray", 1), "RGB": ("rgb", 3), "RGBA": ("rgba", 4), "BGR": ("bgr", 3)}
+
+_TO_BGR = {"rgb": cv2.COLOR_RGB2BGR, "rgba": cv2.COLOR_RGBA2BGR, "bgra": cv2.COLOR_BGRA2BGR}
+_TO_RGBA = {"gray": cv2.COLOR_GRAY2RGBA, "rgb": cv2.COLOR_RGB2RGBA, "bgr": cv2.COLOR_BGR2RGBA,
+            "bgra": cv2.COLOR_BGRA2RGBA}
+
+
+def _clip(x, y, width, height, image_width, image_height):
+    x0, y0 = min(max(x, 0), image_width), min(max(y, 0), image_height)
+    x1, y1 = min(max(x + width, x0), image_width), min(max(y + height, y0), image_height)
+    return x0, y0, x1, y1
+
+
+def _map_file(path):
+    # Read-only mapping of the whole file, and the same bytes as a flat uint8 array
+    with open(path, "rb") as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapping, np.frombuffer(mapping, dtype=np.uint8)
+
+
+class _Reader:
+    # Subclasses set width, height, channels, order ("gray", "bgr", "bgra", "rgb" or "rgba") and
+    # implement read(x, y, width, height): the region clipped to the image, in the file's channel
+    # order, as a new HxWxC array. Readers that map their file keep the mapping in _mapping.
+    _mapping = None
+
+    def release(self):
+        # Drops the pages read so far from the process's resident set; they stay in the page cache and
+        # later reads fault them back in. Keeps a top-to-bottom pass over a huge image small.
+        if self._mapping is not None and hasattr(mmap, "MADV_DONTNEED"):
+            self._mapping.madvise(mmap.MADV_DONTNEED)
+
+    def read_bgr(self, x, y, width, height):
+        # Like cv2.imread(IMREAD_COLOR) cropped to the region
+        pixels = self.read(x, y, width, height)
+        if pixels.size == 0:
+            return np.empty(pixels.shape[:2] + (3,), dtype=np.uint8)
+        if self.order == "gray":
+            return cv2.cvtColor(pixels[..., 0], cv2.COLOR_GRAY2BGR)
+        if self.order == "bgr":
+            return pixels
+        return cv2.cvtColor(pixels, _TO_BGR[self.order])
+
+    def read_rgba(self, x, y, width, height):
+        # Like PIL's convert("RGBA") cropped to the region
+        pixels = self.read(x, y, width, height)
+        if pixels.size == 0:
+            return np.empty(pixels.shape[:2] + (4,), dtype=np.uint8)
+        if self.order == "rgba":
+            return pixels
+        return cv2.cvtColor(pixels[..., 0] if self.order == "gray" else pixels, _TO_RGBA[self.order])
+
+
+class TileFile(_Reader):
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a tile cache")
+        (_, version, self.width, self.height, self.channels, self.tile_size,
+         self.source_size, self.source_mtime_ns) = HEADER.unpack(header)
+        if version != VERSION:
+            raise ValueError(f"{path} has unsupported tile cache version {version}")
+        self.path = path
+        self.order = {1: "gray", 3: "bgr", 4: "bgra"}[self.channels]
+        size = self.tile_size
+        shape = (math.ceil(self.height / size), math.ceil(self.width / size), size, size, self.channels)
+        self._mapping, data = _map_file(path)
+        self.tiles = data[DATA_OFFSET:DATA_OFFSET + math.prod(shape)].reshape(shape)
+
+    def matches(self, image_path):
+        info = os.stat(image_path)
+        return info.st_size == self.source_size and info.st_mtime_ns == self.source_mtime_ns
+
+    def read(self, x, y, width, height):
+        x0, y0, x1, y1 = _clip(x, y, width, height, self.width, self.height)
+        out = np.empty((y1 - y0, x1 - x0, self.channels), dtype=np.uint8)
+        size = self.tile_size
+        for row in range(y0 // size, (y1 - 1) // size + 1 if y1 > y0 else 0):
+            top, bottom = max(y0, row * size), min(y1, (row + 1) * size)
+            for col in range(x0 // size, (x1 - 1) // size + 1 if x1 > x0 else 0):
+                left, right = max(x0, col * size), min(x1, (col + 1) * size)
+                out[top - y0:bottom - y0, left - x0:right - x0] = \
+                    self.tiles[row, col, top - row * size:bottom - row * size, left - col * size:right - col * size]
+        return out
+
+
+class RawImage(_Reader):
+    # Pixels stored uncompressed in the file: every strip or tile PIL reports is memory-mapped
+    def __init__(self, path, size, order, channels, blocks, mapping=None):
+        self.path = path
+        self._mapping = mapping
+        self.width, self.height = size
+        self.order = order
+        self.channels = channels
+        self.blocks = blocks  # (x0, y0, x1, y1, HxWxC view) in row-major order
+        self._bottoms = [block[3] for block in blocks]
+
+    @classmethod
+    def open(cls, path):
+        # None unless every block of the image is raw 8-bit pixels in a supported layout
+        with Image.open(path) as img:
+            size, mode, tiles = img.size, img.mode, list(img.tile)
+        if mode not in ("L", "RGB", "RGBA") or not tiles:
+            return None
+
+        # Every block is checked before the file is mapped, so the early returns leave nothing open
+        layouts = []
+        for tile in tiles:
+            codec, extents, offset, args = tile[0], tile[1], tile[2], tile[3]
+            if codec != "raw":
+                return None
+            if isinstance(args, str):
+                args = (args,)
+            rawmode = args[0]
+            stride = args[1] if len(args) > 1 else 0
+            orientation = args[2] if len(args) > 2 else 1
+            if rawmode not in RAW_MODES:
+                return None
+            layouts.append((extents, offset, rawmode, stride, orientation))
+
+        blocks = []
+        order = channels = None
+        mapping, data = _map_file(path)
+        try:
+            for (x0, y0, x1, y1), offset, rawmode, stride, orientation in layouts:
+                order, channels = RAW_MODES[rawmode]
+                rows, row_bytes = y1 - y0, (x1 - x0) * channels
+                stride = stride or row_bytes
+                view = data[offset:offset + rows * stride].reshape(rows, stride)
+                view = view[:, :row_bytes].reshape(rows, x1 - x0, channels)
+                if orientation < 0:
+                    view = view[::-1]  # bottom-up rows (BMP)
+                blocks.append((x0, y0, x1, y1, view))
+        except ValueError:
+            # Truncated file: the views must go before the mapping can close
+            del data, blocks
+            mapping.close()
+            raise
+        blocks.sort(key=lambda block: (block[1], block[0]))
+        return cls(path, size, order, channels, blocks, mapping)
+
+    def read(self, x, y, width, height):
+        x0, y0, x1, y1 = _clip(x, y, width, height, self.width, self.height)
+        out = np.empty((y1 - y0, x1 - x0, self.channels), dtype=np.uint8)
+        # Strips and tile rows don't overlap, so the bottoms are sorted too
+        for index in range(bisect.bisect_right(self._bottoms, y0), len(self.blocks)):
+            bx0, by0, bx1, by1, view = self.blocks[index]
+            if by0 >= y1:
+                break
+            top, bottom, left, right = max(y0, by0), min(y1, by1), max(x0, bx0), min(x1, bx1)
+            if top < bottom and left < right:
+                out[top - y0:bottom - y0, left - x0:right - x0] = view[top - by0:bottom - by0, left - bx0:right - bx0]
+        return out
+
+
+class TiledTiff(_Reader):
+    # Tiled, Deflate-compressed 8-bit TIFF (the "lossless-archival" encoder profile): a region
+    # decompresses only the tiles it overlaps, and recently used tiles are kept for neighbouring regions
+    CACHED_TILES = 64
+
+    def __init__(self, path, size, order, channels, tile_size, offsets, counts, predictor):
+        self.path = path
+        self.width, self.height = size
+        self.order = order
+        self.channels = channels
+        self.tile_size = tile_size
+        self.cols = math.ceil(self.width / tile_size)
+        self.offsets = offsets
+        self.counts = counts
+        self.predictor = predictor
+        self._mapping, self._data = _map_file(path)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path):
+        # None unless the file is a tiled, Deflate-compressed, 8-bit chunky TIFF
+        with Image.open(path) as img:
+            if img.format != "TIFF" or img.mode not in ("L", "RGB", "RGBA"):
+                return None
+            tags = img.tag_v2
+            if 322 not in tags or tags.get(259) not in (8, 32946) or tags.get(284, 1) != 1 \
+                    or tags.get(317, 1) not in (1, 2) or set(np.atleast_1d(tags.get(258, 8))) != {8} \
+                    or tags[322] != tags.get(323):
+                return None
+            order, channels = RAW_MODES[img.mode]
+            return cls(path, img.size, order, channels, tags[322], list(tags[324]), list(tags[325]),
+                       tags.get(317, 1))
+
+    def _tile(self, index):
+        with self._lock:
+            tile = self._cache.get(index)
+            if tile is not None:
+                self._cache.move_to_end(index)
+                return tile
+        offset = self.offsets[index]
+        data = zlib.decompress(self._data[offset:offset + self.counts[index]])
+        size = self.tile_size
+        tile = np.frombuffer(data, dtype=np.uint8).reshape(size, size, self.channels)
+        if self.predictor == 2:
+            tile = np.cumsum(tile, axis=1, dtype=np.uint8)  # undoes horizontal differencing, mod 256
+        with self._lock:
+            self._cache[index] = tile
+            if len(self._cache) > self.CACHED_TILES:
+                self._cache.popitem(last=False)
+        return tile
+
+    def read(self, x, y, width, height):
+        x0, y0, x1, y1 = _clip(x, y, width, height, self.width, self.height)
+        out = np.empty((y1 - y0, x1 - x0, self.channels), dtype=np.uint8)
+        size = self.tile_size
+        for row in range(y0 // size, (y1 - 1) // size + 1 if y1 > y0 else 0):
+            top, bottom = max(y0, row * size), min(y1, (row + 1) * size)
+            for col in range(x0 // size, (x1 - 1) // size + 1 if x1 > x0 else 0):
+                left, right = max(x0, col * size), min(x1, (col + 1) * size)
+                tile = self._tile(row * self.cols + col)
+                out[top - y0:bottom - y0, left - x0:right - x0] = \
+                    tile[top - row * size:bottom - row * size, left - col * size:right - col * size]
+        return out
+
+
+def cache_path(image_path):
+    return image_path + TILE_EXTENSION
+
+
+def convert_to_tiles(image_path, tiles_path=None, tile_size=TILE_SIZE):
+    # Decodes the image once and writes it as a tile cache (by default next to the image)
+    tiles_path = tiles_path or cache_path(image_path)
+    info = os.stat(image_path)
+    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise IOError(f"Could not read image {image_path}")
+    if image.dtype != np.uint8:
+        raise ValueError("Only 8-bit images can be converted to a tile cache")
+    if image.ndim == 2:
+        image = image[..., None]
+    height, width, channels = image.shape
+    rows, cols = math.ceil(height / tile_size), math.ceil(width / tile_size)
+
+    tmp_path = tiles_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, width, height, channels, tile_size, info.st_size, info.st_mtime_ns))
+        f.truncate(DATA_OFFSET + rows * cols * tile_size * tile_size * channels)
+    tiles = np.memmap(tmp_path, dtype=np.uint8, mode="r+", offset=DATA_OFFSET,
+                      shape=(rows, cols, tile_size, tile_size, channels))
+    band = np.zeros((tile_size, cols * tile_size, channels), dtype=np.uint8)
+    for row in range(rows):
+        # One band of tiles at a time; edge tiles are padded with zeros
+        source = image[row * tile_size:(row + 1) * tile_size]
+        band[:source.shape[0], :width] = source
+        band[source.shape[0]:] = 0
+        tiles[row] = band.reshape(tile_size, cols, tile_size, channels).transpose(1, 0, 2, 3)
+    tiles.flush()
+    del tiles
+    os.replace(tmp_path, tiles_path)
+    return tiles_path
+
+
+def open_reader(image_path):
+    # A reader for a tile cache, an image with an up-to-date cache next to it, or an uncompressed
+    # image; None when the image has to be decoded in full
+    try:
+        if image_path.lower().endswith(TILE_EXTENSION):
+            return TileFile(image_path)
+        cached = cache_path(image_path)
+        if os.path.exists(cached):
+            reader = TileFile(cached)
+            if reader.matches(image_path):
+                return reader
+            print(f"Warning: ignoring out-of-date tile cache {cached}")
+        if image_path.lower().endswith((".tif", ".tiff")):
+            return RawImage.open(image_path) or TiledTiff.open(image_path)
+        if image_path.lower().endswith((".bmp", ".ppm", ".pgm")):
+            return RawImage.open(image_path)
+    except (OSError, ValueError) as e:
+        print(f"Warning: region reads unavailable for {image_path}: {e}")
+    return None
+
+
+# PNG color types decode_rows handles and their bytes per pixel at 8 bits per sample
+_PNG_BYTES_PER_PIXEL = {0: 1, 2: 3, 3: 1, 6: 4}
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def decode_rows(image_path, stop):
+    # Decodes an 8-bit, non-interlaced PNG only down to row stop (PNG rows can only be decoded in
+    # order) and returns those rows in BGR order like cv2.imread; None for anything else. Only the
+    # filtered scanlines above stop are inflated; they go back into a small PNG of that height (stored,
+    # not recompressed) with the original palette, which PIL then unfilters and decodes.
+    try:
+        with open(image_path, "rb") as f:
+            if f.read(8) != b"\x89PNG\r\n\x1a\n":
+                return None
+            head = []
+            raw = []
+            inflater = zlib.decompressobj()
+            remaining = None
+            while remaining != 0:
+                header = f.read(8)
+                if len(header) < 8:
+                    return None
+                length, kind = struct.unpack(">I4s", header)
+                data = f.read(length)
+                f.seek(4, os.SEEK_CUR)  # CRC
+                if len(data) < length or kind == b"IEND":
+                    return None
+                if kind == b"IHDR":
+                    width, height, depth, color, _, _, interlace = struct.unpack(">IIBBBBB", data)
+                    if depth != 8 or color not in _PNG_BYTES_PER_PIXEL or interlace or stop >= height:
+                        return None
+                    rows = max(stop, 1)
+                    remaining = rows * (1 + width * _PNG_BYTES_PER_PIXEL[color])
+                    head.append(_png_chunk(kind, struct.pack(">II", width, rows) + data[8:]))
+                elif kind == b"IDAT":
+                    if remaining is None:
+                        return None
+                    raw.append(inflater.decompress(data, remaining))
+                    remaining -= len(raw[-1])
+                elif not raw:
+                    head.append(_png_chunk(kind, data))  # palette, transparency and the like
+    except (OSError, struct.error, zlib.error):
+        return None
+
+    png = b"\x89PNG\r\n\x1a\n" + b"".join(head) + _png_chunk(b"IDAT", zlib.compress(b"".join(raw), 0)) \
+        + _png_chunk(b"IEND", b"")
+    with Image.open(io.BytesIO(png)) as img:
+        pixels = np.asarray(img.convert("RGB"))
+    return cv2.cvtColor(pixels, cv2.COLOR_RGB2BGR)
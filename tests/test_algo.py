@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+
+import algo
+
+
+def _image(height, width, seed=0):
+    # Random pixels with a bright and a dark patch, so windows fall on both sides of each threshold
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, (height, width), dtype=np.uint8)
+    image[:height // 2, :width // 3] = 230
+    image[height // 2:, width // 2:] = 20
+    return image
+
+
+SHAPES = [(13, 21), (22, 9)]
+KERNEL_SIZES = [1, 2, 3, 4, 7, 30]
+PERCENTAGES = [0, 37.5, 100]
+VALUES = [(128, 0), (50, 255), (200, 17)]
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("kernel_size", KERNEL_SIZES)
+@pytest.mark.parametrize("percentage", PERCENTAGES)
+@pytest.mark.parametrize("comparison_operator", [">=", "<="])
+@pytest.mark.parametrize("compare_value,set_value", VALUES)
+def test_engines_match(shape, kernel_size, percentage, comparison_operator, compare_value, set_value):
+    image = _image(*shape)
+    loop = algo.filter_image(image, kernel_size, percentage, compare_value, set_value, comparison_operator, 'loop')
+    vectorized = algo.filter_image(image, kernel_size, percentage, compare_value, set_value, comparison_operator,
+                                   'vectorized')
+    assert vectorized.dtype == loop.dtype
+    assert vectorized.tobytes() == loop.tobytes()
+
+
+# Gigapixel tables and the difference-array stamp only kick in on huge images and kernels; lowering
+# the limits runs them on small ones
+@pytest.fixture(params=["int32", "uint32", "uint64"])
+def table(request, monkeypatch):
+    if request.param != "int32":
+        monkeypatch.setattr(algo, "CV2_INTEGRAL_PIXELS", 0)
+    if request.param == "uint64":
+        monkeypatch.setattr(algo, "UINT64_TABLE_SIDE", 0)
+    return request.param
+
+
+@pytest.fixture(params=["dilate", "scatter"])
+def stamp(request, monkeypatch):
+    monkeypatch.setattr(algo, "DILATE_STAMP_MAX", 10 ** 6 if request.param == "dilate" else 0)
+    return request.param
+
+
+def test_integral_dtype(table):
+    table_values = algo._integral(np.ones((5, 7), dtype=np.uint8))
+    assert table_values.dtype == np.dtype(table)
+    assert table_values.shape == (6, 8)
+    assert table_values[-1, -1] == 35
+
+
+@pytest.mark.parametrize("kernel_size", [1, 2, 5, 8])
+@pytest.mark.parametrize("percentage", [0, 37.5, 100])
+@pytest.mark.parametrize("comparison_operator", [">=", "<="])
+def test_fast_paths_match_loop(table, stamp, kernel_size, percentage, comparison_operator):
+    image = _image(17, 26, seed=kernel_size)
+    loop = algo.filter_image(image, kernel_size, percentage, 128, 0, comparison_operator, 'loop')
+    vectorized = algo.filter_image(image, kernel_size, percentage, 128, 0, comparison_operator, 'vectorized')
+    assert vectorized.tobytes() == loop.tobytes()
+
+
+def test_wrapped_table_counts():
+    # Gigapixel tables wrap around 2**32; window sums are still exact because no window holds 2**32 pixels
+    mask = (np.random.default_rng(1).random((40, 30)) < 0.5).astype(np.uint8)
+    table = algo._integral(mask).astype(np.uint32)
+    wrapped = table + np.uint32(2 ** 32 - 12345)
+    assert np.array_equal(algo._window_sums(wrapped, 7), algo._window_sums(table, 7))
+
+
+def test_stamp_above_dilate_limit():
+    # A kernel past DILATE_STAMP_MAX goes through the difference-array scatter by default
+    kernel_size = algo.DILATE_STAMP_MAX + 12
+    image = _image(kernel_size + 25, kernel_size + 18, seed=3)
+    loop = algo.filter_image(image, kernel_size, 45, 128, 0, '>=', 'loop')
+    vectorized = algo.filter_image(image, kernel_size, 45, 128, 0, '>=', 'vectorized')
+    assert vectorized.tobytes() == loop.tobytes()
+
+
+@pytest.mark.parametrize("kernel_size", [1, 3, 6])
+def test_stack_matches_filter_image(table, stamp, kernel_size):
+    stack = np.stack([_image(15, 19, seed=seed) for seed in range(5)])
+    filtered = algo.filter_stack(stack, kernel_size, 50, 128, 255, '>=', workers=2)
+    for image, result in zip(stack, filtered):
+        assert np.array_equal(result, algo.filter_image(image, kernel_size, 50, 128, 255, '>='))
+
+
+def test_tiled_matches_whole_image():
+    image = _image(200, 37, seed=4)
+    tiled = algo.filter_image_tiled(image, 9, 50, 128, 0, '<=', strip_height=16, workers=3)
+    assert np.array_equal(tiled, algo.filter_image(image, 9, 50, 128, 0, '<='))
+
+
+def test_directory_from_a_thread(tmp_path):
+    # The GUI runs directory filtering on a worker thread, with a cancel Event
+    import threading
+
+    import cv2
+
+    input_dir, output_dir = tmp_path / "in", tmp_path / "out"
+    input_dir.mkdir()
+    images = {f"page{index}.png": _image(40, 30, seed=index) for index in range(3)}
+    for name, image in images.items():
+        cv2.imwrite(str(input_dir / name), image)
+
+    results = {}
+    thread = threading.Thread(target=lambda: results.update(algo.process_images_in_directory(
+        str(input_dir), str(output_dir), 3, 50, 128, 0, '>=', workers=2, cancel=threading.Event())))
+    thread.start()
+    thread.join(120)
+    assert len(results) == 3 and all(result["error"] is None for result in results.values())
+    for name, image in images.items():
+        output = cv2.imread(results[str(input_dir / name)]["output"], cv2.IMREAD_UNCHANGED)
+        assert np.array_equal(output, algo.filter_image(image, 3, 50, 128, 0, '>='))
@@ -0,0 +1,64 @@
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+import cli
+
+
+def _master(tmp_path):
+    path = str(tmp_path / "master.png")
+    cv2.imwrite(path, np.full((40, 60, 3), 200, dtype=np.uint8))
+    regions = str(tmp_path / "regions.json")
+    with open(regions, "w") as f:
+        json.dump({"a": {"x": 0, "y": 0, "width": 10, "height": 10},
+                   "b": {"x": 20, "y": 10, "width": 15, "height": 15}}, f)
+    return path, regions
+
+
+def test_bad_options_fail_the_job_not_the_run():
+    assert cli.run_job({"op": "filter", "input_dir": ".", "output_dir": ".", "encoder": "nope"})[:2] == ("filter", False)
+    op, ok, error = cli.run_job({"op": "filter", "input_dir": ".", "output_dir": ".", "percentage": [1, 2, 3]})
+    assert not ok and "--color" in error
+
+
+def test_main_exits_on_bad_options(tmp_path):
+    with pytest.raises(SystemExit, match="Error: .*nope"):
+        cli.main(["filter", str(tmp_path), str(tmp_path), "--encoder", "nope"])
+
+
+def test_paste_status(tmp_path):
+    master, regions = _master(tmp_path)
+    edited = tmp_path / "edited"
+    edited.mkdir()
+    cv2.imwrite(str(edited / "a.png"), np.zeros((10, 10, 3), dtype=np.uint8))
+    output = str(tmp_path / "out.png")
+    assert cli.main(["paste", regions, master, str(edited), output, "--full"]) == 1
+    cv2.imwrite(str(edited / "b.png"), np.zeros((15, 15, 3), dtype=np.uint8))
+    assert cli.main(["paste", regions, master, str(edited), output, "--full"]) == 0
+    pasted = cv2.imread(output)
+    assert pasted[:10, :10].max() == 0 and pasted[10:25, 20:35].max() == 0 and pasted[30:, 40:].min() == 200
+
+
+@pytest.mark.parametrize("op", ["pdf", "pipeline"])
+def test_pdf_status_ignores_earlier_output(tmp_path, op):
+    pdf_path = str(tmp_path / "out.pdf")
+    with open(pdf_path, "wb") as f:
+        f.write(b"from an earlier run")
+    missing = str(tmp_path / "missing.png")
+    empty_dir = tmp_path / "empty"
+    empty_dir.mkdir()
+    if op == "pdf":
+        assert cli.main(["pdf", missing, pdf_path]) == 1
+        assert cli.main(["pdf", str(empty_dir), pdf_path]) == 1
+    else:
+        assert cli.main(["pipeline", str(empty_dir), pdf_path]) == 1
+        assert cli.run_job({"op": "pipeline", "input_path": missing, "pdf_path": pdf_path})[1] is False
+    assert open(pdf_path, "rb").read() == b"from an earlier run"
+
+    page = str(tmp_path / "page.png")
+    cv2.imwrite(page, np.zeros((10, 10), dtype=np.uint8))
+    args = ["pdf", page, pdf_path] if op == "pdf" else ["pipeline", page, pdf_path]
+    assert cli.main(args) == 0
+    assert open(pdf_path, "rb").read().startswith(b"%PDF")
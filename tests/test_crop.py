@@ -0,0 +1,27 @@
+import json
+import os
+
+import cv2
+import numpy as np
+
+import crop
+from regions import RegionStore
+
+
+def test_interrupted_write_leaves_no_crop(tmp_path, monkeypatch):
+    image = np.random.default_rng(0).integers(0, 256, (50, 60, 3), dtype=np.uint8)
+    regions = RegionStore.from_boxes([(0, 0, 10, 10), (20, 5, 30, 40)])
+    real_replace = os.replace
+
+    def replace(src, dst):
+        if dst.endswith("2.png"):
+            raise OSError("disk full")
+        real_replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", replace)
+    summary = crop.export_crops(image, regions, str(tmp_path), workers=1)
+    assert summary["written"] == 1 and [key for key, _ in summary["failures"]] == ["2"]
+    assert sorted(f for f in os.listdir(tmp_path) if f.endswith((".png", ".tmp"))) == ["1.png"]
+    assert np.array_equal(cv2.imread(str(tmp_path / "1.png")), image[:10, :10])
+    with open(tmp_path / "crop_manifest.json") as f:
+        assert list(json.load(f)["crops"]) == ["1"]
@@ -0,0 +1,91 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+import encoders
+import roi
+
+PROFILES = ["default", "fast", "small", "webp", "lossless-archival"]
+
+
+def _pixels(channels, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = (61, 83) if channels == 1 else (61, 83, channels)
+    return rng.integers(0, 256, shape, dtype=np.uint8)
+
+
+def _stored(pixels, profile):
+    # What a profile keeps of pixels (OpenCV channel order), read back unchanged by cv2
+    if profile == "lossless-archival" and pixels.ndim == 3 and pixels.shape[2] == 4:
+        return pixels[..., :3]
+    if profile == "webp" and pixels.ndim == 2:
+        return cv2.merge([pixels] * 3)
+    return pixels
+
+
+@pytest.mark.parametrize("profile", PROFILES)
+@pytest.mark.parametrize("channels", [1, 3, 4])
+def test_cv2_round_trip(tmp_path, profile, channels):
+    pixels = _pixels(channels)
+    path = encoders.output_path(str(tmp_path / "image.png"), profile)
+    nbytes, _ = encoders.write_image(path, pixels, profile)
+    assert nbytes == os.path.getsize(path)
+    assert np.array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), _stored(pixels, profile))
+
+
+@pytest.mark.parametrize("channels", [1, 3, 4])
+def test_archival_readers_agree(tmp_path, channels):
+    # cv2, PIL and the roi tile reader see the same pixels
+    pixels = _pixels(channels, seed=1)
+    path = encoders.output_path(str(tmp_path / "image.png"), "lossless-archival")
+    encoders.write_image(path, pixels, "lossless-archival")
+    expected = _stored(pixels, "lossless-archival")
+    with Image.open(path) as img:
+        from_pil = encoders._to_bgr_order(np.asarray(img))
+    reader = roi.open_reader(path)
+    from_roi = reader.read_bgr(0, 0, reader.width, reader.height)
+    assert np.array_equal(from_pil, expected)
+    assert np.array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), expected)
+    assert np.array_equal(from_roi, expected if expected.ndim == 3 else cv2.merge([expected] * 3))
+
+
+def test_webp_gray_reads_back_gray(tmp_path):
+    pixels = _pixels(1)
+    path = encoders.output_path(str(tmp_path / "image.png"), "webp")
+    encoders.write_image(path, pixels, "webp")
+    assert np.array_equal(cv2.imread(path, cv2.IMREAD_GRAYSCALE), pixels)
+
+
+def test_write_is_atomic(tmp_path, monkeypatch):
+    path = str(tmp_path / "image.png")
+    encoders.write_image(path, _pixels(1), "fast")
+    before = open(path, "rb").read()
+
+    def fail(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        encoders.write_image(path, _pixels(1, seed=5), "fast")
+    assert open(path, "rb").read() == before
+    assert os.listdir(tmp_path) == ["image.png"]
+
+
+@pytest.mark.parametrize("profile", PROFILES)
+@pytest.mark.parametrize("channels", [1, 3, 4])
+@pytest.mark.parametrize("extension", [".png", ".bmp", ".tif"])
+def test_strip_writer_matches_write_image(tmp_path, profile, channels, extension):
+    pixels = _pixels(channels, seed=2)
+    path = encoders.output_path(str(tmp_path / ("strips" + extension)), profile)
+    writer = encoders.StripWriter(path, pixels.shape[1], pixels.shape[0], channels, profile)
+    for start in range(0, pixels.shape[0], 16):
+        writer.write(pixels[start:start + 16])
+    nbytes, _ = writer.close()
+    assert nbytes == os.path.getsize(path)
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
+    whole = encoders.output_path(str(tmp_path / ("whole" + extension)), profile)
+    encoders.write_image(whole, pixels, profile)
+    assert np.array_equal(cv2.imread(path, cv2.IMREAD_UNCHANGED), cv2.imread(whole, cv2.IMREAD_UNCHANGED))
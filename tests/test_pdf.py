@@ -0,0 +1,52 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+import pdf
+
+
+def _pages(tmp_path, count):
+    paths = []
+    for index in range(count):
+        path = str(tmp_path / f"page{index}.png")
+        cv2.imwrite(path, np.full((20, 30), index * 40, dtype=np.uint8))
+        paths.append(path)
+    return paths
+
+
+def test_failed_page_leaves_no_pdf(tmp_path):
+    pdf_path = str(tmp_path / "book.pdf")
+    paths = _pages(tmp_path, 3) + [str(tmp_path / "missing.png")]
+    with pytest.raises(OSError):
+        pdf.images_to_pdf(paths, pdf_path, workers=1)
+    assert not os.path.exists(pdf_path) and not os.path.exists(pdf_path + ".tmp")
+
+
+def test_cancel_keeps_earlier_pdf(tmp_path):
+    pdf_path = str(tmp_path / "book.pdf")
+    with open(pdf_path, "wb") as f:
+        f.write(b"earlier")
+    cancel = threading.Event()
+    cancel.set()
+    assert pdf.images_to_pdf(_pages(tmp_path, 2), pdf_path, cancel=cancel) is None
+    assert open(pdf_path, "rb").read() == b"earlier" and not os.path.exists(pdf_path + ".tmp")
+
+
+def test_pdf_written(tmp_path):
+    pdf_path = str(tmp_path / "book.pdf")
+    assert pdf.images_to_pdf(_pages(tmp_path, 2), pdf_path) == pdf_path
+    data = open(pdf_path, "rb").read()
+    assert data.startswith(b"%PDF-1.4") and data.endswith(b"%%EOF\n") and b"/Count 2" in data
+    assert os.listdir(tmp_path).count("book.pdf.tmp") == 0
+
+
+def test_failed_pipeline_leaves_no_pdf(tmp_path):
+    from pipeline import run_pipeline
+
+    pdf_path = str(tmp_path / "book.pdf")
+    with pytest.raises(Exception):
+        run_pipeline(_pages(tmp_path, 2) + [str(tmp_path / "missing.png")], pdf_path, workers=1)
+    assert not os.path.exists(pdf_path) and not os.path.exists(pdf_path + ".tmp")
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+import replace
+from regions import RegionStore
+
+
+def _overlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+@pytest.fixture
+def store(monkeypatch):
+    # Small chunks and cells, so regions overlap across chunk and cell boundaries
+    monkeypatch.setattr(replace, "PLAN_CHUNK", 7)
+    monkeypatch.setattr(replace, "OVERLAP_CELL", 16)
+    rng = np.random.default_rng(0)
+    count = 150
+    boxes = np.stack([rng.integers(-10, 120, count), rng.integers(-10, 120, count),
+                      rng.integers(1, 30, count), rng.integers(1, 30, count)], 1)
+    return RegionStore.from_boxes(boxes)
+
+
+def _layers(boxes, indices):
+    # One region after another: a region goes above the highest earlier overlapping region
+    layer_of = {}
+    for i in indices:
+        layer_of[i] = max([layer_of[j] + 1 for j in layer_of if _overlap(boxes[i], boxes[j])], default=0)
+    return [[i for i in indices if layer_of[i] == layer] for layer in range(max(layer_of.values(), default=-1) + 1)]
+
+
+def test_plan_layers(store):
+    boxes = [store.box(i) for i in range(len(store))]
+    indices = list(range(0, len(store), 3))
+    assert [layer.tolist() for layer in replace.plan_layers(store)] == _layers(boxes, range(len(store)))
+    assert [layer.tolist() for layer in replace.plan_layers(store, indices)] == _layers(boxes, indices)
+    assert replace.plan_layers(store, []) == []
+
+
+def test_regions_to_paste(store):
+    boxes = [store.box(i) for i in range(len(store))]
+    unchanged = np.random.default_rng(1).random(len(store)) < 0.8
+    expected = [i for i in range(len(store))
+                if not unchanged[i] or any(not unchanged[j] and _overlap(boxes[i], boxes[j]) for j in range(i))]
+    assert replace.regions_to_paste(store, unchanged).tolist() == expected
@@ -0,0 +1,41 @@
+import os
+import shutil
+
+import pytest
+
+import result_cache
+
+
+@pytest.mark.parametrize("link", [True, False])
+def test_fetch_after_eviction_is_a_miss(tmp_path, monkeypatch, link):
+    cache = result_cache.ResultCache(str(tmp_path / "cache"), link=link)
+    src = tmp_path / "result.png"
+    src.write_bytes(b"pixels")
+    cache.store("ab1234.png", str(src))
+    entry = cache._path("ab1234.png")
+    dest = str(tmp_path / "out.png")
+
+    # Another process evicts the entry between the existence check and the link or copy
+    real_link, real_copy = os.link, shutil.copyfile
+
+    def evict_then(real):
+        def call(a, b):
+            if os.path.exists(entry):
+                os.chmod(entry, 0o600)
+                os.remove(entry)
+            return real(a, b)
+        return call
+
+    monkeypatch.setattr(os, "link", evict_then(real_link))
+    monkeypatch.setattr(shutil, "copyfile", evict_then(real_copy))
+    assert cache.fetch("ab1234.png", dest) is False
+    assert not os.path.exists(dest)
+
+
+def test_fetch_hit(tmp_path):
+    cache = result_cache.ResultCache(str(tmp_path / "cache"))
+    src = tmp_path / "result.png"
+    src.write_bytes(b"pixels")
+    cache.store("cd5678.png", str(src))
+    assert cache.fetch("cd5678.png", str(tmp_path / "out.png"))
+    assert (tmp_path / "out.png").read_bytes() == b"pixels"
@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+import roi
+
+
+def _scan(height=90, width=70, channels=3):
+    # Smooth gradients plus noise, so the encoder picks a mix of row filters
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[:height, :width]
+    base = ((xx * 3 + yy * 2) % 256).astype(np.uint8)[..., None].repeat(channels, axis=2)
+    return (base + rng.integers(0, 8, base.shape, dtype=np.uint8)).squeeze()
+
+
+@pytest.mark.parametrize("channels", [1, 3, 4])
+def test_decode_rows_matches_full_decode(tmp_path, channels):
+    path = str(tmp_path / "scan.png")
+    cv2.imwrite(path, _scan(channels=channels))
+    expected = cv2.imread(path, cv2.IMREAD_COLOR)
+    for stop in (0, 1, 37, 89):
+        rows = roi.decode_rows(path, stop)
+        assert np.array_equal(rows, expected[:max(stop, 1)])
+
+
+def test_decode_rows_palette(tmp_path):
+    path = str(tmp_path / "scan.png")
+    Image.fromarray(_scan()).convert("P", palette=Image.ADAPTIVE).save(path)
+    expected = cv2.imread(path, cv2.IMREAD_COLOR)
+    assert np.array_equal(roi.decode_rows(path, 50), expected[:50])
+
+
+def test_decode_rows_declines(tmp_path):
+    path = str(tmp_path / "scan.png")
+    cv2.imwrite(path, _scan())
+    assert roi.decode_rows(path, 90) is None  # every row: a plain decode is as cheap
+    cv2.imwrite(str(tmp_path / "deep.png"), _scan().astype(np.uint16) * 257)
+    assert roi.decode_rows(str(tmp_path / "deep.png"), 10) is None
+    cv2.imwrite(str(tmp_path / "scan.jpg"), _scan())
+    assert roi.decode_rows(str(tmp_path / "scan.jpg"), 10) is None
+
+
+def test_raw_image_maps_only_supported_files(tmp_path, monkeypatch):
+    mapped = []
+    real_map_file = roi._map_file
+
+    def map_file(path):
+        mapping, data = real_map_file(path)
+        mapped.append(mapping)
+        return mapping, data
+
+    monkeypatch.setattr(roi, "_map_file", map_file)
+    path = str(tmp_path / "scan.tif")
+    Image.fromarray(_scan()).save(path, compression="tiff_lzw")
+    assert roi.RawImage.open(path) is None
+    assert mapped == []
+
+    # A BMP cut short: the pixel views can't be made, and the mapping is closed
+    path = str(tmp_path / "scan.bmp")
+    cv2.imwrite(path, _scan())
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) // 2)
+    with pytest.raises(ValueError):
+        roi.RawImage.open(path)
+    assert len(mapped) == 1 and mapped[0].closed
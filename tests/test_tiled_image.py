@@ -0,0 +1,125 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+pytest.importorskip("PyQt5")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import encoders
+import tiled_image
+
+
+def _halved(image, shape):
+    fy = 2 if image.shape[0] > 1 else 1
+    fx = 2 if image.shape[1] > 1 else 1
+    return cv2.resize(image[:shape[0] * fy, :shape[1] * fx], (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+
+
+@pytest.fixture(autouse=True)
+def small_levels(monkeypatch):
+    # Several levels, bands and spilled levels on small images
+    monkeypatch.setattr(tiled_image, "TILE_SIZE", 64)
+    monkeypatch.setattr(tiled_image, "BAND_BYTES", 5000)
+    monkeypatch.setattr(tiled_image, "SPILL_BYTES", 20000)
+
+
+@pytest.mark.parametrize("extension", [".png", ".bmp", ".tif", ".tiles"])
+@pytest.mark.parametrize("shape", [(301, 187, 3), (130, 257), (90, 77, 4)])
+def test_levels_match_whole_image(tmp_path, extension, shape):
+    image = np.random.default_rng(0).integers(0, 256, shape, dtype=np.uint8)
+    if extension == ".tif":
+        path = encoders.output_path(str(tmp_path / "image.png"), "lossless-archival")
+        encoders.write_image(path, image, "lossless-archival")
+        image = image[..., :3] if image.ndim == 3 and image.shape[2] == 4 else image
+    elif extension == ".tiles":
+        path = str(tmp_path / "image.png")
+        cv2.imwrite(path, image)
+        import roi
+        roi.convert_to_tiles(path)
+    else:
+        path = str(tmp_path / ("image" + extension))
+        cv2.imwrite(path, image)
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+    pyramid = tiled_image.ImagePyramid(path)
+    updates = []
+    pyramid.build(lambda: updates.append(list(pyramid.levels)))
+    assert pyramid.error is None and pyramid.complete
+    # Compressed tiles get no preview; the coarsest level comes with the last update
+    assert updates[0][-1] is not None or extension == ".tif"
+    expected = image
+    for index, level in enumerate(pyramid.levels):
+        if index:
+            expected = _halved(expected, pyramid.shapes[index])
+        assert np.array_equal(np.asarray(level[0:level.shape[0], 0:level.shape[1]]), expected)
+    assert np.array_equal(pyramid.region(-5, 7, 40, 50), image[7:57, :35])
+    tile = pyramid.tile_image(len(pyramid.levels) - 1, 0, 0)
+    assert (tile.width(), tile.height()) == pyramid.shapes[-1][:2][::-1]
+    spill_dir = pyramid._spill_dir
+    pyramid.close()
+    assert spill_dir is None or not os.path.exists(spill_dir)
+
+
+def test_preview_replaced_by_coarsest_level(tmp_path):
+    path = str(tmp_path / "image.bmp")
+    image = np.random.default_rng(1).integers(0, 256, (300, 200, 3), dtype=np.uint8)
+    cv2.imwrite(path, image)
+    pyramid = tiled_image.ImagePyramid(path)
+    seen = []
+    pyramid.build(lambda: seen.append((pyramid.generation, np.array(pyramid.levels[-1]))))
+    assert seen[0][0] == 0 and seen[-1][0] == 1
+    assert seen[0][1].shape == seen[-1][1].shape
+    assert pyramid.levels[-1] is not None and pyramid.generation == 1
+    pyramid.close()
+
+
+def test_stop_ends_build(tmp_path):
+    path = str(tmp_path / "image.bmp")
+    cv2.imwrite(path, np.zeros((300, 200), dtype=np.uint8))
+    pyramid = tiled_image.ImagePyramid(path)
+    pyramid.build(pyramid.stop)
+    assert not pyramid.complete and pyramid.error is None
+    assert pyramid.region(0, 0, 10, 10).shape == (10, 10)
+    pyramid.close()
+
+
+@pytest.mark.parametrize("extension", [".bmp", ".png"])
+def test_crop_export_from_pyramid(tmp_path, extension):
+    from image_viewer import CropExportJob
+
+    path = str(tmp_path / ("image" + extension))
+    image = np.random.default_rng(2).integers(0, 256, (300, 200, 3), dtype=np.uint8)
+    cv2.imwrite(path, image)
+    pyramid = tiled_image.ImagePyramid(path)
+    pyramid.build()
+    assert isinstance(pyramid.levels[0], tiled_image._ReaderLevel) == (extension == ".bmp")
+
+    output_dir = str(tmp_path / "crops")
+    summary = CropExportJob(pyramid, [(10, 20, 30, 40), (150, 250, 100, 100)], output_dir).run()
+    pyramid.close()
+    assert summary["written"] == 2 and summary["failed"] == 0
+    assert np.array_equal(cv2.imread(os.path.join(output_dir, "1.png")), image[20:60, 10:40])
+    assert np.array_equal(cv2.imread(os.path.join(output_dir, "2.png")), image[250:, 150:])
+
+
+@pytest.fixture(scope="module")
+def qapp():
+    from PyQt5.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
+
+
+def test_export_job_snapshots_boxes(qapp):
+    from types import SimpleNamespace
+    from image_viewer import ImageViewer
+
+    viewer = ImageViewer()
+    viewer.image_item = SimpleNamespace(pyramid=None)
+    first = viewer.add_box(10.4, 20.6, 30.2, 39.7)
+    viewer.add_box(150, 250, 100, 100)
+    job = viewer.export_job("crops")
+    # Whole pixels with the edges rounded, like QRectF.toRect; later edits don't reach the job
+    viewer.annotations.update(first, 0, 0, 5, 5)
+    viewer.erase_box(first)
+    assert job.boxes == [(10, 21, 31, 39), (150, 250, 100, 100)]
@@ -0,0 +1,61 @@
+import os
+
+import cv2
+import numpy as np
+
+import watch
+
+
+def _watcher(tmp_path, monkeypatch, fail_times):
+    # A watcher whose filter fails the first fail_times calls, run in-process
+    input_dir, output_dir = tmp_path / "in", tmp_path / "out"
+    input_dir.mkdir()
+    cv2.imwrite(str(input_dir / "page.png"), np.full((20, 20), 200, dtype=np.uint8))
+    calls = []
+    real_filter = watch._filter_file
+
+    def flaky(image_path, output_path, params):
+        calls.append(image_path)
+        if len(calls) <= fail_times:
+            return "file is locked", 0, 0.0
+        return real_filter(image_path, output_path, params)
+
+    monkeypatch.setattr(watch, "_filter_file", flaky)
+    params = watch.resolve_profile()
+    return watch.Watcher(str(input_dir), str(output_dir), params, workers=1, settle=0), calls
+
+
+class _Executor:
+    def submit(self, fn, *args):
+        from concurrent.futures import Future
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+def _poll(watcher, times):
+    for _ in range(times):
+        watcher.scan()
+        watcher.submit(_Executor())
+        watcher.collect(list(watcher.in_flight))
+
+
+def test_failure_is_retried(tmp_path, monkeypatch):
+    watcher, calls = _watcher(tmp_path, monkeypatch, fail_times=1)
+    _poll(watcher, 6)
+    assert len(calls) == 2 and watcher.processed == 1 and watcher.failed == 1
+    assert os.path.exists(watcher.output_path("page.png"))
+    watcher.journal.close()
+
+
+def test_retries_are_bounded_across_restarts(tmp_path, monkeypatch):
+    watcher, calls = _watcher(tmp_path, monkeypatch, fail_times=100)
+    _poll(watcher, 2)
+    watcher.journal.close()
+    assert len(calls) == 2
+
+    # A restart picks up the attempts from the journal
+    watcher = watch.Watcher(watcher.input_dir, watcher.output_dir, watcher.params, workers=1, settle=0)
+    _poll(watcher, 10)
+    assert len(calls) == watch.MAX_ATTEMPTS and watcher.processed == 0
+    watcher.journal.close()
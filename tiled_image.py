@@ -0,0 +1,442 @@
+# tiled_image.py
+# Level-of-detail image item for ImageViewer. The image is opened in the background as a
+# multi-resolution pyramid (each level half the size of the previous one) and only the tiles visible
+# at the current zoom are turned into pixmaps. Level 0 is read through a roi reader where the file
+# allows region reads (tile caches, uncompressed TIFF/BMP/PPM, archival TIFF), so it is never decoded
+# as a whole; anything else is decoded once. Levels are built from level 0 in bands, and any level
+# bigger than SPILL_BYTES, level 0 included, lives in a memory-mapped file instead of RAM.
+# A coarse preview is shown as soon as level 0 is open, while the finer levels are filled in.
+# Tile decoding runs on a thread pool and pixmaps live in an LRU cache with a memory cap.
+
+import math
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import instrument
+import image_cache
+import roi
+from PyQt5.QtWidgets import QGraphicsObject, QStyleOptionGraphicsItem, QGraphicsItem
+from PyQt5.QtGui import QImage, QImageReader, QPixmap, QPainter
+from PyQt5.QtCore import QRectF, QObject, QRunnable, QThreadPool, pyqtSignal
+
+TILE_SIZE = 512
+# Levels bigger than this are moved to a memory-mapped file instead of staying in RAM
+SPILL_BYTES = 256 * 1024 * 1024
+CACHE_BYTES = 256 * 1024 * 1024
+# Source pixels read at a time when building a level
+BAND_BYTES = 64 * 1024 * 1024
+
+
+class _ReaderLevel:
+    # Level 0 read through a roi reader: [rows, cols] slices come back in cv2's channel order
+    # (gray, BGR or BGRA), like the rest of the pyramid
+    _TO_CV2 = {"rgb": cv2.COLOR_RGB2BGR, "rgba": cv2.COLOR_RGBA2BGRA}
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.shape = (reader.height, reader.width) + (() if reader.channels == 1 else (reader.channels,))
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        y0, y1, _ = rows.indices(self.shape[0])
+        x0, x1, _ = cols.indices(self.shape[1])
+        pixels = self.reader.read(x0, y0, x1 - x0, y1 - y0)
+        if self.reader.order == "gray":
+            return pixels[..., 0]
+        if self.reader.order in self._TO_CV2 and pixels.size:
+            return cv2.cvtColor(pixels, self._TO_CV2[self.reader.order])
+        return pixels
+
+    def read_bgr(self, x, y, width, height):
+        # For crop.export_crops, which reads regions from roi readers this way
+        return self.reader.read_bgr(x, y, width, height)
+
+    def release(self):
+        self.reader.release()
+
+
+def _level_shapes(shape):
+    shapes = [tuple(shape)]
+    while max(shapes[-1][:2]) > TILE_SIZE:
+        height, width = shapes[-1][:2]
+        shapes.append((max(height // 2, 1), max(width // 2, 1)) + shapes[-1][2:])
+    return shapes
+
+
+def _sample(level0, shape):
+    # Nearest-pixel preview of level0 at shape, reading one source row per output row
+    rows = ((np.arange(shape[0]) + 0.5) * level0.shape[0] / shape[0]).astype(int)
+    cols = ((np.arange(shape[1]) + 0.5) * level0.shape[1] / shape[1]).astype(int)
+    preview = np.empty(shape, dtype=np.uint8)
+    for index, row in enumerate(rows.tolist()):
+        preview[index] = level0[row:row + 1][0, cols]
+    return preview
+
+
+class ImagePyramid:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.shapes = []  # (height, width[, channels]) of every level, known once level 0 is open
+        self.levels = []  # arrays (level 0 possibly a _ReaderLevel); None until built
+        self.generation = 0  # bumped when the coarsest level's preview is replaced by the real level
+        self.complete = False
+        self.error = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._spill_dir = None
+
+    def build(self, on_update=None):
+        # Opens level 0, puts a preview in the coarsest level, then builds the levels from the finest
+        # down, halving the previous level in bands. on_update() is called whenever there is more to draw.
+        try:
+            with instrument.span("decode", op="viewer"):
+                level0 = self._open()
+            self.shapes = _level_shapes(level0.shape)
+            self.levels = [level0] + [None] * (len(self.shapes) - 1)
+            self._ready.set()
+
+            if len(self.shapes) > 1:
+                self.levels[-1] = self._preview(level0, self.shapes[-1])
+            if on_update and self.levels[-1] is not None:
+                on_update()
+
+            for index in range(1, len(self.shapes)):
+                level = self._allocate(self.shapes[index], index)
+                if not self._halve(level0 if index == 1 else self.levels[index - 1], level):
+                    return
+                self.levels[index] = level
+                if index == len(self.shapes) - 1:
+                    self.generation += 1
+                if on_update:
+                    on_update()
+            # A decode is only needed in RAM while the levels are built from it
+            self.levels[0] = self._spill(level0, 0)
+            self.complete = True
+        except Exception as e:
+            self.error = str(e)
+            if on_update:
+                on_update()
+        finally:
+            self._ready.set()
+
+    def _open(self):
+        # A roi reader where the file has one; otherwise an earlier decode, or a decode of our own
+        # (spilled once the levels are built if it is big, since the pyramid keeps it while the image is shown)
+        reader = roi.open_reader(self.file_path)
+        if reader is not None:
+            return _ReaderLevel(reader)
+        image = image_cache.shared.peek(self.file_path, "unchanged")
+        if image is None:
+            image = cv2.imread(self.file_path, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise IOError(f"Could not read image {self.file_path}")
+        if image.dtype != np.uint8:
+            image = cv2.convertScaleAbs(image, alpha=255.0 / max(int(image.max()), 1))
+        if image.ndim == 3 and image.shape[2] == 1:
+            image = image[:, :, 0]
+        return image
+
+    def _preview(self, level0, shape):
+        # The coarsest level straight from level 0: an area resize of a decoded image, or a sample of
+        # the rows a mapped file needs. None for compressed tiles, where any sample costs a full pass.
+        if not isinstance(level0, _ReaderLevel):
+            return cv2.resize(np.asarray(level0), (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+        if isinstance(level0.reader, roi.TiledTiff):
+            return None
+        preview = _sample(level0, shape)
+        level0.release()
+        return preview
+
+    def _halve(self, source, level):
+        # Fills level with 2x2 averages of source (1x2 or 2x1 once a side is down to one pixel), a band
+        # of rows at a time; False if the pyramid was closed part way
+        fy = 2 if source.shape[0] > 1 else 1
+        fx = 2 if source.shape[1] > 1 else 1
+        row_bytes = math.prod(source.shape[1:])
+        step = max(BAND_BYTES // (row_bytes * fy), 1)
+        height, width = level.shape[:2]
+        for top in range(0, height, step):
+            if self._stop.is_set():
+                return False
+            bottom = min(top + step, height)
+            band = np.asarray(source[top * fy:bottom * fy, :width * fx])
+            level[top:bottom] = cv2.resize(band, (width, bottom - top), interpolation=cv2.INTER_AREA)
+            if isinstance(source, _ReaderLevel):
+                source.release()
+        return True
+
+    def _allocate(self, shape, index):
+        if math.prod(shape) <= SPILL_BYTES:
+            return np.empty(shape, dtype=np.uint8)
+        return np.memmap(self._spill_path(index), dtype=np.uint8, mode='w+', shape=shape)
+
+    def _spill(self, array, index):
+        # A read-only array is shared with the decoded-image cache and already in memory; a spilled
+        # copy would only add to that. Readers are already backed by the file.
+        if not isinstance(array, np.ndarray) or array.nbytes <= SPILL_BYTES or not array.flags.writeable:
+            return array
+        # Written through the page cache rather than a writable mapping, so the copy doesn't count
+        # against the process while the decode is still held
+        path = self._spill_path(index)
+        array.tofile(path)
+        return np.memmap(path, dtype=array.dtype, mode='r', shape=array.shape)
+
+    def _spill_path(self, index):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="pyramid_")
+        return os.path.join(self._spill_dir, f"level{index}.raw")
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    @property
+    def ready(self):
+        # Level 0 is open (or opening failed)
+        return self._ready.is_set()
+
+    def region(self, x, y, width, height):
+        # Full-resolution pixels (BGR/BGRA/gray, as cv2 reads them) clipped to the image
+        self.wait()
+        if self.error:
+            raise IOError(self.error)
+        full = self.levels[0]
+        x0, y0 = max(int(x), 0), max(int(y), 0)
+        x1, y1 = min(int(x + width), full.shape[1]), min(int(y + height), full.shape[0])
+        return np.array(full[y0:max(y1, y0), x0:max(x1, x0)])
+
+    def tile_image(self, level, tx, ty):
+        array = self.levels[level]
+        tile = np.ascontiguousarray(array[ty * TILE_SIZE:(ty + 1) * TILE_SIZE, tx * TILE_SIZE:(tx + 1) * TILE_SIZE])
+        height, width = tile.shape[:2]
+        if tile.ndim == 2:
+            fmt = QImage.Format_Grayscale8
+        elif tile.shape[2] == 4:
+            fmt = QImage.Format_ARGB32  # BGRA byte order on little-endian
+        else:
+            fmt = QImage.Format_BGR888
+        # copy() so the QImage owns its pixels once the NumPy tile goes away
+        return QImage(tile.data, width, height, tile.strides[0], fmt).copy()
+
+    def stop(self):
+        # Lets a running build return at its next band
+        self._stop.set()
+
+    def close(self):
+        self.stop()
+        self.levels = []
+        if self._spill_dir:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+
+class TileCache:
+    # LRU of QPixmaps keyed by (level, tx, ty), evicting once the total size passes max_bytes
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        pixmap = self._items.get(key)
+        if pixmap is not None:
+            self._items.move_to_end(key)
+        return pixmap
+
+    def put(self, key, pixmap):
+        if key in self._items:
+            self.bytes -= self._size(self._items.pop(key))
+        self._items[key] = pixmap
+        self.bytes += self._size(pixmap)
+        while self.bytes > self.max_bytes and len(self._items) > 1:
+            _, evicted = self._items.popitem(last=False)
+            self.bytes -= self._size(evicted)
+
+    def clear(self):
+        self._items.clear()
+        self.bytes = 0
+
+    @staticmethod
+    def _size(pixmap):
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+
+class _Signals(QObject):
+    pyramid_ready = pyqtSignal()
+    tile_loaded = pyqtSignal(object, QImage)
+
+
+class _PyramidTask(QRunnable):
+    def __init__(self, pyramid, signals):
+        super().__init__()
+        self.pyramid = pyramid
+        self.signals = signals
+
+    def run(self):
+        self.pyramid.build(self.signals.pyramid_ready.emit)
+
+
+class _TileTask(QRunnable):
+    def __init__(self, pyramid, key, signals, is_wanted):
+        super().__init__()
+        self.pyramid = pyramid
+        self.key = key
+        self.signals = signals
+        self.is_wanted = is_wanted
+
+    def run(self):
+        # Zoom may have moved on while this was queued. The generation tells a preview tile of the
+        # coarsest level from a real one.
+        generation = self.pyramid.generation
+        if not self.is_wanted(self.key):
+            self.signals.tile_loaded.emit((self.key, generation), QImage())
+            return
+        try:
+            image = self.pyramid.tile_image(*self.key)
+        except Exception:
+            image = QImage()
+        self.signals.tile_loaded.emit((self.key, generation), image)
+
+
+class TiledImageItem(QGraphicsObject):
+    def __init__(self, file_path, cache_bytes=CACHE_BYTES):
+        super().__init__()
+        # Header-only read, so the scene knows the image size before anything is decoded
+        size = QImageReader(file_path).size()
+        self.width, self.height = max(size.width(), 0), max(size.height(), 0)
+
+        self.pyramid = ImagePyramid(file_path)
+        self.cache = TileCache(cache_bytes)
+        self.pending = set()
+        self.current_level = None
+        self.coarse_generation = None
+
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max(min(os.cpu_count() or 1, 4), 1))
+
+        self.signals = _Signals()
+        self.signals.pyramid_ready.connect(self._on_pyramid_ready)
+        self.signals.tile_loaded.connect(self._on_tile_loaded)
+
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption, True)
+        self.pool.start(_PyramidTask(self.pyramid, self.signals))
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.width, self.height)
+
+    def region(self, x, y, width, height):
+        return self.pyramid.region(x, y, width, height)
+
+    def close(self):
+        self.pyramid.stop()
+        self.pool.clear()
+        self.pool.waitForDone()
+        self.cache.clear()
+        self.pyramid.close()
+
+    def level_for(self, lod):
+        # The level matching the zoom, or the nearest coarser one already built; None if none is
+        levels = self.pyramid.levels
+        level = len(levels) - 1 if lod <= 0 else min(max(int(math.floor(math.log2(1.0 / lod))), 0), len(levels) - 1)
+        while level < len(levels) and levels[level] is None:
+            level += 1
+        return level if level < len(levels) else None
+
+    def _tile_rect(self, level, tx, ty):
+        # Scene rect covered by a tile; level sizes are rounded down, so scale by the real size ratio
+        height, width = self.pyramid.shapes[level][:2]
+        scale_x = self.width / width
+        scale_y = self.height / height
+        x0, y0 = tx * TILE_SIZE, ty * TILE_SIZE
+        x1, y1 = min(x0 + TILE_SIZE, width), min(y0 + TILE_SIZE, height)
+        return QRectF(x0 * scale_x, y0 * scale_y, (x1 - x0) * scale_x, (y1 - y0) * scale_y)
+
+    def _is_wanted(self, key):
+        return key[0] == self.current_level or key[0] == len(self.pyramid.levels) - 1
+
+    def _request(self, key):
+        if key in self.pending:
+            return
+        self.pending.add(key)
+        self.pool.start(_TileTask(self.pyramid, key, self.signals, self._is_wanted))
+
+    def _on_pyramid_ready(self):
+        if self.pyramid.error:
+            print(f"Error: {self.pyramid.error}")
+            return
+        if not self.pyramid.levels:
+            return  # closed while the update was queued
+        if not self.width or not self.height:
+            # Qt couldn't read the header; take the size from level 0 instead
+            self.prepareGeometryChange()
+            self.height, self.width = self.pyramid.shapes[0][:2]
+        # Keep the coarsest level around as a fallback while finer tiles load; its preview tiles are
+        # fetched again once the real level replaces the preview
+        coarsest = len(self.pyramid.levels) - 1
+        if self.pyramid.levels[coarsest] is not None and self.coarse_generation != self.pyramid.generation:
+            self.coarse_generation = self.pyramid.generation
+            height, width = self.pyramid.shapes[coarsest][:2]
+            for ty in range(math.ceil(height / TILE_SIZE)):
+                for tx in range(math.ceil(width / TILE_SIZE)):
+                    self._request((coarsest, tx, ty))
+        self.update()
+
+    def _on_tile_loaded(self, loaded, image):
+        key, generation = loaded
+        self.pending.discard(key)
+        if image.isNull():
+            return
+        self.cache.put(key, QPixmap.fromImage(image))
+        self.update(self._tile_rect(*key))
+        if key[0] == len(self.pyramid.levels) - 1 and generation != self.pyramid.generation:
+            self._request(key)  # read from the preview while the real level was being finished
+
+    def _draw_fallback(self, painter, level, tx, ty):
+        # Draw the matching part of the nearest coarser cached tile
+        for parent in range(level + 1, len(self.pyramid.levels)):
+            shift = parent - level
+            pixmap = self.cache.get((parent, tx >> shift, ty >> shift))
+            if pixmap is None:
+                continue
+            target = self._tile_rect(level, tx, ty)
+            parent_rect = self._tile_rect(parent, tx >> shift, ty >> shift)
+            sx = (target.x() - parent_rect.x()) / parent_rect.width() * pixmap.width()
+            sy = (target.y() - parent_rect.y()) / parent_rect.height() * pixmap.height()
+            sw = target.width() / parent_rect.width() * pixmap.width()
+            sh = target.height() / parent_rect.height() * pixmap.height()
+            painter.drawPixmap(target, pixmap, QRectF(sx, sy, sw, sh))
+            return
+
+    def paint(self, painter, option, widget=None):
+        if not self.pyramid.ready or self.pyramid.error or not self.pyramid.levels:
+            return
+
+        lod = QStyleOptionGraphicsItem.levelOfDetailFromTransform(painter.worldTransform())
+        level = self.level_for(lod)
+        if level is None:
+            return
+        self.current_level = level
+
+        height, width = self.pyramid.shapes[level][:2]
+        scale_x = width / self.width
+        scale_y = height / self.height
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        tx0 = max(int(exposed.left() * scale_x) // TILE_SIZE, 0)
+        ty0 = max(int(exposed.top() * scale_y) // TILE_SIZE, 0)
+        tx1 = min(int(math.ceil(exposed.right() * scale_x)) // TILE_SIZE, (width - 1) // TILE_SIZE)
+        ty1 = min(int(math.ceil(exposed.bottom() * scale_y)) // TILE_SIZE, (height - 1) // TILE_SIZE)
+
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, lod < 1)
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                key = (level, tx, ty)
+                pixmap = self.cache.get(key)
+                if pixmap is not None:
+                    painter.drawPixmap(self._tile_rect(*key), pixmap, QRectF(pixmap.rect()))
+                else:
+                    self._draw_fallback(painter, level, tx, ty)
+                    self._request(key)
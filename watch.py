@@ -0,0 +1,295 @@
+# watch.py
+# Watch-folder service around the threshold filter. Images dropped into input_dir are picked up once
+# they stop changing (same size and mtime for `settle` seconds), filtered on a bounded process pool
+# with the parameters of a saved profile, and written to output_dir through a temporary file that is
+# renamed into place, so readers never see a half-written result:
+#
+#   python cli.py watch scans/ filtered/ --profiles profiles.json --profile default
+#
+# Every finished file is appended to a journal (output_dir/.filter_journal.jsonl) with the input's
+# size and mtime and a digest of the parameters. After a restart, files whose journal entry still
+# matches are skipped; changed files, or a changed profile, are processed again. A file that failed
+# (perhaps locked or briefly unreadable) is retried up to MAX_ATTEMPTS times while it stays unchanged,
+# each retry waiting `settle` seconds like a new file. The directory is polled rather than watched
+# through OS notifications, so it works the same on network shares.
+
+import hashlib
+import json
+import os
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import encoders
+import instrument
+from algo import _filter_to_file, _read_gray
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+JOURNAL_NAME = ".filter_journal.jsonl"
+POLL_INTERVAL = 0.5
+SETTLE_SECONDS = 1.0
+# Tries for a file that keeps failing, before it is left alone until it changes
+MAX_ATTEMPTS = 3
+
+PROFILE_DEFAULTS = {
+    "kernel_size": 2,
+    "percentage": 50,
+    "compare_value": 100,
+    "set_value": 255,
+    "comparison_operator": ">=",
+    "engine": "vectorized",
+    "strip_height": None,
+    "encoder": encoders.DEFAULT_PROFILE,
+}
+
+
+def load_profiles(profiles_path):
+    # {"name": {filter parameters}, ...}, optionally under a "profiles" key; JSON or YAML
+    if not os.path.exists(profiles_path):
+        return {}
+    with open(profiles_path, "r") as f:
+        if profiles_path.lower().endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is required for YAML profile files (pip install pyyaml)")
+            profiles = yaml.safe_load(f) or {}
+        else:
+            profiles = json.load(f)
+    return profiles.get("profiles", profiles)
+
+
+def save_profile(profiles_path, name, params):
+    profiles = load_profiles(profiles_path)
+    profiles[name] = {k: params[k] for k in PROFILE_DEFAULTS if params.get(k) is not None}
+    tmp_path = profiles_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"profiles": profiles}, f, indent=4)
+    os.replace(tmp_path, profiles_path)
+
+
+def resolve_profile(profiles_path=None, name=None, overrides=None):
+    params = dict(PROFILE_DEFAULTS)
+    if name:
+        profiles = load_profiles(profiles_path) if profiles_path else {}
+        if name not in profiles:
+            raise ValueError(f"no profile {name!r} in {profiles_path}")
+        params.update(profiles[name])
+    params.update({k: v for k, v in (overrides or {}).items() if k in PROFILE_DEFAULTS and v is not None})
+    return params
+
+
+def params_digest(params):
+    if params.get("encoder") == encoders.DEFAULT_PROFILE:
+        # Journals written before encoder profiles existed stay valid for the default one
+        params = {k: v for k, v in params.items() if k != "encoder"}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def _filter_file(image_path, output_path, params):
+    # Runs in a worker process; returns (error message or None, bytes written, seconds spent encoding)
+    try:
+        with instrument.span("decode", op="watch"):
+            image = _read_gray(image_path, params["strip_height"])
+        if image is None:
+            return f"Could not read image {image_path}", 0, 0.0
+
+        # Same extension as the output, so the same format is written
+        stem, ext = os.path.splitext(os.path.basename(output_path))
+        tmp_path = os.path.join(os.path.dirname(output_path), f".{stem}.partial{ext}")
+        try:
+            nbytes, seconds = _filter_to_file(image, tmp_path, params["kernel_size"], params["percentage"],
+                                              params["compare_value"], params["set_value"],
+                                              params["comparison_operator"], params["engine"], params["strip_height"],
+                                              encoder=params["encoder"])
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return None, nbytes, seconds
+    except Exception as e:
+        return str(e), 0, 0.0
+    finally:
+        instrument.flush()
+
+
+def _init_worker():
+    # Service managers signal the whole process group; the main process decides when to stop and
+    # lets the workers finish the images they have
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+class Journal:
+    # Append-only record of processed files; the last entry for a name wins
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        lines = 0
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line from a crash
+                    self.entries[entry["file"]] = entry
+                    lines += 1
+        if lines > 2 * len(self.entries) + 100:
+            self._compact()
+        self.file = open(path, "a")
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def _entry(self, name, size, mtime_ns, digest):
+        # The entry for this version of the file and these parameters, if any
+        entry = self.entries.get(name)
+        if (entry is not None and entry["size"] == size and entry["mtime_ns"] == mtime_ns
+                and entry["params"] == digest):
+            return entry
+        return None
+
+    def is_done(self, name, size, mtime_ns, digest):
+        entry = self._entry(name, size, mtime_ns, digest)
+        return entry is not None and (entry["status"] == "done" or entry.get("attempts", 1) >= MAX_ATTEMPTS)
+
+    def attempts(self, name, size, mtime_ns, digest):
+        # Failed tries so far for this version of the file
+        entry = self._entry(name, size, mtime_ns, digest)
+        return entry.get("attempts", 1) if entry is not None and entry["status"] == "failed" else 0
+
+    def record(self, entry):
+        self.entries[entry["file"]] = entry
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class Watcher:
+    def __init__(self, input_dir, output_dir, params, workers=None, poll_interval=POLL_INTERVAL,
+                 settle=SETTLE_SECONDS):
+        if os.path.abspath(input_dir) == os.path.abspath(output_dir):
+            raise ValueError("The output directory must differ from the watched directory")
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.params = params
+        self.digest = params_digest(params)
+        self.workers = workers or os.cpu_count() or 1
+        self.poll_interval = poll_interval
+        self.settle = settle
+        os.makedirs(output_dir, exist_ok=True)
+        self.journal = Journal(os.path.join(output_dir, JOURNAL_NAME))
+        self.candidates = {}   # name -> ((size, mtime_ns), first seen, last changed) until a file settles
+        self.queue = deque()   # (name, size, mtime_ns, first seen), oldest first
+        self.queued = set()
+        self.in_flight = {}    # future -> (name, size, mtime_ns, first seen, started)
+        self.processed = 0
+        self.failed = 0
+
+    def scan(self):
+        # Queues files that have stopped changing and are not already done with these parameters
+        now = time.monotonic()
+        present = set()
+        with os.scandir(self.input_dir) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith(".") or not name.lower().endswith(IMAGE_EXTENSIONS) or not entry.is_file():
+                    continue
+                present.add(name)
+                try:
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                signature = (info.st_size, info.st_mtime_ns)
+                if name in self.queued or self.journal.is_done(name, *signature, self.digest):
+                    continue
+                seen = self.candidates.get(name)
+                if seen is None:
+                    seen = self.candidates[name] = (signature, now, now)
+                elif seen[0] != signature:
+                    seen = self.candidates[name] = (signature, seen[1], now)
+                # Still being written until it has stayed the same for `settle` seconds
+                if info.st_size and now - seen[2] >= self.settle:
+                    del self.candidates[name]
+                    self.queue.append((name, info.st_size, info.st_mtime_ns, seen[1]))
+                    self.queued.add(name)
+        # Forget files that were removed before they settled
+        for name in list(self.candidates):
+            if name not in present:
+                del self.candidates[name]
+
+    def output_path(self, name):
+        return encoders.output_path(os.path.join(self.output_dir, name), self.params["encoder"])
+
+    def submit(self, executor):
+        while self.queue and len(self.in_flight) < self.workers:
+            name, size, mtime_ns, first_seen = self.queue.popleft()
+            image_path = os.path.join(self.input_dir, name)
+            output_path = self.output_path(name)
+            future = executor.submit(_filter_file, image_path, output_path, self.params)
+            self.in_flight[future] = (name, size, mtime_ns, first_seen, time.monotonic())
+
+    def collect(self, done):
+        for future in done:
+            name, size, mtime_ns, first_seen, started = self.in_flight.pop(future)
+            self.queued.discard(name)
+            error, nbytes, encode_seconds = future.result()
+            finished = time.monotonic()
+            attempts = self.journal.attempts(name, size, mtime_ns, self.digest) + 1
+            self.journal.record({
+                "file": name, "size": size, "mtime_ns": mtime_ns, "params": self.digest,
+                "status": "failed" if error else "done", "error": error, "attempts": attempts,
+                "output": None if error else self.output_path(name),
+                "bytes": nbytes, "encode_seconds": round(encode_seconds, 4),
+                "seconds": round(finished - started, 4),
+                # Time from the file first appearing to its result being in place
+                "latency": round(finished - first_seen, 4),
+                "ts": time.time(),
+            })
+            if error:
+                self.failed += 1
+                retry = " (will retry)" if attempts < MAX_ATTEMPTS else f" (gave up after {attempts} attempts)"
+                print(f"Error: {name}: {error}{retry}")
+            else:
+                self.processed += 1
+                instrument.count("images", op="watch")
+                print(f"Filtered {name} in {finished - started:.2f}s ({finished - first_seen:.2f}s after it appeared), "
+                      f"{nbytes / 1024:.1f} KB encoded in {encode_seconds:.2f}s")
+
+    def run(self, stop_event=None):
+        # Runs until stop_event is set (or Ctrl+C); work in progress is finished before returning
+        stop_event = stop_event or threading.Event()
+        print(f"Watching {self.input_dir} -> {self.output_dir} with {self.workers} workers "
+              f"({len(self.journal.entries)} files in the journal)")
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker) as executor:
+                try:
+                    while not stop_event.is_set():
+                        self.scan()
+                        self.submit(executor)
+                        if self.in_flight:
+                            done, _ = wait(list(self.in_flight), timeout=self.poll_interval,
+                                           return_when=FIRST_COMPLETED)
+                            self.collect(done)
+                        else:
+                            stop_event.wait(self.poll_interval)
+                except KeyboardInterrupt:
+                    pass
+                if self.in_flight:
+                    print(f"Stopping; waiting for {len(self.in_flight)} images in progress")
+                    done, _ = wait(list(self.in_flight))
+                    self.collect(done)
+        finally:
+            self.journal.close()
+        print(f"Stopped: {self.processed} filtered, {self.failed} failed")
+        return self.failed == 0